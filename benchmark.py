@@ -0,0 +1,362 @@
+"""
+Throughput and latency benchmarks for StubServer and FTPStubServer.
+
+Everything runs against localhost. Results are printed and written as JSON
+so runs can be compared::
+
+    python benchmark.py --output benchmark.json
+    python benchmark.py --quick
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+from ftplib import FTP
+from io import BytesIO
+from stubserver import Body, StubServer, FTPStubServer, Times
+if sys.version_info[0] < 3:
+    from httplib import HTTPConnection
+else:
+    from http.client import HTTPConnection
+
+# Benchmarks hit only some of the expectations they register
+ANY = Times.at_least(0)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def summarise(latencies, elapsed, **extra):
+    """Turn a list of per-operation latencies into rate and percentile figures."""
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(p):
+        return latencies[min(count - 1, int(count * p))] if count else 0.0
+
+    result = {
+        "operations": count,
+        "seconds": elapsed,
+        "per_second": count / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(0.50),
+        "latency_p90": percentile(0.90),
+        "latency_p99": percentile(0.99),
+        "latency_max": latencies[-1] if count else 0.0,
+    }
+    result.update(extra)
+    return result
+
+
+def timed_requests(port, paths, method="GET", body=None, headers=None):
+    """Send one request per path over a single keep-alive connection, returning the latencies."""
+    conn = HTTPConnection('localhost', port)
+    latencies = []
+    try:
+        for path in paths:
+            started = time.time()
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            response.read()
+            latencies.append(time.time() - started)
+            if response.status >= 400:
+                raise AssertionError("%s %s answered %d" % (method, path, response.status))
+    finally:
+        conn.close()
+    return latencies
+
+
+def bench_expectation_count(counts, requests_per_run):
+    """Request rate as the number of registered expectations grows."""
+    results = {}
+    for count in counts:
+        port = free_port()
+        server = StubServer(port, protocol_version="HTTP/1.1")
+        for i in range(count):
+            server.expect(method="GET", url="^/item/%d$" % i, times=ANY).and_return(content="item")
+        server.expect(method="GET", url=r"^/search/\d+$", times=ANY).and_return(content="found")
+        server.run()
+        try:
+            paths = ["/item/%d" % ((i * 7919) % count) for i in range(requests_per_run)]
+            started = time.time()
+            latencies = timed_requests(port, paths)
+            literal = summarise(latencies, time.time() - started)
+            paths = ["/search/%d" % i for i in range(requests_per_run)]
+            started = time.time()
+            latencies = timed_requests(port, paths)
+            regex = summarise(latencies, time.time() - started)
+        finally:
+            server.stop()
+        results[str(count)] = {"literal_url": literal, "regex_url": regex}
+    return results
+
+
+def bench_same_url_bodies(count, requests_per_run):
+    """Request rate with ``count`` expectations on one URL that differ only in their JSON body."""
+    port = free_port()
+    server = StubServer(port, protocol_version="HTTP/1.1")
+    for i in range(count):
+        server.expect(method="POST", url="^/items$", data=Body.json({"id": i}), times=ANY).and_return(content="ok")
+    server.run()
+    try:
+        conn = HTTPConnection('localhost', port)
+        latencies = []
+        started = time.time()
+        for i in range(requests_per_run):
+            begin = time.time()
+            conn.request("POST", "/items", body='{"id": %d}' % (i * 7919 % count))
+            conn.getresponse().read()
+            latencies.append(time.time() - begin)
+        elapsed = time.time() - started
+        conn.close()
+    finally:
+        server.stop()
+    return summarise(latencies, elapsed, expectations=count)
+
+
+def bench_concurrent_clients(clients, requests_per_client, threads, processes=None):
+    """Many keep-alive clients hitting one expectation at the same time."""
+    port = free_port()
+    server = StubServer(port, threads=threads, protocol_version="HTTP/1.1", processes=processes)
+    server.expect(method="GET", url="^/shared$", times=ANY).and_return(content="shared")
+    server.run()
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        mine = timed_requests(port, ["/shared"] * requests_per_client)
+        with lock:
+            latencies.extend(mine)
+
+    try:
+        workers = [threading.Thread(target=client) for i in range(clients)]
+        started = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - started
+    finally:
+        server.stop()
+    return summarise(latencies, elapsed, clients=clients, server_threads=threads, server_processes=processes)
+
+
+def bench_large_bodies(size, repeat):
+    """Upload and download of ``size`` byte bodies."""
+    payload = os.urandom(size)
+    port = free_port()
+    server = StubServer(port, protocol_version="HTTP/1.1")
+    server.expect(method="GET", url="^/download$", times=ANY).and_return(content=payload)
+    server.expect(method="PUT", url="^/upload$", times=ANY, capture_digest=True).and_return(reply_code=204)
+    server.run()
+    try:
+        started = time.time()
+        latencies = timed_requests(port, ["/download"] * repeat)
+        elapsed = time.time() - started
+        download = summarise(latencies, elapsed, bytes=size, megabytes_per_second=size * repeat / elapsed / 1e6)
+        started = time.time()
+        latencies = timed_requests(port, ["/upload"] * repeat, method="PUT", body=payload)
+        elapsed = time.time() - started
+        upload = summarise(latencies, elapsed, bytes=size, megabytes_per_second=size * repeat / elapsed / 1e6)
+    finally:
+        server.stop()
+    return {"download": download, "upload": upload}
+
+
+def bench_compressed_json(size, repeat):
+    """Download of a ``size`` byte JSON body, plain and gzip encoded."""
+    item = '{"id": %d, "name": "item %d", "tags": ["a", "b", "c"], "active": true}'
+    payload = "[" + ", ".join(item % (i, i) for i in range(size // len(item))) + "]"
+    port = free_port()
+    server = StubServer(port, protocol_version="HTTP/1.1")
+    server.expect(method="GET", url="^/items$", times=ANY).and_return(mime_type="application/json",
+                                                                       content=payload, compress=True)
+    server.run()
+    results = {}
+    try:
+        for coding in ("identity", "gzip"):
+            started = time.time()
+            latencies = timed_requests(port, ["/items"] * repeat, headers={"Accept-Encoding": coding})
+            elapsed = time.time() - started
+            results[coding] = summarise(latencies, elapsed, bytes=len(payload))
+    finally:
+        server.stop()
+    return results
+
+
+def _ftp_session():
+    server = FTPStubServer(0)
+    server.run()
+    ftp = FTP()
+    ftp.connect('localhost', server.server.server_address[1])
+    ftp.login('user', 'password')
+    return server, ftp
+
+
+def _ftp_close(server, ftp):
+    try:
+        ftp.quit()
+    finally:
+        ftp.close()
+        server.stop()
+
+
+def bench_ftp_large_file(size):
+    """STOR then RETR of one ``size`` byte file."""
+    payload = b'x' * size
+    server, ftp = _ftp_session()
+    try:
+        started = time.time()
+        ftp.storbinary('STOR big.bin', BytesIO(payload))
+        stor = time.time() - started
+        received = []
+        started = time.time()
+        ftp.retrbinary('RETR big.bin', received.append)
+        retr = time.time() - started
+    finally:
+        _ftp_close(server, ftp)
+    if len(b''.join(received)) != size:
+        raise AssertionError("RETR returned %d bytes, expected %d" % (len(b''.join(received)), size))
+    return {
+        "bytes": size,
+        "stor": summarise([stor], stor, megabytes_per_second=size / stor / 1e6),
+        "retr": summarise([retr], retr, megabytes_per_second=size / retr / 1e6),
+    }
+
+
+def bench_ftp_small_files(count):
+    """Many small STOR and RETR transfers in one session."""
+    server, ftp = _ftp_session()
+    try:
+        latencies = []
+        started = time.time()
+        for i in range(count):
+            begin = time.time()
+            ftp.storbinary('STOR small%d.txt' % i, BytesIO(b'small file'))
+            latencies.append(time.time() - begin)
+        stor = summarise(latencies, time.time() - started)
+        latencies = []
+        started = time.time()
+        for i in range(count):
+            begin = time.time()
+            ftp.retrbinary('RETR small%d.txt' % i, lambda data: None)
+            latencies.append(time.time() - begin)
+        retr = summarise(latencies, time.time() - started)
+    finally:
+        _ftp_close(server, ftp)
+    return {"stor": stor, "retr": retr}
+
+
+def bench_ftp_concurrent_sessions(clients, count):
+    """``clients`` sessions at once, each storing and retrieving ``count`` small files."""
+    server = FTPStubServer(0)
+    server.run()
+    latencies = []
+    lock = threading.Lock()
+
+    def session(number):
+        ftp = FTP()
+        ftp.connect('localhost', server.port)
+        ftp.login('user', 'password')
+        mine = []
+        for i in range(count):
+            begin = time.time()
+            ftp.storbinary('STOR s%d-%d.txt' % (number, i), BytesIO(b'small file'))
+            ftp.retrbinary('RETR s%d-%d.txt' % (number, i), lambda data: None)
+            mine.append(time.time() - begin)
+        ftp.quit()
+        with lock:
+            latencies.extend(mine)
+    threads = [threading.Thread(target=session, args=(n,)) for n in range(clients)]
+    started = time.time()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.stop()
+    return summarise(latencies, time.time() - started, clients=clients)
+
+
+def bench_spec_load(count):
+    """Loading a JSON spec of ``count`` expectations."""
+    spec = [{"method": "GET", "url": "^/item/%d$" % i, "content": "item %d" % i} for i in range(count)]
+    handle, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(handle, 'w') as f:
+        json.dump(spec, f)
+    try:
+        server = StubServer(0)
+        started = time.time()
+        server.load(path)
+        elapsed = time.time() - started
+    finally:
+        os.remove(path)
+    return summarise([elapsed], elapsed, expectations=count)
+
+
+def bench_start_stop(cycles):
+    """Cost of starting a server, answering one request and stopping it."""
+    latencies = []
+    started = time.time()
+    for i in range(cycles):
+        begin = time.time()
+        server = StubServer(0)
+        server.expect(method="GET", url="^/$").and_return(content="up")
+        server.run()
+        timed_requests(server.port, ["/"])
+        server.stop()
+        latencies.append(time.time() - begin)
+    return summarise(latencies, time.time() - started)
+
+
+def run(quick=False):
+    scale = 10 if quick else 1
+    return {
+        "expectation_count": bench_expectation_count([10, 1000 // scale, 10000 // scale], 2000 // scale),
+        "same_url_bodies": bench_same_url_bodies(10000 // scale, 2000 // scale),
+        "concurrent_clients": bench_concurrent_clients(32 // (4 if quick else 1), 500 // scale, 8),
+        "concurrent_clients_processes": bench_concurrent_clients(32 // (4 if quick else 1), 500 // scale, 8,
+                                                                 processes=multiprocessing.cpu_count()),
+        "large_bodies": bench_large_bodies(32 * 1024 * 1024 // scale, 5),
+        "compressed_json": bench_compressed_json(8 * 1024 * 1024 // scale, 20),
+        "ftp_large_file": bench_ftp_large_file(64 * 1024 * 1024 // scale),
+        "ftp_small_files": bench_ftp_small_files(100 // scale),
+        "ftp_concurrent_sessions": bench_ftp_concurrent_sessions(8, 100 // scale),
+        "spec_load": bench_spec_load(50000 // scale),
+        "start_stop": bench_start_stop(20 // (4 if quick else 1)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--quick', action='store_true', help="smaller sizes, for a smoke test")
+    args = parser.parse_args(argv)
+    report = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "quick": args.quick,
+        "results": run(args.quick),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 """A stub webserver used to enable blackbox testing of applications that call external web urls. For example, an application that consumes data from an external REST api. The usage pattern is intended to be very much like using a mock framework."""
-from stubserver.webserver import StubServer
+import sys
+from stubserver.matcher import Body
+from stubserver.webserver import StubServer, Times
 from stubserver.ftpserver import FTPStubServer
+if sys.version_info >= (3, 7):
+    from stubserver.asyncserver import AsyncStubServer
 
 VERSION = __version__ = '1.0.2'
 __author__ = 'Chris Tarttelin and Point 2 inc'
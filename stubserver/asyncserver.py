@@ -0,0 +1,217 @@
+"""asyncio serving engine for :class:`stubserver.StubServer`. Requires Python 3.7+."""
+import asyncio
+import http.client
+import time
+from stubserver.body import DEFAULT_CAPTURE_LIMIT, READ_CHUNK, RequestBody, chunk_size, decoding, is_chunked
+from stubserver.journal import DEFAULT_JOURNAL_SIZE
+from stubserver.response import PreparedResponse
+from stubserver.stats import STATS_PATH
+from stubserver.webserver import Exchange, StubServer, fallback_response, stats_response
+
+
+class AsyncStubServer(StubServer):
+    """
+    A :class:`StubServer` serving every connection from a single asyncio
+    event loop, so thousands of mostly idle keep-alive connections cost no
+    threads. Expectations are registered and verified exactly as with
+    :class:`StubServer`, but the server is started and stopped from a
+    coroutine::
+
+        server = AsyncStubServer(0)
+        await server.start()
+        server.expect(method="GET", url="/$").and_return(content="hello")
+        ...
+        await server.stop()
+
+    Scopes are routed by prefix or header; there is no port per scope.
+    """
+    scope_routes = ("prefix", "header")
+
+    def __init__(self, port=8080, address='localhost', keep_alive_timeout=5, max_keep_alive_requests=None,
+                 backlog=1024, capture_limit=DEFAULT_CAPTURE_LIMIT, journal_size=DEFAULT_JOURNAL_SIZE,
+                 journal_file=None):
+        """
+        :param port: Port to listen on, 0 picks a free one
+        :type port: ``int``
+
+        :param address: Address to listen on
+        :type address: ``str``
+
+        :param keep_alive_timeout: Seconds a connection may stay idle before
+                                   it is closed
+        :type keep_alive_timeout: ``float``
+
+        :param max_keep_alive_requests: Number of requests served on one
+                                        connection before it is closed.
+                                        ``None`` for no limit.
+        :type max_keep_alive_requests: ``None`` or ``int``
+
+        :param backlog: Size of the listen queue
+        :type backlog: ``int``
+
+        :param capture_limit: Bytes of a request body held in memory
+        :type capture_limit: ``int``
+
+        :param journal_size: Requests kept in :attr:`journal`
+        :type journal_size: ``int``
+
+        :param journal_file: File every request is also appended to
+        :type journal_file: ``None`` or ``str``
+        """
+        StubServer.__init__(self, port, address, protocol_version="HTTP/1.1",
+                            keep_alive_timeout=keep_alive_timeout,
+                            max_keep_alive_requests=max_keep_alive_requests,
+                            capture_limit=capture_limit, journal_size=journal_size,
+                            journal_file=journal_file)
+        self.backlog = backlog
+        self._server = None
+        self._connections = {}
+
+    def run(self):
+        raise NotImplementedError("AsyncStubServer is started with 'await server.start()'")
+
+    async def start(self):
+        """Start listening. Returns once the server accepts connections."""
+        self._server = await asyncio.start_server(self._serve, self.address, self.port,
+                                               reuse_address=True, backlog=self.backlog)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Close the listening socket and every open connection, then :meth:`verify`."""
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await asyncio.gather(*self._connections.values(), return_exceptions=True)
+        await self._server.wait_closed()
+        if self._fallback is not None:
+            self._fallback.close()
+            self._fallback = None
+        self.journal.close()
+        self.verify()
+
+    async def _send_file(self, writer, path, offset, count):
+        if count <= 0:
+            return
+        with open(path, 'rb') as f:
+            await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+
+    async def _serve(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        served = 0
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                words = request_line.decode('iso-8859-1').split()
+                if len(words) != 3:
+                    response = PreparedResponse(400, "Bad request", "text/plain", None, b"Bad request syntax")
+                    writer.writelines(response.render("HTTP/1.0"))
+                    break
+                method, path, version = words
+                headers = http.client.HTTPMessage()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('iso-8859-1').partition(':')
+                    headers[name.strip()] = value.strip()
+
+                served += 1
+                connection = headers.get('connection', '').lower()
+                close = (connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive') or
+                         (self.max_keep_alive_requests and served >= self.max_keep_alive_requests))
+                if headers.get('expect', '').lower() == '100-continue' and version == 'HTTP/1.1':
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                if not await self._respond(reader, writer, method, path, version, headers, close):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _respond(self, reader, writer, method, path, version, headers, close):
+        """Answer one request. Returns whether the connection stays open."""
+        exchange = Exchange(self.journal, self._stats, method, path, headers)
+        head_only = method == "HEAD"
+        body = RequestBody(self.capture_limit)
+        try:
+            try:
+                await _read_body(reader, headers, body)
+            except ValueError as e:
+                await self._answer(writer, exchange, version, True, head_only, exchange.bad_body(e, body))
+                return False
+            if path == STATS_PATH:
+                response = stats_response(self._stats, self._index)
+                writer.writelines(response.render(self.protocol_version, close and version == "HTTP/1.1",
+                                                  head_only))
+                await writer.drain()
+                return not close
+            fallback = self._fallback
+            if exchange.claim(self._scopes, None, body, fallback):
+                if fallback.blocking:
+                    exchange.recorded = await asyncio.get_running_loop().run_in_executor(
+                        None, fallback_response, fallback, method, exchange.routed, headers, body)
+                else:
+                    exchange.recorded = fallback_response(fallback, method, exchange.routed, headers, body)
+        finally:
+            body.close()
+        response, file_part, pacing = exchange.response()
+        close = close or response.closes or pacing is not None
+        await self._answer(writer, exchange, version, close, head_only, response, file_part, pacing)
+        return not close
+
+    async def _answer(self, writer, exchange, version, close, head_only, response, file_part=None, pacing=None):
+        buffers = response.render(self.protocol_version, close and version == "HTTP/1.1", head_only)
+        if head_only:
+            file_part = None
+        exchange.record(response.code, sum(len(b) for b in buffers) + (file_part[2] if file_part else 0))
+        if pacing is not None:
+            await _send_paced(writer, pacing.schedule(buffers, file_part))
+        else:
+            writer.writelines(buffers)
+            await writer.drain()
+            if file_part is not None:
+                await self._send_file(writer, *file_part)
+        exchange.written()
+
+
+async def _read_body(reader, headers, body):
+    """Stream a request body into ``body``, as :func:`stubserver.body.read_body` does for blocking sockets."""
+    sink = decoding(headers, body)
+    try:
+        if is_chunked(headers):
+            while True:
+                size = chunk_size(await reader.readline())
+                if size == 0:
+                    break
+                await _copy(reader, size, sink)
+                await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+        elif 'Content-Length' in headers:
+            await _copy(reader, int(headers['Content-Length']), sink)
+        if sink is not body:
+            sink.finish()
+    except asyncio.IncompleteReadError:
+        raise ValueError("Request body ended early")
+
+
+async def _copy(reader, remaining, body):
+    while remaining:
+        chunk = await reader.readexactly(min(remaining, READ_CHUNK))
+        body.write(chunk)
+        remaining -= len(chunk)
+
+
+async def _send_paced(writer, pieces):
+    for due, data in pieces:
+        wait = due - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        writer.write(data)
+        await writer.drain()
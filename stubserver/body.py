@@ -0,0 +1,200 @@
+"""Request bodies read incrementally, kept in memory up to a limit and spilled to a temporary file beyond it."""
+import hashlib
+import tempfile
+import zlib
+from io import BytesIO
+from stubserver.response import brotli
+
+# Bytes of a request body kept in memory before it is moved to a temporary file
+DEFAULT_CAPTURE_LIMIT = 10 * 1024 * 1024
+
+# Largest read issued against the connection while streaming a body
+READ_CHUNK = 64 * 1024
+
+
+class RequestBody(object):
+    """
+    Body of one request.
+
+    Chunks are appended with :meth:`write`. Once more than ``limit`` bytes
+    have arrived the body is moved to an anonymous temporary file, so memory
+    use stays bounded however large the upload is.
+    """
+
+    def __init__(self, limit=DEFAULT_CAPTURE_LIMIT):
+        self.limit = limit
+        self.size = 0
+        self._buffer = BytesIO()
+        self._kept = False
+
+    @property
+    def spilled(self):
+        return not isinstance(self._buffer, BytesIO)
+
+    def write(self, chunk):
+        if not self.spilled and self.size + len(chunk) > self.limit:
+            spill = tempfile.TemporaryFile()
+            spill.write(self._buffer.getvalue())
+            self._buffer = spill
+        self._buffer.write(chunk)
+        self.size += len(chunk)
+
+    def getvalue(self):
+        """Return the whole body as ``bytes``, reading it back if it was spilled."""
+        if not self.spilled:
+            return self._buffer.getvalue()
+        self._buffer.seek(0)
+        try:
+            return self._buffer.read()
+        finally:
+            self._buffer.seek(0, 2)
+
+    def text(self):
+        return self.getvalue().decode('utf-8', 'replace')
+
+    def digest(self):
+        """Return the hex SHA-256 of the body, hashing a spilled body straight from disk."""
+        if not self.spilled:
+            return hashlib.sha256(self._buffer.getvalue()).hexdigest()
+        sha = hashlib.sha256()
+        self._buffer.seek(0)
+        for chunk in iter(lambda: self._buffer.read(READ_CHUNK), b''):
+            sha.update(chunk)
+        return sha.hexdigest()
+
+    def capture_into(self, data_capture, digest_only=False):
+        """
+        Record the body in an expectation's ``data_capture``.
+
+        ``size`` is always set. With ``digest_only`` only ``sha256`` is added.
+        Otherwise a body held in memory is stored as ``raw`` bytes and as a
+        ``body`` string decoded from UTF-8, and a spilled body is handed over
+        as ``file``, an open temporary file positioned at the start.
+        """
+        data_capture["size"] = self.size
+        if digest_only:
+            data_capture["sha256"] = self.digest()
+        elif self.spilled:
+            self._buffer.seek(0)
+            data_capture["file"] = self._buffer
+            self._kept = True
+        else:
+            data_capture["raw"] = self.getvalue()
+            data_capture["body"] = self.text()
+
+    def close(self):
+        if self.spilled and not self._kept:
+            self._buffer.close()
+
+
+class _Decoder(object):
+    """Decompresses chunks of a request body as they arrive, writing the result to a :class:`RequestBody`."""
+
+    def __init__(self, coding, body):
+        self.body = body
+        self.coding = coding
+        self._started = False
+        if coding == 'br':
+            self._brotli = brotli.Decompressor()
+            self._zlib = None
+        else:
+            # 47 takes gzip or zlib framing
+            self._zlib = zlib.decompressobj(47)
+
+    def write(self, chunk):
+        try:
+            if self._zlib is None:
+                self.body.write(self._brotli.process(chunk))
+                return
+            data = self._inflate(chunk)
+            while True:
+                self.body.write(data)
+                if not self._zlib.unconsumed_tail:
+                    break
+                data = self._zlib.decompress(self._zlib.unconsumed_tail, READ_CHUNK)
+        except Exception as e:
+            raise ValueError("Cannot decompress request body: %s" % e)
+
+    def _inflate(self, chunk):
+        # Output is limited per call so a small upload cannot expand into memory all at once
+        try:
+            data = self._zlib.decompress(chunk, READ_CHUNK)
+        except zlib.error:
+            if self._started or self.coding != 'deflate':
+                raise
+            # Some clients send a bare deflate stream as deflate
+            self._zlib = zlib.decompressobj(-15)
+            data = self._zlib.decompress(chunk, READ_CHUNK)
+        self._started = True
+        return data
+
+    def finish(self):
+        if self._zlib is not None:
+            self.body.write(self._zlib.flush())
+            if not self._zlib.eof:
+                raise ValueError("Compressed request body is truncated")
+        elif not self._brotli.is_finished():
+            raise ValueError("Compressed request body is truncated")
+
+
+def decoding(headers, body):
+    """
+    Return what to write the request body to: ``body`` itself, or a decoder
+    undoing the ``Content-Encoding`` of the request.
+
+    :raises: ValueError: If the content coding is not supported.
+    """
+    coding = headers.get('Content-Encoding', '').strip().lower()
+    if coding in ('', 'identity'):
+        return body
+    if coding in ('gzip', 'x-gzip', 'deflate') or (coding == 'br' and brotli is not None):
+        return _Decoder(coding, body)
+    raise ValueError("Unsupported Content-Encoding: %s" % coding)
+
+
+def is_chunked(headers):
+    return 'chunked' in headers.get('Transfer-Encoding', '').lower()
+
+
+def chunk_size(line):
+    """Parse the size line of a chunk, ignoring extensions."""
+    try:
+        return int(line.split(b';', 1)[0].strip(), 16)
+    except ValueError:
+        raise ValueError("Bad chunk size line: %r" % line[:64])
+
+
+def read_body(rfile, headers, body):
+    """
+    Stream a request body from ``rfile`` into ``body``, decoding
+    ``Transfer-Encoding: chunked`` and decompressing any ``Content-Encoding``
+    as it goes.
+
+    :raises: ValueError: If the body is truncated, badly framed or cannot be
+             decompressed.
+    """
+    sink = decoding(headers, body)
+    if is_chunked(headers):
+        while True:
+            size = chunk_size(rfile.readline(65537))
+            if size == 0:
+                break
+            _copy(rfile, size, sink)
+            rfile.readline(65537)
+        # Skip any trailer fields
+        while rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+            pass
+    elif 'Content-Length' in headers:
+        _copy(rfile, int(headers['Content-Length']), sink)
+    if sink is not body:
+        sink.finish()
+    return body
+
+
+def _copy(rfile, remaining, body):
+    while remaining:
+        chunk = rfile.read(min(remaining, READ_CHUNK))
+        if not chunk:
+            raise ValueError("Request body ended %d bytes early" % remaining)
+        body.write(chunk)
+        remaining -= len(chunk)
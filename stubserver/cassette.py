@@ -0,0 +1,249 @@
+"""
+Record exchanges with a real server and replay them later.
+
+A cassette is an append-only file. After a header line, each exchange is
+stored as one line of JSON describing the request and the response,
+followed by the raw response body and a newline. Next to it, ``<cassette>.idx``
+holds one tab separated line per exchange:
+``method, body sha256, start offset, end offset, path``.
+
+Replay reads only the index and memory-maps the cassette. An exchange is
+decoded on its first hit and its body is sent straight from the mapping,
+so even a large recording is ready at once. Exchanges recorded after the
+index was last written are found by scanning the end of the cassette.
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+import sys
+import threading
+from stubserver.response import PreparedResponse
+if sys.version_info[0] < 3:
+    from httplib import HTTPConnection
+    from urlparse import urlsplit
+else:
+    from http.client import HTTPConnection
+    from urllib.parse import urlsplit
+
+MAGIC = b"stubserver-cassette 1\n"
+
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+# Headers describing the connection or the framing, which the stub sets itself
+HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'te', 'upgrade',
+                         'content-length', 'host', 'date', 'server', 'content-type', 'trailer'])
+
+
+def index_path(cassette):
+    return cassette + ".idx"
+
+
+class CassetteRecorder(object):
+    """Forwards requests to ``upstream`` and appends every exchange to a cassette."""
+
+    # Forwarding blocks, so an event loop calls respond from an executor
+    blocking = True
+
+    def __init__(self, upstream, cassette, timeout=30):
+        """
+        :param upstream: Base URL requests are forwarded to, e.g. ``"http://localhost:9000"``
+        :type upstream: ``str``
+
+        :param cassette: File the exchanges are appended to, created if needed
+        :type cassette: ``str``
+
+        :param timeout: Seconds to wait for the upstream
+        :type timeout: ``float``
+        """
+        parts = urlsplit(upstream)
+        if parts.scheme != 'http':
+            raise ValueError("Only http:// upstreams can be recorded: %r" % (upstream,))
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.base = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.path = cassette
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = open(cassette, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+        self._index = open(index_path(cassette), 'a')
+
+    def respond(self, method, path, headers, body):
+        """
+        Forward a request and record the answer.
+
+        :param body: Body of the request
+        :type body: :class:`stubserver.body.RequestBody`
+
+        :rtype: :class:`stubserver.response.PreparedResponse`
+        """
+        data = body.getvalue()
+        # The body has already been decompressed
+        forwarded = dict((name, value) for name, value in headers.items()
+                         if name.lower() not in HOP_HEADERS and name.lower() != 'content-encoding')
+        if headers.get('Content-Type'):
+            forwarded['Content-Type'] = headers['Content-Type']
+        for attempt in (1, 2):
+            reused = getattr(self._local, 'connection', None) is not None
+            upstream = self._connection()
+            try:
+                upstream.request(method, self.base + path, data or None, forwarded)
+                answer = upstream.getresponse()
+                content = answer.read()
+                break
+            except Exception:
+                self._local.connection = None
+                upstream.close()
+                # The upstream may have closed an idle keep-alive connection
+                if not reused or attempt == 2:
+                    raise
+        if answer.getheader('Connection', '').lower() == 'close':
+            self._local.connection = None
+            upstream.close()
+        exchange = {
+            "method": method,
+            "path": path,
+            "sha256": hashlib.sha256(data).hexdigest() if data else EMPTY_SHA256,
+            "code": answer.status,
+            "reason": answer.reason,
+            "content_type": answer.getheader('Content-Type', 'text/html'),
+            "headers": [[name, value] for name, value in answer.getheaders() if name.lower() not in HOP_HEADERS],
+            "length": len(content),
+        }
+        self._append(exchange, content)
+        return _prepare(exchange, content)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._index.close()
+
+    def _connection(self):
+        upstream = getattr(self._local, 'connection', None)
+        if upstream is None:
+            upstream = self._local.connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return upstream
+
+    def _append(self, exchange, content):
+        line = json.dumps(exchange, sort_keys=True).encode('utf-8') + b"\n"
+        with self._lock:
+            start = self._file.tell()
+            self._file.write(line)
+            self._file.write(content)
+            self._file.write(b"\n")
+            self._file.flush()
+            self._index.write("%s\t%s\t%d\t%d\t%s\n" % (exchange["method"], exchange["sha256"], start,
+                                                      self._file.tell(), exchange["path"]))
+            self._index.flush()
+
+
+class CassetteReplayer(object):
+    """
+    Answers requests with the responses recorded in a cassette.
+
+    Exchanges with the same method, path and body are replayed in the order
+    they were recorded, the last one answering any further requests.
+    """
+    blocking = False
+
+    def __init__(self, cassette):
+        """
+        :param cassette: File written by :class:`CassetteRecorder`
+        :type cassette: ``str``
+        """
+        self.path = cassette
+        self._lock = threading.Lock()
+        self._responses = {}
+        self._served = {}
+        self._file = open(cassette, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("%s is not a cassette" % cassette)
+        self._offsets = {}
+        indexed = self._read_index()
+        if indexed < size:
+            self._scan(max(indexed, len(MAGIC)), size)
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self._offsets.values())
+
+    def respond(self, method, path, headers, body):
+        """
+        :return: The recorded response, or ``None`` when nothing was recorded
+                 for this request
+        :rtype: :class:`stubserver.response.PreparedResponse`
+        """
+        key = (method, path, body.digest() if body.size else EMPTY_SHA256)
+        offsets = self._offsets.get(key)
+        if not offsets:
+            return None
+        with self._lock:
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        offset = offsets[min(served, len(offsets) - 1)]
+        response = self._responses.get(offset)
+        if response is None:
+            response = self._responses[offset] = self._decode(offset)
+        return response
+
+    def close(self):
+        self._responses.clear()
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                # A response body is still referenced; the mapping goes with it
+                pass
+        self._file.close()
+
+    def _read_index(self):
+        """Load the sidecar index, returning the cassette offset it covers up to."""
+        end = len(MAGIC)
+        try:
+            index = io.open(index_path(self.path), encoding='utf-8')
+        except IOError:
+            return 0
+        with index:
+            for line in index:
+                fields = line.rstrip('\n').split('\t', 4)
+                if len(fields) < 5:
+                    # Torn last line; the scan picks the exchange up
+                    break
+                method, sha256, start, stop, path = fields
+                self._offsets.setdefault((method, path, sha256), []).append(int(start))
+                end = max(end, int(stop))
+        return end
+
+    def _scan(self, offset, size):
+        while offset < size:
+            newline = self._map.find(b"\n", offset)
+            if newline < 0:
+                return
+            try:
+                exchange = json.loads(self._map[offset:newline].decode('utf-8'))
+            except ValueError:
+                return
+            stop = newline + 1 + exchange["length"] + 1
+            if stop > size:
+                return
+            key = (exchange["method"], exchange["path"], exchange["sha256"])
+            self._offsets.setdefault(key, []).append(offset)
+            offset = stop
+
+    def _decode(self, offset):
+        newline = self._map.find(b"\n", offset)
+        exchange = json.loads(self._map[offset:newline].decode('utf-8'))
+        content = memoryview(self._map)[newline + 1:newline + 1 + exchange["length"]]
+        return _prepare(exchange, content)
+
+
+def _prepare(exchange, content):
+    return PreparedResponse(exchange["code"], exchange["reason"], exchange["content_type"],
+                            [tuple(header) for header in exchange["headers"]], content)
@@ -0,0 +1,193 @@
+"""Serve one :class:`stubserver.StubServer` from several forked worker processes."""
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from stubserver.stats import ServerStats
+
+# Seconds to wait for every worker to be listening
+START_TIMEOUT = 10
+
+
+def _context():
+    if hasattr(multiprocessing, 'get_context'):
+        # Workers inherit the registered expectations, so they have to be forked
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+class ProcessCluster(object):
+    """
+    Worker processes sharing the listening port of a :class:`stubserver.StubServer`.
+
+    Each worker binds its own socket with ``SO_REUSEPORT`` where the platform
+    has it, so the kernel spreads connections across them. Elsewhere the
+    workers accept from one non-blocking socket opened before they are
+    forked.
+
+    Hit counts live in shared memory and every claim takes a process-shared
+    lock, so an expectation answers exactly as many requests as it would in a
+    single process. Captures, journal records and traffic counters are sent
+    back to the parent over a queue, where :meth:`StubServer.verify` and
+    :meth:`StubServer.stats` see them. Expectations have to be registered
+    before the workers are started.
+    """
+
+    def __init__(self, stub, processes):
+        """
+        :param stub: Server whose expectations the workers answer
+        :type stub: :class:`stubserver.StubServer`
+
+        :param processes: Number of worker processes
+        :type processes: ``int``
+        """
+        self.stub = stub
+        self.processes = processes
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self._workers = []
+
+    def start(self):
+        ctx = _context()
+        stub = self.stub
+        expectations = stub._index.expectations()
+        hits = ctx.RawArray('l', [x.hits for x in expectations] or [0])
+        for slot, expectation in enumerate(expectations):
+            expectation._hits, expectation._slot = hits, slot
+        stub._index.lock = ctx.RLock()
+        self._expectations = dict((x.seq, x) for x in expectations)
+        self._reports = ctx.Queue()
+        self._stopping = ctx.Event()
+        self._ready = ctx.Semaphore(0)
+        self._listener = self._listen(stub.address, stub.port, not self.reuse_port)
+        stub.port = self._listener.getsockname()[1]
+        for i in range(self.processes):
+            worker = ctx.Process(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._merger = threading.Thread(target=self._merge)
+        self._merger.daemon = True
+        self._merger.start()
+        for worker in self._workers:
+            if not self._ready.acquire(True, START_TIMEOUT):
+                self.stop()
+                raise Exception("Worker processes did not start listening on port %d" % stub.port)
+
+    def stop(self):
+        """Stop the workers and wait until everything they reported has been merged."""
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join()
+        self._reports.put(None)
+        self._merger.join()
+        self._reports.close()
+        self._listener.close()
+        del self._workers[:]
+
+    def _listen(self, address, port, activate):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((address, port))
+        if activate:
+            sock.listen(1024)
+            # Several workers wait on this socket; only one gets each connection
+            sock.setblocking(False)
+        return sock
+
+    def _work(self):
+        """Body of a worker process."""
+        stub = self.stub
+        reports = self._reports
+        stub._index.on_satisfy = lambda x: reports.put(('capture', x.seq, _portable(x.data_capture)))
+        stub._stats = _ReportingStats(reports)
+        stub.journal = _ReportingJournal(reports)
+        if self.reuse_port:
+            listener = self._listen(stub.address, stub.port, True)
+            self._listener.close()
+        else:
+            listener = self._listener
+        server = stub._create_server((stub.address, stub.port), stub._create_handler(), listener)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self._ready.release()
+        self._stopping.wait()
+        server.shutdown()
+        server.server_close()
+        reports.close()
+        reports.join_thread()
+
+    def _merge(self):
+        """Apply what the workers report, in the parent, until :meth:`stop`."""
+        stub = self.stub
+        while True:
+            report = self._reports.get()
+            if report is None:
+                return
+            kind, args = report[0], report[1:]
+            if kind == 'capture':
+                expectation = self._expectations[args[0]]
+                with stub._index.lock:
+                    expectation.data_capture.update(_restore(args[1]))
+            elif kind == 'stats':
+                stub._stats.record(*args[0])
+            elif kind == 'write':
+                stub._stats.record_write(args[0])
+            else:
+                stub.journal.record(*args[0], expectation=self._expectations.get(args[1]))
+
+
+class _ReportingStats(ServerStats):
+    """Counters of one worker, which it serves on ``/__stats``, copied to the parent."""
+
+    def __init__(self, reports):
+        ServerStats.__init__(self)
+        self._reports = reports
+
+    def record(self, *args):
+        ServerStats.record(self, *args)
+        self._reports.put(('stats', args))
+
+    def record_write(self, write_time):
+        ServerStats.record_write(self, write_time)
+        self._reports.put(('write', write_time))
+
+
+class _ReportingJournal(object):
+    """Stands in for the journal in a worker, handing every record to the parent."""
+
+    def __init__(self, reports):
+        self._reports = reports
+
+    def record(self, method, path, status, bytes_in=0, bytes_out=0, expectation=None):
+        self._reports.put(('journal', (method, path, status, bytes_in, bytes_out),
+                           expectation.seq if expectation is not None else None))
+
+    def close(self):
+        pass
+
+
+def _portable(data_capture):
+    """Copy a capture so it can be pickled, moving a spilled body into a named file."""
+    capture = dict(data_capture)
+    spilled = capture.pop("file", None)
+    if spilled is not None:
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            spilled.seek(0)
+            shutil.copyfileobj(spilled, f)
+            capture["file_path"] = f.name
+        spilled.seek(0)
+    return capture
+
+
+def _restore(capture):
+    """Undo :func:`_portable`, reopening a spilled body and removing its name."""
+    path = capture.pop("file_path", None)
+    if path is not None:
+        capture["file"] = open(path, 'rb')
+        os.remove(path)
+    return capture
@@ -1,5 +1,12 @@
+import copy
+import posixpath
+import socket
 import threading
+import time
 import sys
+from stubserver.ftpstorage import MemoryStorage, normalize
+from stubserver.journal import DEFAULT_JOURNAL_SIZE, Journal
+from stubserver.response import send_file, to_bytes
 
 if sys.version_info[0] < 3:
     import SocketServer
@@ -7,105 +14,479 @@ else:
     import socketserver as SocketServer
 
 
+# Longest command line accepted on the control connection
+MAX_LINE = 8192
+
+# Verbs of RFC 959 and its extensions, answered with 502 rather than 500 when not supported
+KNOWN_VERBS = frozenset(['ABOR', 'ACCT', 'ALLO', 'APPE', 'CDUP', 'DELE', 'EPRT', 'EPSV', 'FEAT', 'HELP', 'LIST',
+                         'MDTM', 'MKD', 'MLSD', 'MLST', 'MODE', 'NLST', 'NOOP', 'OPTS', 'PASS', 'PASV', 'PORT',
+                         'PWD', 'QUIT', 'REIN', 'REST', 'RETR', 'RMD', 'RNFR', 'RNTO', 'SITE', 'SIZE', 'SMNT',
+                         'STAT', 'STOR', 'STOU', 'STRU', 'SYST', 'TYPE', 'USER', 'XCUP', 'XMKD', 'XPWD', 'XRMD'])
+
+# Seconds a passive listener waits for the client to open the data connection
+DATA_TIMEOUT = 30
+
+# Bytes read or written at a time on a data connection
+DATA_CHUNK = 64 * 1024
+
+# Verbs refused with 501 when sent without an argument
+NEEDS_ARGUMENT = frozenset(['APPE', 'CWD', 'MDTM', 'MKD', 'REST', 'RETR', 'SIZE', 'STOR', 'TYPE'])
+
+# Transfers that can be interrupted by FTPStubServer.interrupt_transfers
+TRANSFER_VERBS = ('RETR', 'STOR', 'APPE')
+
+FEATURES = (b'211-Features:\r\n EPSV\r\n MDTM\r\n MLSD type*;size*;modify*;\r\n PASV\r\n REST STREAM\r\n'
+            b' SIZE\r\n211 End\r\n')
+
+
+class PassivePorts(object):
+    """
+    Listening sockets for passive mode data connections.
+
+    A listener is bound the first time it is needed and goes back to the
+    pool after its transfer, so a session making thousands of transfers
+    binds a handful of ports rather than one per transfer.
+    """
+
+    def __init__(self, hostname, ports=None):
+        """
+        :param hostname: Address the listeners are bound to
+        :type hostname: ``str``
+
+        :param ports: Ports the listeners may use, or ``None`` to let the
+                      system pick free ones
+        :type ports: ``None`` or iterable of ``int``
+        """
+        self.hostname = hostname
+        self._ports = list(ports) if ports is not None else None
+        self._free = []
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def acquire(self):
+        """
+        Lend out a listener.
+
+        :raises: socket.error: If every port of the range is in use.
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            candidates = [0] if self._ports is None else self._ports
+            used = set(listener.getsockname()[1] for listener in self._listeners)
+            error = None
+            for port in candidates:
+                if port and port in used:
+                    continue
+                try:
+                    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    listener.bind((self.hostname, port))
+                    listener.listen(8)
+                except socket.error as e:
+                    listener.close()
+                    error = e
+                    continue
+                listener.settimeout(DATA_TIMEOUT)
+                self._listeners.append(listener)
+                return listener
+            raise error or socket.error("No passive port left in %s" % self._ports)
+
+    def release(self, listener):
+        _drain(listener)
+        with self._lock:
+            if listener in self._listeners:
+                self._free.append(listener)
+
+    def close(self):
+        with self._lock:
+            for listener in self._listeners:
+                listener.close()
+            del self._listeners[:]
+            del self._free[:]
+
+
+def _drain(listener):
+    """Close connections still queued on ``listener``, such as the one a client opened for a refused transfer."""
+    timeout = listener.gettimeout()
+    listener.setblocking(False)
+    try:
+        while True:
+            try:
+                connection, address = listener.accept()
+            except socket.error:
+                break
+            connection.close()
+    finally:
+        listener.settimeout(timeout)
+
+
+class Interruptions(object):
+    """Data connections to cut short, shared by every session of a server."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def add(self, after_bytes, times, verbs):
+        with self._lock:
+            self._pending.append([after_bytes, times, frozenset(verbs)])
+
+    def take(self, verb):
+        """Return the bytes after which this ``verb`` transfer is cut, or ``None`` to let it run."""
+        with self._lock:
+            for pending in self._pending:
+                if verb in pending[2]:
+                    pending[1] -= 1
+                    if not pending[1]:
+                        self._pending.remove(pending)
+                    return pending[0]
+        return None
+
+    def clear(self):
+        with self._lock:
+            del self._pending[:]
+
+
+def _timestamp(seconds):
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime(seconds))
+
+
 class FTPServer(SocketServer.BaseRequestHandler):
-    def __init__(self, hostname, port, interactions, files):
+    # Verb to method, filled in from the _VERB methods below the class
+    commands = {}
+
+    def __init__(self, hostname, port, journal, storage, passive=None, interruptions=None):
         self.hostname = hostname
         self.port = port
-        self.interactions = interactions
-        self.files = files
+        self.journal = journal
+        self.storage = storage
+        self.passive = passive if passive is not None else PassivePorts(hostname)
+        self.interruptions = interruptions if interruptions is not None else Interruptions()
+        self.listener = None
+        self.command = None
+        self.binary = False
         self.cwd = '/'
+        # Offset given by REST for the next transfer
+        self.rest = 0
 
     def __call__(self, request, client_address, server):
-        self.request = request
-        self.client_address = client_address
-        self.server = server
-        self.setup()
+        # Each session gets its own copy, so concurrent clients keep their
+        # own directory, passive listener and transfer state.
+        session = copy.copy(self)
+        session.request = request
+        session.client_address = client_address
+        session.server = server
+        session.setup()
         try:
-            self.handle()
+            session.handle()
         finally:
-            self.finish()
-        return self
+            session.finish()
+        return session
 
     def handle(self):
+        # Replies are small and often come in pairs around a transfer; don't let Nagle hold the second back
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         # Establish connection
-        self.request.send(b'220 (FtpStubServer 0.1a)\r\n')
+        self.request.sendall(b'220 (FtpStubServer 0.1a)\r\n')
+        # Buffered, so commands split across reads or sent several to a read are framed on line ends
+        rfile = self.request.makefile('rb')
         self.communicating = True
-        while self.communicating:
-            cmd = self.request.recv(1024)
-            if len(cmd) == 0:
-                break
-            if cmd:
-                self.interactions.append(cmd)
-                cmd = cmd.decode('utf-8').rstrip()
-                first = cmd.split(' ', 1)[0]
-                getattr(self, '_' + first)(cmd)
-
-    def _USER(self, cmd):
-        self.request.send(b'331 Please specify password.\r\n')
-
-    def _PASS(self, cmd):
-        self.request.send(b'230 You are now logged in.\r\n')
-
-    def _TYPE(self, cmd):
-        self.request.send(b'200 Switching to ascii mode.\r\n')
-
-    def _PASV(self, cmd):
-        self.data_handler = FTPDataServer(self.files)
-        self.port += 1
-        SocketServer.TCPServer.allow_reuse_address = True
-        self.data_server = SocketServer.TCPServer((self.hostname, self.port + 1), self.data_handler)
-        self.request.send(('227 Entering Passive Mode. (127,0,0,1,%s,%s)\r\n' % (
-            int((self.port + 1) / 256), (self.port + 1) % 256)).encode('utf-8'))
+        try:
+            while self.communicating:
+                line = rfile.readline(MAX_LINE + 1)
+                if not line:
+                    break
+                self.status = self.command = None
+                self.bytes_in = self.bytes_out = 0
+                if len(line) > MAX_LINE:
+                    self._send(b'500 Command line too long.\r\n')
+                    # Skip the rest of the line
+                    while line and not line.endswith(b'\n'):
+                        line = rfile.readline(MAX_LINE)
+                    continue
+                verb, _, argument = line.rstrip(b'\r\n').decode('utf-8', 'replace').partition(' ')
+                verb = self.verb = verb.upper()
+                self.command = (verb, argument)
+                self.dispatch(verb, argument)
+                if self.command is not None:
+                    self._record()
+        finally:
+            # A client gone without QUIT must not keep its passive listener out of the pool
+            self._release()
+            rfile.close()
+
+    def dispatch(self, verb, argument):
+        """Run the method answering ``verb``, or refuse it."""
+        command = self.commands.get(verb)
+        if command is not None:
+            if not argument and verb in NEEDS_ARGUMENT:
+                self._send(b'501 Syntax error in parameters or arguments.\r\n')
+                return
+            try:
+                command(self, argument)
+            except Exception:
+                # A failing command must not end the session; answer it unless it already was
+                self.server.handle_error(self.request, self.client_address)
+                if self.command is not None:
+                    self._send(b'451 Requested action aborted: local error in processing.\r\n')
+        elif verb in KNOWN_VERBS:
+            self._send(('502 %s not implemented.\r\n' % verb).encode('utf-8'))
+        else:
+            self._send(b'500 Syntax error, command unrecognized.\r\n')
+
+    def _send(self, reply):
+        """Send a reply, journaling the command before its final reply so a client never sees one unrecorded."""
+        self.status = int(reply.splitlines()[-1][:3])
+        if self.status >= 200 and self.command is not None:
+            self._record()
+        self.request.sendall(reply)
+
+    def _record(self):
+        verb, argument = self.command
+        self.command = None
+        self.journal.record(verb, argument, self.status, self.bytes_in, self.bytes_out)
+
+    def _USER(self, argument):
+        self._send(b'331 Please specify password.\r\n')
+
+    def _PASS(self, argument):
+        self._send(b'230 You are now logged in.\r\n')
+
+    def _TYPE(self, argument):
+        words = argument.split()
+        if not words:
+            return self._send(b'501 Syntax error in parameters or arguments.\r\n')
+        mode = words[0].upper()
+        if mode == 'I':
+            self.binary = True
+            self._send(b'200 Switching to binary mode.\r\n')
+        elif mode == 'A':
+            self.binary = False
+            self._send(b'200 Switching to ascii mode.\r\n')
+        else:
+            self._send(('504 TYPE %s not supported.\r\n' % argument).encode('utf-8'))
+
+    def _PASV(self, argument):
+        listener = self._listen()
+        if listener is not None:
+            address = self.request.getsockname()[0]
+            if address in ('0.0.0.0', '') or ':' in address:
+                address = listener.getsockname()[0]
+            port = listener.getsockname()[1]
+            self._send(('227 Entering Passive Mode (%s,%d,%d).\r\n' % (
+                address.replace('.', ','), port >> 8, port & 0xff)).encode('utf-8'))
+
+    def _EPSV(self, argument):
+        if argument.upper() == 'ALL':
+            self._send(b'200 EPSV ALL ok.\r\n')
+            return
+        listener = self._listen()
+        if listener is not None:
+            self._send(('229 Entering Extended Passive Mode (|||%d|)\r\n' % listener.getsockname()[1]).encode('utf-8'))
+
+    def _listen(self):
+        """Take a passive listener for the next transfer, replying 425 when none is left."""
+        self._release()
+        try:
+            self.listener = self.passive.acquire()
+        except socket.error as e:
+            self._send(('425 Cannot open passive connection: %s\r\n' % e).encode('utf-8'))
+            return None
+        self.data_handler = FTPDataServer(self.storage)
+        return self.listener
+
+    def _release(self):
+        if self.listener is not None:
+            self.passive.release(self.listener)
+            self.listener = None
 
     def child_go(self, action):
+        """Accept the data connection and run ``action`` over it."""
+        listener, self.listener = self.listener, None
+        try:
+            connection, address = listener.accept()
+        finally:
+            self.passive.release(listener)
         self.data_handler.set_action(action)
-        self.data_server.handle_request()
-        self.data_server.server_close()
-
-    def _STOR(self, cmd):
-        filename = cmd.split(' ', 2)[1]
-        self.data_handler.set_filename(filename)
-        self.request.send(b'150 Okay to send data\r\n')
-        self.child_go('STOR')
-        self.request.send(b'226 Got the file\r\n')
-
-    def _LIST(self, cmd):
-        self.request.send(b'150 Accepted data connection\r\n')
-        self.child_go('LIST')
-        self.request.send(b'226 You got the listings now\r\n')
-
-    def _RETR(self, cmd):
-        filename = cmd.split(' ', 2)[1]
-        self.data_handler.set_filename(filename)
-        self.request.send(b'150 Accepted data connection\r\n')
-        self.child_go('RETR')
-        self.request.send(b'226 Enjoy your file\r\n')
-
-    def _CWD(self, cmd):
-        self.cwd = cmd.split(' ', 2)[1]
-        self.request.send(('250 OK. Current directory is "%s"\r\n' % self.cwd).encode('utf-8'))
-
-    def _PWD(self, cmd):
-        self.request.send(('257 "%s" is your current location\r\n' % self.cwd).encode('utf-8'))
-
-    def _MKD(self, cmd):
-        mkd = cmd.split(' ', 2)[1]
-        self.request.send(('257 "%s" folder created\r\n' % mkd).encode('utf-8'))
-
-    def _NLST(self, cmd):
-        self.request.send(b'150 Accepted data connection\r\n')
-        self.child_go('NLST')
-        self.request.send(b'226 You got the listings now\r\n')
-
-    def _QUIT(self, cmd):
+        self.data_handler.binary = self.binary
+        self.data_handler.cut_after = self.interruptions.take(self.verb)
+        try:
+            self.data_handler(connection, address, None)
+        finally:
+            try:
+                connection.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            connection.close()
+        self.bytes_in = self.data_handler.bytes_in
+        self.bytes_out = self.data_handler.bytes_out
+
+    def _transfer(self, action, opening, done):
+        """Run ``action`` over the data connection announced by PASV or EPSV, replying before and after."""
+        if self.listener is None:
+            self._send(b'425 Use PASV or EPSV first.\r\n')
+            return
+        self._send(opening)
+        try:
+            self.child_go(action)
+        except socket.timeout:
+            self.data_handler.discard()
+            self._send(b'425 No data connection was opened.\r\n')
+            return
+        except (IOError, OSError) as e:
+            self.data_handler.discard()
+            self._send(('451 Transfer aborted: %s\r\n' % e).encode('utf-8'))
+            return
+        if self.data_handler.cut:
+            self._send(b'426 Connection closed; transfer aborted.\r\n')
+            return
+        self._send(done)
+
+    def _path(self, argument):
+        return normalize(argument, self.cwd)
+
+    def _refuse(self, error):
+        self._send(('550 %s.\r\n' % (error.strerror or error)).encode('utf-8'))
+
+    def _size_of(self, path):
+        return self.storage.size(path) if self.storage.isfile(path) else 0
+
+    def _STOR(self, filename):
+        offset, self.rest = self.rest, 0
+        self._upload(self._path(filename), offset or None)
+
+    def _APPE(self, filename):
+        self.rest = 0
+        path = self._path(filename)
+        self._upload(path, self._size_of(path))
+
+    def _upload(self, path, offset):
+        if offset and offset > self._size_of(path):
+            return self._send(b'554 Restart offset is past the end of the file.\r\n')
+        if self.listener is not None:
+            try:
+                self.data_handler.set_file(self.storage.open_write(path, offset), offset is None)
+            except (IOError, OSError) as e:
+                return self._refuse(e)
+        self._transfer('STOR', b'150 Okay to send data\r\n', b'226 Got the file\r\n')
+
+    def _RETR(self, filename):
+        offset, self.rest = self.rest, 0
+        path = self._path(filename)
+        if not self.storage.isfile(path):
+            return self._send(b'550 No such file.\r\n')
+        if offset > self.storage.size(path):
+            return self._send(b'554 Restart offset is past the end of the file.\r\n')
+        if self.listener is not None:
+            self.data_handler.set_path(path, offset)
+        self._transfer('RETR', b'150 Accepted data connection\r\n', b'226 Enjoy your file\r\n')
+
+    def _REST(self, argument):
+        if not argument.isdigit():
+            return self._send(b'501 REST needs a byte offset.\r\n')
+        self.rest = int(argument)
+        self._send(('350 Restarting at %d. Send STORE or RETRIEVE.\r\n' % self.rest).encode('utf-8'))
+
+    def _SIZE(self, filename):
+        path = self._path(filename)
+        if not self.storage.isfile(path):
+            return self._send(b'550 No such file.\r\n')
+        self._send(('213 %d\r\n' % self.storage.size(path)).encode('utf-8'))
+
+    def _MDTM(self, filename):
+        path = self._path(filename)
+        if not self.storage.isfile(path):
+            return self._send(b'550 No such file.\r\n')
+        self._send(('213 %s\r\n' % _timestamp(self.storage.mtime(path))).encode('utf-8'))
+
+    def _FEAT(self, argument):
+        self._send(FEATURES)
+
+    def _MLSD(self, argument):
+        path = self._path(argument)
+        if not self.storage.isdir(path):
+            return self._send(b'550 No such directory.\r\n')
+        lines = []
+        try:
+            for name in self.storage.listdir(path):
+                entry = posixpath.join(path, name)
+                if self.storage.isdir(entry):
+                    lines.append('type=dir; %s\r\n' % name)
+                else:
+                    lines.append('type=file;size=%d;modify=%s; %s\r\n' % (
+                        self.storage.size(entry), _timestamp(self.storage.mtime(entry)), name))
+        except (IOError, OSError) as e:
+            return self._refuse(e)
+        if self.listener is not None:
+            self.data_handler.set_listing(lines)
+        self._transfer('MLSD', b'150 Accepted data connection\r\n', b'226 You got the listings now\r\n')
+
+    def _LIST(self, argument):
+        self._listing('LIST', argument)
+
+    def _NLST(self, argument):
+        self._listing('NLST', argument)
+
+    def _listing(self, action, argument):
+        # Options such as -la are ignored
+        names = [word for word in argument.split(' ') if word and not word.startswith('-')]
+        path = self._path(' '.join(names))
+        if self.storage.isdir(path):
+            try:
+                entries = self.storage.listdir(path)
+            except (IOError, OSError) as e:
+                return self._refuse(e)
+        elif self.storage.isfile(path):
+            entries = [posixpath.basename(path)]
+        else:
+            return self._send(b'550 No such file or directory.\r\n')
+        if self.listener is not None:
+            self.data_handler.set_listing(entries)
+        self._transfer(action, b'150 Accepted data connection\r\n', b'226 You got the listings now\r\n')
+
+    def _CWD(self, directory):
+        path = self._path(directory)
+        if not self.storage.isdir(path):
+            return self._send(b'550 No such directory.\r\n')
+        self.cwd = path
+        self._send(('250 OK. Current directory is "%s"\r\n' % self.cwd).encode('utf-8'))
+
+    def _CDUP(self, argument):
+        self._CWD('..')
+
+    def _PWD(self, argument):
+        self._send(('257 "%s" is your current location\r\n' % self.cwd).encode('utf-8'))
+
+    def _MKD(self, directory):
+        path = self._path(directory)
+        try:
+            self.storage.mkdir(path)
+        except (IOError, OSError) as e:
+            return self._refuse(e)
+        self._send(('257 "%s" folder created\r\n' % path).encode('utf-8'))
+
+    def _QUIT(self, argument):
         self.communicating = False
-        self.request.send(b'221-Goodbye.\r\n221 Have fun.')
+        self._release()
+        self._send(b'221-Goodbye.\r\n221 Have fun.\r\n')
+
+
+FTPServer.commands = dict((name[1:], method) for name, method in vars(FTPServer).items()
+                          if name.startswith('_') and name[1:].isalpha() and name[1:].isupper())
 
 
 class FTPDataServer(SocketServer.StreamRequestHandler):
-    def __init__(self, files):
-        self.files = files
-        self.command = 'LIST'
+    """Moves the content of one transfer over a data connection, a chunk at a time."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.binary = False
+        self.bytes_in = self.bytes_out = 0
+        # Bytes after which the connection is dropped, and whether it was
+        self.cut_after = None
+        self.cut = False
+        self.file = None
 
     def __call__(self, request, client_address, server):
         self.request = request
@@ -121,49 +502,186 @@ class FTPDataServer(SocketServer.StreamRequestHandler):
     def set_action(self, action):
         self.action = action
 
+    def set_file(self, f, whole=True):
+        """Upload into ``f``, an open storage file closed once the upload ends."""
+        self.file = f
+        self.whole = whole
+
+    def discard(self):
+        """Drop the file of an upload that never started."""
+        f, self.file = self.file, None
+        if f is not None:
+            f.discard()
+
+    def set_path(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+
+    def set_listing(self, names):
+        self.names = names
+
     def handle(self):
         getattr(self, '_' + self.action)()
 
-    def set_filename(self, filename):
-        self.filename = filename.encode('utf-8')
-
     def _STOR(self):
-        self.files[self.filename] = self.rfile.read().strip()
+        f, self.file = self.file, None
+        # ASCII uploads of whole files lose leading and trailing whitespace, as they always have; binary ones,
+        # resumed and appended uploads are stored as sent
+        sink = f if self.binary or not self.whole else _Stripping(f)
+        # read1 returns whatever has arrived rather than waiting for a whole chunk
+        read = getattr(self.rfile, 'read1', self.rfile.read)
+        try:
+            for chunk in iter(lambda: read(DATA_CHUNK), b''):
+                if self.cut_after is not None and self.bytes_in + len(chunk) >= self.cut_after:
+                    chunk = chunk[:self.cut_after - self.bytes_in]
+                    self.cut = True
+                self.bytes_in += len(chunk)
+                sink.write(chunk)
+                if self.cut:
+                    break
+        finally:
+            if sink is not f:
+                sink.flush()
+            f.close()
 
     def _LIST(self):
-        data = b'\n'.join([name for name in self.files.keys()])
-        self.wfile.write(data)
+        self._write('\n'.join(self.names).encode('utf-8'))
 
     def _NLST(self):
-        data = b'\015\012'.join([name for name in self.files.keys()])
-        self.wfile.write(data)
+        self._write('\r\n'.join(self.names).encode('utf-8'))
+
+    def _MLSD(self):
+        self._write(''.join(self.names).encode('utf-8'))
 
     def _RETR(self):
-        self.wfile.write(self.files[self.filename])
+        count = self.storage.size(self.path) - self.offset
+        if self.cut_after is not None and self.cut_after < count:
+            count = self.cut_after
+            self.cut = True
+        local = self.storage.local_path(self.path)
+        if local is not None:
+            self.wfile.flush()
+            send_file(self.connection, local, self.offset, count)
+            self.bytes_out += count
+            return
+        f = self.storage.open_read(self.path, self.offset)
+        try:
+            while count:
+                chunk = f.read(min(count, DATA_CHUNK))
+                if not chunk:
+                    break
+                self._write(chunk)
+                count -= len(chunk)
+        finally:
+            f.close()
+
+    def _write(self, data):
+        self.bytes_out += len(data)
+        self.wfile.write(data)
+
+
+class _Stripping(object):
+    """Writes to a file without the leading and trailing whitespace of everything written."""
+
+    def __init__(self, f):
+        self._f = f
+        self._started = False
+        self._pending = b''
+
+    def write(self, chunk):
+        if not self._started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                return
+            self._started = True
+        stripped = chunk.rstrip()
+        if stripped:
+            self._f.write(self._pending + stripped)
+            self._pending = b''
+        # Whitespace at the end is only written once more content follows it
+        self._pending += chunk[len(stripped):]
+
+    def flush(self):
+        self._pending = b''
 
 
 class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    pass
+    daemon_threads = True
 
 
 class FTPStubServer(object):
-    def __init__(self, port, hostname='localhost'):
+    def __init__(self, port, hostname='localhost', journal_size=DEFAULT_JOURNAL_SIZE, journal_file=None,
+                 passive_ports=None, storage=None):
+        """
+        :param port: Port to listen on, 0 picks a free one
+        :type port: ``int``
+
+        :param hostname: Address to listen on
+        :type hostname: ``str``
+
+        :param journal_size: Commands kept in :attr:`journal`
+        :type journal_size: ``int``
+
+        :param journal_file: File every command is also appended to, as a
+                             line of JSON
+        :type journal_file: ``None`` or ``str``
+
+        :param passive_ports: Ports passive mode data connections may use,
+                              e.g. ``range(60000, 60010)``. By default the
+                              system picks free ones. Each port serves one
+                              transfer at a time and is reused afterwards.
+        :type passive_ports: ``None`` or iterable of ``int``
+
+        :param storage: Where files are kept, see :mod:`stubserver.ftpstorage`.
+                        In memory by default; a
+                        :class:`stubserver.ftpstorage.DirectoryStorage` keeps
+                        large files on disk.
+        :type storage: ``None`` or storage
+        """
         self.hostname = hostname
         self.port = port
-        self._interactions = []
-        self._files = {}
+        self.journal = Journal(journal_size, journal_file)
+        self.passive_ports = passive_ports
+        self.storage = storage if storage is not None else MemoryStorage()
+        self.interruptions = Interruptions()
+
+    def interrupt_transfers(self, after_bytes, times=1, verbs=TRANSFER_VERBS):
+        """
+        Drop the data connection of the next transfers once ``after_bytes``
+        have been sent or received, replying 426, so a client's resume logic
+        can be exercised. Bytes of an upload that arrived before the cut are
+        kept, as a real server would.
+
+        :param after_bytes: Bytes moved before the connection is dropped
+        :type after_bytes: ``int``
+
+        :param times: Number of transfers to interrupt
+        :type times: ``int``
+
+        :param verbs: Transfers to interrupt, from ``RETR``, ``STOR`` and ``APPE``
+        :type verbs: iterable of ``str``
+        """
+        self.interruptions.add(after_bytes, times, [verb.upper() for verb in verbs])
 
     def files(self, name):
-        name = name.encode('utf-8')
-        if name in self._files:
-            return self._files[name].decode('utf-8')
-        return None
+        """Return the content of file ``name``, a path from the root, decoded as UTF-8, or ``None``."""
+        path = normalize(name)
+        if not self.storage.isfile(path):
+            return None
+        return self.storage.read(path).decode('utf-8')
 
     def add_file(self, name, content):
-        self._files[name.encode('utf-8')] = content.encode('utf-8')
+        """Store ``content`` as file ``name``, creating the directories on its path."""
+        path = normalize(name)
+        parent = posixpath.dirname(path)
+        if not self.storage.isdir(parent):
+            self.storage.mkdir(parent)
+        self.storage.write(path, to_bytes(content))
 
     def run(self, timeout=2):
-        self.handler = FTPServer(self.hostname, self.port, self._interactions, self._files)
+        self.passive = PassivePorts(self.hostname, self.passive_ports)
+        self.handler = FTPServer(self.hostname, self.port, self.journal, self.storage, self.passive,
+                                 self.interruptions)
         self.server = ThreadedTCPServer((self.hostname, self.port), self.handler)
 
         # Retrieving actual port when using a random one.
@@ -178,7 +696,9 @@ class FTPStubServer(object):
 
     def stop(self):
         self.server.shutdown()
-        while self._interactions:
-            self._interactions.pop()
-        while self._files:
-            self._files.popitem()
+        self.server.server_close()
+        self.passive.close()
+        self.journal.close()
+        self.journal.clear()
+        self.storage.close()
+        self.interruptions.clear()
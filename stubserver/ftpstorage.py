@@ -0,0 +1,327 @@
+"""
+Where :class:`stubserver.FTPStubServer` keeps the files clients upload.
+
+Paths are absolute and ``/`` separated, as the FTP client sees them.
+Storages are shared by every session and lock their own state; file
+contents are read and written in chunks outside the lock, so one large
+transfer never holds up the others.
+"""
+import errno
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+# Renames over an existing file on every platform where it exists
+_replace = getattr(os, 'replace', os.rename)
+
+
+def normalize(path, cwd='/'):
+    """Resolve ``path`` against ``cwd``; ``..`` never leads above the root."""
+    path = posixpath.normpath(posixpath.join(cwd, path))
+    return '/' + path.lstrip('/')
+
+
+def _missing(path):
+    return IOError(errno.ENOENT, "No such file or directory", path)
+
+
+def _check_offset(path, offset, size):
+    if offset > size:
+        raise IOError(errno.EINVAL, "Offset %d is past the end of the file" % offset, path)
+
+
+class MemoryStorage(object):
+    """Files held in memory, the default."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+        self._mtimes = {}
+        self._dirs = set(['/'])
+
+    def isdir(self, path):
+        with self._lock:
+            return path in self._dirs
+
+    def isfile(self, path):
+        with self._lock:
+            return path in self._files
+
+    def mkdir(self, path):
+        """Create ``path`` and any missing parents.
+
+        :raises: IOError: If it already exists, or a parent is a file.
+        """
+        with self._lock:
+            if path in self._dirs or path in self._files:
+                raise IOError(errno.EEXIST, "File exists", path)
+            parent = path
+            while parent not in self._dirs:
+                if parent in self._files:
+                    raise IOError(errno.ENOTDIR, "Not a directory", parent)
+                self._dirs.add(parent)
+                parent = posixpath.dirname(parent)
+
+    def listdir(self, path):
+        """Return the names in directory ``path``, sorted."""
+        with self._lock:
+            if path not in self._dirs:
+                raise _missing(path)
+            names = set()
+            for entry in list(self._files) + list(self._dirs):
+                if entry != '/' and posixpath.dirname(entry) == path:
+                    names.add(posixpath.basename(entry))
+            return sorted(names)
+
+    def size(self, path):
+        with self._lock:
+            if path not in self._files:
+                raise _missing(path)
+            return len(self._files[path])
+
+    def mtime(self, path):
+        with self._lock:
+            if path not in self._mtimes:
+                raise _missing(path)
+            return self._mtimes[path]
+
+    def read(self, path):
+        with self._lock:
+            if path not in self._files:
+                raise _missing(path)
+            return self._files[path]
+
+    def write(self, path, content):
+        with self._lock:
+            self._check_parent(path)
+            self._files[path] = content
+            self._mtimes[path] = time.time()
+
+    def open_read(self, path, offset=0):
+        return BytesIO(self.read(path)[offset:])
+
+    def open_write(self, path, offset=None):
+        """
+        Return a file object whose content replaces ``path`` when closed.
+
+        :param offset: Keep this many bytes of the existing file and write on
+                       from there, as a resumed upload does
+        :type offset: ``None`` or ``int``
+        """
+        with self._lock:
+            self._check_parent(path)
+            kept = b''
+            if offset is not None:
+                kept = self._files.get(path, b'')
+                _check_offset(path, offset, len(kept))
+                kept = kept[:offset]
+        return _MemoryWriter(self, path, kept)
+
+    def local_path(self, path):
+        """Return the file on disk holding ``path``, ``None`` when there is none."""
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._mtimes.clear()
+            self._dirs = set(['/'])
+
+    def close(self):
+        self.clear()
+
+    def _check_parent(self, path):
+        if posixpath.dirname(path) not in self._dirs:
+            raise _missing(posixpath.dirname(path))
+        if path in self._dirs:
+            raise IOError(errno.EISDIR, "Is a directory", path)
+
+
+class _MemoryWriter(BytesIO):
+    def __init__(self, storage, path, kept=b''):
+        BytesIO.__init__(self, kept)
+        self.seek(0, 2)
+        self._storage = storage
+        self._path = path
+
+    def close(self):
+        if not self.closed:
+            self._storage.write(self._path, self.getvalue())
+        BytesIO.close(self)
+
+    def discard(self):
+        """Close without storing anything."""
+        BytesIO.close(self)
+
+
+class DirectoryStorage(object):
+    """
+    Files kept in a directory, a new temporary one unless ``root`` is given.
+
+    Uploads are written to disk as they arrive and downloads are sent with
+    ``sendfile`` (or ``mmap`` where there is none), so memory use does not
+    grow with the size of the files.
+    """
+
+    def __init__(self, root=None):
+        """
+        :param root: Directory to keep the files in. Files already there
+                     are served and nothing in it is ever deleted. A
+                     temporary directory, removed by :meth:`close`, is made
+                     when not given.
+        :type root: ``None`` or ``str``
+        """
+        self._temporary = root is None
+        self.root = tempfile.mkdtemp(prefix='ftpstub-') if root is None else root
+        self._lock = threading.Lock()
+
+    def _real(self, path):
+        return os.path.join(self.root, *[part for part in normalize(path).split('/') if part])
+
+    def isdir(self, path):
+        return os.path.isdir(self._real(path))
+
+    def isfile(self, path):
+        return os.path.isfile(self._real(path))
+
+    def mkdir(self, path):
+        with self._lock:
+            real = self._real(path)
+            if os.path.exists(real):
+                raise IOError(errno.EEXIST, "File exists", path)
+            os.makedirs(real)
+
+    def listdir(self, path):
+        try:
+            return sorted(name for name in os.listdir(self._real(path)) if not name.startswith('.ftpstub-'))
+        except OSError:
+            raise _missing(path)
+
+    def size(self, path):
+        real = self._real(path)
+        if not os.path.isfile(real):
+            raise _missing(path)
+        return os.path.getsize(real)
+
+    def mtime(self, path):
+        real = self._real(path)
+        if not os.path.isfile(real):
+            raise _missing(path)
+        return os.path.getmtime(real)
+
+    def read(self, path):
+        with self.open_read(path) as f:
+            return f.read()
+
+    def write(self, path, content):
+        with self.open_write(path) as f:
+            f.write(content)
+
+    def open_read(self, path, offset=0):
+        real = self._real(path)
+        if not os.path.isfile(real):
+            raise _missing(path)
+        f = open(real, 'rb')
+        f.seek(offset)
+        return f
+
+    def open_write(self, path, offset=None):
+        """
+        Return a file object whose content replaces ``path`` when closed,
+        never showing a partial file. With an ``offset`` the existing file is
+        cut to that length and written on in place, but only once the upload
+        writes or closes, so one that never starts leaves the file whole.
+        """
+        real = self._real(path)
+        if not os.path.isdir(os.path.dirname(real)):
+            raise _missing(posixpath.dirname(path))
+        if os.path.isdir(real):
+            raise IOError(errno.EISDIR, "Is a directory", path)
+        if offset is not None:
+            _check_offset(path, offset, os.path.getsize(real) if os.path.isfile(real) else 0)
+            return _ResumingWriter(real, offset)
+        handle, partial = tempfile.mkstemp(prefix='.ftpstub-', dir=os.path.dirname(real))
+        return _RenamingWriter(os.fdopen(handle, 'wb'), partial, real)
+
+    def local_path(self, path):
+        real = self._real(path)
+        return real if os.path.isfile(real) else None
+
+    def clear(self):
+        """Remove every file from a temporary root; a root given by the caller is never emptied."""
+        if not self._temporary:
+            return
+        with self._lock:
+            for name in os.listdir(self.root):
+                real = os.path.join(self.root, name)
+                if os.path.isdir(real):
+                    shutil.rmtree(real, ignore_errors=True)
+                else:
+                    os.remove(real)
+
+    def close(self):
+        """Remove a temporary root along with its files; a root given by the caller is left as it is."""
+        if self._temporary:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+class _RenamingWriter(object):
+    def __init__(self, f, partial, real):
+        self._f = f
+        self._partial = partial
+        self._real = real
+        self.write = f.write
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+            _replace(self._partial, self._real)
+
+    def discard(self):
+        """Close and remove the partial file, leaving ``path`` as it was."""
+        if not self._f.closed:
+            self._f.close()
+            os.remove(self._partial)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _ResumingWriter(object):
+    def __init__(self, real, offset):
+        self._real = real
+        self._offset = offset
+        self._f = None
+
+    def _open(self):
+        self._f = open(self._real, 'r+b' if os.path.isfile(self._real) else 'wb')
+        self._f.truncate(self._offset)
+        self._f.seek(self._offset)
+
+    def write(self, data):
+        if self._f is None:
+            self._open()
+        self._f.write(data)
+
+    def close(self):
+        if self._f is None:
+            self._open()
+        self._f.close()
+
+    def discard(self):
+        """Close, leaving the file cut only if something was written."""
+        if self._f is not None:
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,169 @@
+"""A fixed-size record of the requests a stub server received."""
+import collections
+import heapq
+import json
+import re
+import threading
+import time
+
+# Records kept in memory by default; older ones are overwritten
+DEFAULT_JOURNAL_SIZE = 10000
+
+
+class Record(collections.namedtuple('Record', 'seq timestamp method path status bytes_in bytes_out expectation')):
+    """
+    One journal entry. ``method`` is the HTTP method or FTP command, ``path``
+    the request path or command argument and ``expectation`` the URL pattern
+    of the expectation that answered, or ``None``.
+    """
+    __slots__ = ()
+
+
+class Journal(object):
+    """
+    Ring buffer of the last ``capacity`` requests.
+
+    Records are numbered in arrival order. :meth:`checkpoint` returns the
+    number the next record will get, so passing it to :meth:`records` as
+    ``since`` lists everything that arrived afterwards. Records are also
+    indexed by path and by expectation, so queries only look at the records
+    they return. With ``stream`` every record is also appended to a file as
+    one JSON object per line, keeping the full history on disk while memory
+    stays bounded.
+    """
+
+    def __init__(self, capacity=DEFAULT_JOURNAL_SIZE, stream=None):
+        """
+        :param capacity: Records kept in memory
+        :type capacity: ``int``
+
+        :param stream: File name, or open text file, every record is
+                       appended to as a line of JSON
+        :type stream: ``None``, ``str`` or file
+        """
+        if capacity < 1:
+            raise ValueError("Journal capacity must be at least 1")
+        self.capacity = capacity
+        self.stream = stream
+        self._file = None
+        self._lock = threading.Lock()
+        self._next = 0
+        self._reset()
+
+    def clear(self):
+        """Forget every record held in memory. Numbering carries on."""
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self._ring = [None] * self.capacity
+        self._first = self._next
+        self._by_path = {}
+        self._by_expectation = {}
+
+    @property
+    def dropped(self):
+        """Number of records overwritten or cleared so far."""
+        return self._first
+
+    def __len__(self):
+        return self._next - self._first
+
+    def checkpoint(self):
+        """
+        :return: Sequence number of the next record, for :meth:`records`
+        :rtype: ``int``
+        """
+        return self._next
+
+    def record(self, method, path, status, bytes_in=0, bytes_out=0, expectation=None):
+        """
+        Add a record, overwriting the oldest one when the journal is full.
+
+        :param expectation: Expectation that answered the request
+        :type expectation: ``None`` or :class:`stubserver.webserver.Expectation`
+
+        :rtype: :class:`Record`
+        """
+        pattern = expectation.url if expectation is not None else None
+        with self._lock:
+            entry = Record(self._next, time.time(), method, path, status, bytes_in, bytes_out, pattern)
+            slot = self._next % self.capacity
+            if self._next - self._first == self.capacity:
+                self._evict(self._ring[slot])
+                self._first += 1
+            self._ring[slot] = entry
+            self._next += 1
+            self._by_path.setdefault(path, collections.deque()).append(entry.seq)
+            if pattern is not None:
+                self._by_expectation.setdefault(pattern, collections.deque()).append(entry.seq)
+            if self.stream is not None:
+                self._write(entry)
+        return entry
+
+    def records(self, url=None, method=None, status=None, expectation=None, since=None):
+        """
+        Records held in memory, oldest first, that meet every given condition.
+
+        :param url: Regex searched for in the path
+        :type url: ``str``
+
+        :param method: HTTP method or FTP command
+        :type method: ``str``
+
+        :param status: Response code
+        :type status: ``int``
+
+        :param expectation: Expectation, or its URL pattern, that answered
+        :type expectation: ``str`` or :class:`stubserver.webserver.Expectation`
+
+        :param since: Value of :meth:`checkpoint` to start from
+        :type since: ``int``
+
+        :rtype: ``list`` of :class:`Record`
+        """
+        if hasattr(expectation, 'url'):
+            expectation = expectation.url
+        url_re = re.compile(url) if url is not None else None
+        with self._lock:
+            start = max(self._first, since or 0)
+            if expectation is not None:
+                seqs = self._by_expectation.get(expectation, ())
+            elif url_re is not None:
+                seqs = heapq.merge(*[seqs for path, seqs in self._by_path.items() if url_re.search(path)])
+            else:
+                seqs = range(start, self._next)
+            found = []
+            for seq in seqs:
+                if seq < start:
+                    continue
+                entry = self._ring[seq % self.capacity]
+                if url_re is not None and not url_re.search(entry.path):
+                    continue
+                if method is not None and entry.method != method:
+                    continue
+                if status is not None and entry.status != status:
+                    continue
+                found.append(entry)
+        return found
+
+    def close(self):
+        """Close the stream file, if the journal opened it."""
+        with self._lock:
+            if self._file is not None and self._file is not self.stream:
+                self._file.close()
+            self._file = None
+
+    def _evict(self, entry):
+        for index, key in ((self._by_path, entry.path), (self._by_expectation, entry.expectation)):
+            if key is None:
+                continue
+            seqs = index[key]
+            seqs.popleft()
+            if not seqs:
+                del index[key]
+
+    def _write(self, entry):
+        if self._file is None:
+            self._file = self.stream if hasattr(self.stream, 'write') else open(self.stream, 'a')
+        self._file.write(json.dumps(entry._asdict(), sort_keys=True) + "\n")
@@ -0,0 +1,525 @@
+"""Lookup structures used by :class:`stubserver.StubServer` to find the expectation matching a request."""
+import hashlib
+import json
+import re
+import sys
+import threading
+from collections import OrderedDict
+from stubserver.response import to_bytes
+if sys.version_info[0] < 3:
+    from urllib import urlencode
+    from urlparse import parse_qs, parse_qsl
+else:
+    from urllib.parse import parse_qs, parse_qsl, urlencode
+
+_SPECIAL = set('.^$*+?{}[]\\|()')
+_QUANTIFIERS = set('*+?{')
+_PLAIN = re.compile(r'\^([^.^$*+?{}\[\]\\|()]*)\$$')
+
+
+def literal_prefix(pattern):
+    """
+    Work out how much of an URL regex is plain text.
+
+    :param pattern: Regex matching with path part of an URL
+    :type pattern: ``str``
+
+    :return: ``(prefix, exact)``. ``prefix`` is the literal text the pattern
+             is anchored to at the start of the path (empty when the pattern
+             is not anchored) and ``exact`` is True when the pattern matches
+             that text and nothing else.
+    :rtype: ``tuple``
+    """
+    plain = _PLAIN.match(pattern)
+    if plain:
+        return plain.group(1), True
+    if not pattern.startswith('^') or '|' in pattern:
+        return '', False
+    chars = []
+    i, n = 1, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 < n and not pattern[i + 1].isalnum():
+                literal, step = pattern[i + 1], 2
+            else:
+                break
+        elif c in _SPECIAL:
+            if c == '$' and i == n - 1:
+                return ''.join(chars), True
+            break
+        else:
+            literal, step = c, 1
+        if i + step < n and pattern[i + step] in _QUANTIFIERS:
+            break
+        chars.append(literal)
+        i += step
+    return ''.join(chars), False
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _canonical_json(value):
+    return _sha256(json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+
+def _canonical_form(pairs):
+    return _sha256(urlencode(sorted(pairs)).encode('utf-8'))
+
+
+def _json_key(body):
+    try:
+        return _canonical_json(json.loads(body.text()))
+    except ValueError:
+        return None
+
+
+def _form_key(body):
+    return _canonical_form(parse_qsl(body.text(), keep_blank_values=True))
+
+
+_BODY_KEYS = {
+    'raw': lambda body: body.digest(),
+    'json': _json_key,
+    'form': _form_key,
+}
+
+
+def body_key(kind, body, keys):
+    """
+    Digest of a request body in the canonical form of ``kind``.
+
+    :param keys: Digests already worked out for this request, filled in as
+                 new ones are needed
+    :type keys: ``dict``
+
+    :return: The hex digest, or ``None`` when the body has no such form
+    """
+    if kind not in keys:
+        keys[kind] = _BODY_KEYS[kind](body)
+    return keys[kind]
+
+
+def _contains(actual, expected):
+    """True when ``expected`` is ``actual`` with some object members left out."""
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and all(
+            name in actual and _contains(actual[name], value) for name, value in expected.items())
+    if isinstance(expected, list):
+        return (isinstance(actual, list) and len(actual) == len(expected) and
+                all(_contains(a, e) for a, e in zip(actual, expected)))
+    return actual == expected
+
+
+def _form_pairs(fields):
+    if isinstance(fields, (bytes, type(u''))):
+        return parse_qsl(to_bytes(fields).decode('utf-8'), keep_blank_values=True)
+    pairs = []
+    for name, value in (fields.items() if isinstance(fields, dict) else fields):
+        if isinstance(value, (list, tuple)):
+            pairs.extend((name, v) for v in value)
+        else:
+            pairs.append((name, value))
+    return pairs
+
+
+class Body(object):
+    """
+    How the body of a request is compared with the ``data`` of an expectation.
+
+    Exact, full JSON and full form matchers reduce the expected body to a
+    digest when they are created. Expectations using them with a ``^/literal$``
+    URL are looked up by the digest of the request body, however many share
+    the URL.
+    """
+
+    def __init__(self, kind, description, key=None, compare=None, size=None):
+        """
+        :param kind: ``"raw"``, ``"json"`` or ``"form"`` for matchers with a
+                     digest, anything else for ones only ``compare`` decides
+        :type kind: ``str``
+
+        :param description: Shown when a request does not match
+        :type description: ``str``
+
+        :param key: Digest of the expected body in the canonical form of ``kind``
+        :type key: ``None`` or ``str``
+
+        :param compare: Called with a :class:`stubserver.body.RequestBody`
+                        when there is no ``key``
+        :type compare: callable
+
+        :param size: Length an exactly matching body has
+        :type size: ``None`` or ``int``
+        """
+        self.kind = kind
+        self.description = description
+        self.key = key
+        self.compare = compare
+        self.size = size
+
+    @classmethod
+    def exactly(cls, data):
+        """The body is ``data``, byte for byte."""
+        if not isinstance(data, (bytes, type(u''))):
+            return cls('other', str(data), compare=lambda body: data == body.text())
+        data = to_bytes(data)
+        return cls('raw', data.decode('utf-8', 'replace'), key=_sha256(data), size=len(data))
+
+    @classmethod
+    def json(cls, value, partial=False):
+        """
+        The body is JSON equal to ``value``, whatever the key order and spacing.
+
+        :param value: Expected document, or its JSON text
+        :param partial: Let the request have object members ``value`` leaves
+                        out; arrays must still have the same length
+        :type partial: ``bool``
+        """
+        if isinstance(value, (bytes, type(u''))):
+            value = json.loads(to_bytes(value).decode('utf-8'))
+        description = "JSON %s%s" % ("containing " if partial else "", json.dumps(value, sort_keys=True))
+        if not partial:
+            return cls('json', description, key=_canonical_json(value))
+
+        def compare(body):
+            try:
+                return _contains(json.loads(body.text()), value)
+            except ValueError:
+                return False
+        return cls('json_partial', description, compare=compare)
+
+    @classmethod
+    def form(cls, fields, partial=False):
+        """
+        The body is ``application/x-www-form-urlencoded`` with these fields,
+        in any order.
+
+        :param fields: ``dict`` of names to a value or list of values, pairs,
+                       or an encoded form
+        :param partial: Let the request have other fields too
+        :type partial: ``bool``
+        """
+        pairs = _form_pairs(fields)
+        description = "form %s%s" % ("containing " if partial else "", urlencode(sorted(pairs)))
+        if not partial:
+            return cls('form', description, key=_canonical_form(pairs))
+
+        def compare(body):
+            sent = parse_qs(body.text(), keep_blank_values=True)
+            return all(value in sent.get(name, ()) for name, value in pairs)
+        return cls('form_partial', description, compare=compare)
+
+    @classmethod
+    def matching(cls, pattern, flags=0):
+        """The body, decoded as UTF-8, contains a match of the regex ``pattern``."""
+        regex = re.compile(pattern, flags)
+        return cls('regex', "matching %s" % pattern, compare=lambda body: regex.search(body.text()) is not None)
+
+    @classmethod
+    def coerce(cls, data):
+        """Turn the ``data`` of an expectation into a matcher, ``None`` when any body will do."""
+        if isinstance(data, cls):
+            return data
+        if not data:
+            return None
+        return cls.exactly(data)
+
+    def matches(self, body, keys):
+        """
+        :param keys: Body digests already worked out for this request
+        :type keys: ``dict``
+        """
+        if self.key is None:
+            return self.compare(body)
+        if self.size is not None and body.size != self.size:
+            return False
+        return body_key(self.kind, body, keys) == self.key
+
+    def __str__(self):
+        return self.description
+
+    __repr__ = __str__
+
+
+def _by_registration(expectation):
+    return expectation.seq
+
+
+class _PrefixTrie(object):
+    """Character trie holding expectations under the literal prefix of their URL regex."""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, prefix, expectation):
+        node = self._root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node.setdefault(None, OrderedDict())[expectation.seq] = expectation
+
+    def remove(self, prefix, expectation):
+        node = self._root
+        for c in prefix:
+            node = node.get(c)
+            if node is None:
+                return
+        node.get(None, {}).pop(expectation.seq, None)
+
+    def find(self, path):
+        """Yield every expectation whose prefix starts ``path``, shortest prefix first."""
+        node = self._root
+        for c in path:
+            node = node.get(c)
+            if node is None:
+                return
+            if None in node:
+                for expectation in node[None].values():
+                    yield expectation
+
+
+class _UrlIndex(object):
+    """
+    Expectations registered for one HTTP method.
+
+    URL patterns of the form ``^/literal$`` live in a dict keyed on the path,
+    patterns anchored to a literal prefix live in a trie and anything else is
+    kept in a list that is scanned with the precompiled regex. Expectations
+    with a ``^/literal$`` pattern and a body matcher that has a digest are
+    instead kept in a dict keyed on the path and the digest.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = _PrefixTrie()
+        self._scan = OrderedDict()
+        self._by_body = {}
+        self._keyed = {}
+
+    def add(self, expectation):
+        prefix, exact = expectation.url_prefix, expectation.url_exact
+        matcher = expectation.data_match
+        if exact and matcher is not None and matcher.key is not None:
+            key = (prefix, matcher.kind, matcher.key)
+            self._by_body.setdefault(key, OrderedDict())[expectation.seq] = expectation
+            kinds = self._keyed.get(prefix)
+            if kinds is None:
+                kinds = self._keyed[prefix] = {}
+            kinds.setdefault(matcher.kind, OrderedDict())[expectation.seq] = expectation
+        elif exact:
+            self._exact.setdefault(prefix, OrderedDict())[expectation.seq] = expectation
+        elif prefix:
+            self._prefixes.add(prefix, expectation)
+        else:
+            self._scan[expectation.seq] = expectation
+
+    def remove(self, expectation):
+        prefix, exact = expectation.url_prefix, expectation.url_exact
+        matcher = expectation.data_match
+        if exact and matcher is not None and matcher.key is not None:
+            key = (prefix, matcher.kind, matcher.key)
+            _discard(self._by_body, key, expectation)
+            kinds = self._keyed.get(prefix)
+            if kinds is not None:
+                _discard(kinds, matcher.kind, expectation)
+                if not kinds:
+                    del self._keyed[prefix]
+        elif exact:
+            bucket = self._exact.get(prefix)
+            if bucket is not None:
+                bucket.pop(expectation.seq, None)
+                if not bucket:
+                    del self._exact[prefix]
+        elif prefix:
+            self._prefixes.remove(prefix, expectation)
+        else:
+            self._scan.pop(expectation.seq, None)
+
+    def find(self, path, keyed=True):
+        """
+        Return the expectations whose URL regex matches ``path``, in registration order.
+
+        :param keyed: Include those kept under the digest of their body
+        :type keyed: ``bool``
+        """
+        found = list(self._exact.get(path, {}).values())
+        for source in (self._prefixes.find(path), self._scan.values()):
+            found.extend([x for x in source if x.url_re.search(path)])
+        if keyed and path in self._keyed:
+            for bucket in self._keyed[path].values():
+                found.extend(bucket.values())
+        # The trie yields shorter prefixes first, so even one source may be out of order
+        found.sort(key=_by_registration)
+        return found
+
+    def keyed(self, path):
+        """Return ``{kind: expectations}`` for the expectations at ``path`` kept under a body digest."""
+        return self._keyed.get(path, {})
+
+    def by_body(self, path, kind, key):
+        return self._by_body.get((path, kind, key))
+
+
+def _discard(buckets, key, expectation):
+    bucket = buckets.get(key)
+    if bucket is not None:
+        bucket.pop(expectation.seq, None)
+        if not bucket:
+            del buckets[key]
+
+
+def _for_method(indexes, method):
+    index = indexes.get(method)
+    if index is None:
+        index = indexes[method] = _UrlIndex()
+    return index
+
+
+class ExpectationIndex(object):
+    """
+    Expectations of a :class:`stubserver.StubServer` bucketed by HTTP method.
+
+    Expectations that can still answer requests are also kept in a separate
+    index so the common case of finding the next expectation to fulfil never
+    looks at the ones already used up. The full index is only consulted to explain a miss.
+
+    All public methods take the index lock, so an expectation is only ever
+    claimed by one of several concurrent requests. The lock may be replaced
+    by a process-shared one, in which case expectations can be exhausted by
+    another process and are dropped from the active index when next seen.
+    """
+    # Called with each expectation after a request has been counted against it
+    on_satisfy = None
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._active = {}
+        self._all = {}
+        self._registered = []
+        self._seq = 0
+
+    def add(self, expectation):
+        with self.lock:
+            self._seq += 1
+            expectation.seq = self._seq
+            self._registered.append(expectation)
+            _for_method(self._all, expectation.method).add(expectation)
+            if not expectation.exhausted:
+                _for_method(self._active, expectation.method).add(expectation)
+
+    def add_all(self, expectations):
+        """Add many expectations, taking the lock once."""
+        with self.lock:
+            for expectation in expectations:
+                self.add(expectation)
+
+    def clear(self):
+        with self.lock:
+            self._active.clear()
+            self._all.clear()
+            del self._registered[:]
+
+    def expectations(self):
+        """Return every registered expectation in registration order."""
+        with self.lock:
+            return list(self._registered)
+
+    def claim(self, method, path, body):
+        """
+        Atomically find the expectation answering a request and count the
+        hit against it.
+
+        :return: ``(expectation, error)`` where exactly one is not ``None``.
+                 ``error`` is a ``(code, message, body)`` tuple describing why
+                 nothing matched.
+        :rtype: ``tuple``
+        """
+        with self.lock:
+            exp, error = self._match(method, path, body)
+            if exp is not None:
+                self._satisfy(exp, body)
+            return exp, error
+
+    def _satisfy(self, expectation, body):
+        expectation.hits += 1
+        body.capture_into(expectation.data_capture, expectation.capture_digest)
+        if expectation.exhausted:
+            self._retire(expectation)
+        if self.on_satisfy is not None:
+            self.on_satisfy(expectation)
+
+    def _retire(self, expectation):
+        active = self._active.get(expectation.method)
+        if active is not None:
+            active.remove(expectation)
+
+    def _first_live(self, bucket):
+        """Return the first expectation of ``bucket`` not yet exhausted, retiring those that are."""
+        found = None
+        stale = []
+        for exp in (bucket.values() if bucket else ()):
+            if not exp.exhausted:
+                found = exp
+                break
+            stale.append(exp)
+        for exp in stale:
+            self._retire(exp)
+        return found
+
+    def _match(self, method, path, body):
+        active = self._active.get(method)
+        matching_expectations = []
+        keyed = {}
+        if active is not None:
+            for exp in active.find(path, keyed=False):
+                if exp.exhausted:
+                    self._retire(exp)
+                else:
+                    matching_expectations.append(exp)
+            keyed = active.keyed(path)
+        # The earliest registered expectation whose body matcher accepts the body wins
+        keys = {}
+        best = None
+        for kind in list(keyed):
+            key = body_key(kind, body, keys)
+            exp = self._first_live(active.by_body(path, kind, key)) if key is not None else None
+            if exp is not None and (best is None or exp.seq < best.seq):
+                best = exp
+        for exp in matching_expectations:
+            if best is not None and exp.seq > best.seq:
+                break
+            if exp.data_match is not None and exp.data_match.matches(body, keys):
+                best = exp
+                break
+        if best is not None:
+            return best, None
+        first = matching_expectations[0] if matching_expectations else None
+        for bucket in list(keyed.values()):
+            exp = self._first_live(bucket)
+            if exp is not None and (first is None or exp.seq < first.seq):
+                first = exp
+        if first is not None:
+            if first.data_match is not None:
+                return None, (403, "Payload missing or incorrect",
+                              "This URL expects data: {0}. Query provided: {1}".format(first.data, body.text()))
+            return first, None
+
+        every = self._all.get(method)
+        expectations_matching_method = every.find(path) if every is not None else []
+        if expectations_matching_method:
+            # All expectations have been fulfilled
+            return None, (400, "Expectations exhausted",
+                          "Expectations at this URL have already been satisfied.\n" +
+                          str(expectations_matching_method))
+        expectations_matching_url = []
+        for every in self._all.values():
+            expectations_matching_url.extend(every.find(path))
+        if expectations_matching_url:
+            expectations_matching_url.sort(key=_by_registration)
+            # Method not allowed
+            return None, (405, "Method not allowed",
+                          "Method " + method + " not allowed.\n" + str(expectations_matching_url))
+        # not found
+        return None, (404, "Not found", "No URL pattern matched.")
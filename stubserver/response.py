@@ -0,0 +1,345 @@
+"""HTTP responses serialized ahead of time so a hit only has to write bytes."""
+import email.utils
+import mmap
+import os
+import re
+import sys
+import time
+import zlib
+try:
+    import brotli
+except ImportError:
+    brotli = None
+if sys.version_info[0] < 3:
+    import BaseHTTPServer
+else:
+    import http.server as BaseHTTPServer
+
+SERVER_HEADER = ("Server: %s %s\r\n" % (BaseHTTPServer.BaseHTTPRequestHandler.server_version,
+                                        BaseHTTPServer.BaseHTTPRequestHandler.sys_version)).encode('iso-8859-1')
+
+# Bodies above this size are written after the head rather than copied into it
+COPY_LIMIT = 64 * 1024
+
+# Slice size used when a file has to be written through mmap rather than sendfile
+MMAP_CHUNK = 1024 * 1024
+
+# Bodies smaller than this are always sent as they are
+COMPRESS_MIN = 256
+
+# Content codings offered, most preferred first
+ENCODINGS = ('br', 'gzip', 'deflate') if brotli is not None else ('gzip', 'deflate')
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_date_cache = [None, None]
+
+
+def date_header():
+    """Return the ``Date`` header line, formatted at most once a second."""
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache[1] = ("Date: %s\r\n" % email.utils.formatdate(now, usegmt=True)).encode('iso-8859-1')
+        _date_cache[0] = now
+    return _date_cache[1]
+
+
+_accepted = {}
+
+
+def choose_encoding(accept_encoding):
+    """
+    Pick the content coding to answer with.
+
+    :param accept_encoding: Value of the ``Accept-Encoding`` request header
+    :type accept_encoding: ``str``
+
+    :return: One of :data:`ENCODINGS`, or ``None`` for the body as it is
+    """
+    if not accept_encoding:
+        return None
+    chosen = _accepted.get(accept_encoding, False)
+    if chosen is not False:
+        return chosen
+    weights = {}
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip()] = weight
+    chosen = None
+    for coding in ENCODINGS:
+        if weights.get(coding, weights.get('*', 0)) > 0:
+            chosen = coding
+            break
+    if len(_accepted) < 64:
+        # Clients send a handful of distinct values, so this stays small
+        _accepted[accept_encoding] = chosen
+    return chosen
+
+
+def compress(data, coding):
+    """Encode ``data`` with a coding from :data:`ENCODINGS`."""
+    if coding == 'br':
+        return brotli.compress(bytes(data))
+    # gzip is the deflate stream in a gzip wrapper, HTTP's deflate the same in a zlib one
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31 if coding == 'gzip' else 15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def to_bytes(content):
+    if isinstance(content, bytes):
+        return content
+    return content.encode('utf-8')
+
+
+def sends_length(code):
+    """
+    Whether a response with status ``code`` gets ``Content-Length``: 1xx and
+    204 must not send it (RFC 7230 3.3.2) and on a 304 it would describe
+    the cached body rather than this response.
+    """
+    return not (100 <= code < 200 or code in (204, 304))
+
+
+class PreparedResponse(object):
+    """
+    Status line, headers and body of a response, serialized once.
+
+    Only the protocol version, the ``Date`` header and an optional
+    ``Connection: close`` are added per request, by :meth:`render`.
+
+    When built with ``compress`` and a request accepts a content coding,
+    :meth:`resolve` answers with a compressed variant, built on first use
+    and kept for later hits.
+    """
+
+    def __init__(self, code, message, content_type, headers, body, length=None, compress=False):
+        """
+        :param code: Response code
+        :type code: ``int``
+
+        :param message: Reason phrase sent after the code
+        :type message: ``str``
+
+        :param content_type: Value of the ``Content-Type`` header
+        :type content_type: ``str``
+
+        :param headers: Additional HTTP header fields to be sent
+        :type headers: ``iterable of tuples (header field name, value)``
+
+        :param body: Response's content
+        :type body: ``bytes``
+
+        :param length: ``Content-Length`` of a body sent separately, when
+                       ``body`` is empty
+        :type length: ``None`` or ``int``
+
+        :param compress: Offer the body compressed when it is at least
+                         :data:`COMPRESS_MIN` bytes and ``headers`` do not
+                         set a ``Content-Encoding`` already
+        :type compress: ``bool``
+        """
+        self.code = code
+        self.body = body
+        self.closes = False
+        lines = [" %d %s" % (code, message)]
+        lines.append(SERVER_HEADER.decode('iso-8859-1').rstrip())
+        lines.append("Content-Type: %s" % content_type)
+        if sends_length(code):
+            lines.append("Content-Length: %d" % (len(body) if length is None else length))
+        if headers:
+            for name, value in headers:
+                lines.append("%s: %s" % (name, value))
+                if name.lower() == 'connection' and str(value).lower() == 'close':
+                    self.closes = True
+        self.head = ("\r\n".join(lines) + "\r\n").encode('iso-8859-1')
+        self._heads = {}
+        self._args = (code, message, content_type, headers)
+        self._variants = None
+        if compress and len(body) >= COMPRESS_MIN and not any(name.lower() == 'content-encoding' for name, value in headers or ()):
+            self._variants = {}
+
+    def resolve(self, headers):
+        """
+        Work out what to send for one request.
+
+        :param headers: Headers of the request
+        :type headers: ``dict``-like
+
+        :return: ``(response, file_part)``. ``file_part`` is ``None`` or the
+                 ``(path, offset, count)`` to send after ``response``.
+        :rtype: ``tuple``
+        """
+        if self._variants is None:
+            return self, None
+        coding = choose_encoding(headers.get('Accept-Encoding'))
+        if coding is None:
+            return self, None
+        variant = self._variants.get(coding)
+        if variant is None:
+            variant = self._variants[coding] = self._encoded(coding)
+        return variant, None
+
+    def _encoded(self, coding):
+        encoded = compress(self.body, coding)
+        if len(encoded) >= len(self.body):
+            return self
+        code, message, content_type, headers = self._args
+        headers = list(headers or ()) + [("Content-Encoding", coding), ("Vary", "Accept-Encoding")]
+        return PreparedResponse(code, message, content_type, headers, encoded)
+
+    def render(self, protocol_version, close=False, head_only=False):
+        """
+        Return the buffers to write for one hit, normally a single one.
+
+        :param protocol_version: Version sent in the status line, e.g. ``"HTTP/1.1"``
+        :type protocol_version: ``str``
+
+        :param close: Announce that the connection closes after this response
+        :type close: ``bool``
+
+        :param head_only: Leave the body out, as for a ``HEAD`` request
+        :type head_only: ``bool``
+
+        :rtype: ``list`` of ``bytes``
+        """
+        head = self._heads.get(protocol_version)
+        if head is None:
+            head = self._heads[protocol_version] = protocol_version.encode('iso-8859-1') + self.head
+        parts = [head, date_header()]
+        if close and not self.closes:
+            parts.append(b"Connection: close\r\n")
+        parts.append(b"\r\n")
+        if head_only or not self.body:
+            return [b"".join(parts)]
+        if len(self.body) > COPY_LIMIT:
+            return [b"".join(parts), self.body]
+        parts.append(self.body)
+        return [b"".join(parts)]
+
+
+class DeferredResponse(object):
+    """
+    Stands in for a :class:`PreparedResponse` that is only built, reading
+    its body from ``path`` if one is given, when first hit.
+    """
+
+    def __init__(self, code, message, content_type, headers, body=b"", path=None, compress=False):
+        """
+        :param path: File the body is read from on the first hit
+        :type path: ``None`` or ``str``
+
+        Other parameters are as for :class:`PreparedResponse`.
+        """
+        self.code = code
+        self.args = (code, message, content_type, headers, body)
+        self.compress = compress
+        self.path = path
+        self._prepared = None
+
+    def prepare(self):
+        """Build the response now, unless it has been built already."""
+        if self._prepared is None:
+            code, message, content_type, headers, body = self.args
+            if self.path is not None:
+                with open(self.path, 'rb') as f:
+                    body = f.read()
+            self._prepared = PreparedResponse(code, message, content_type, headers, body, compress=self.compress)
+        return self._prepared
+
+    def resolve(self, headers):
+        return self.prepare().resolve(headers)
+
+
+class FileResponse(object):
+    """
+    Response whose body stays on disk and is sent with ``sendfile`` on every
+    hit. ``Content-Length`` comes from ``stat`` and a single ``Range``
+    request is answered with ``206 Partial Content``.
+    """
+
+    def __init__(self, code, message, content_type, headers, path):
+        """
+        :param path: File to send
+        :type path: ``str``
+
+        Other parameters are as for :class:`PreparedResponse`.
+        """
+        self.code = code
+        self.message = message
+        self.content_type = content_type
+        self.headers = list(headers or ())
+        self.path = path
+        self.closes = any(name.lower() == 'connection' and str(value).lower() == 'close'
+                          for name, value in self.headers)
+
+    def resolve(self, headers):
+        size = os.stat(self.path).st_size
+        extra = [("Accept-Ranges", "bytes")]
+        requested = headers.get("Range") if self.code == 200 else None
+        if requested:
+            span = parse_range(requested, size)
+            if span is None:
+                extra.append(("Content-Range", "bytes */%d" % size))
+                body = b"Requested range not satisfiable"
+                return PreparedResponse(416, "Requested Range Not Satisfiable", "text/plain",
+                                        self.headers + extra, body), None
+            if span != (0, size):
+                offset, count = span
+                extra.append(("Content-Range", "bytes %d-%d/%d" % (offset, offset + count - 1, size)))
+                return (PreparedResponse(206, "Partial Content", self.content_type, self.headers + extra,
+                                         b"", length=count),
+                        (self.path, offset, count))
+        return (PreparedResponse(self.code, self.message, self.content_type, self.headers + extra, b"", length=size),
+                (self.path, 0, size))
+
+
+def parse_range(header, size):
+    """
+    Parse a single byte range.
+
+    :return: ``(offset, count)`` of the range, ``(0, size)`` when the header
+             is not one we honour, or ``None`` when it cannot be satisfied.
+    :rtype: ``tuple``
+    """
+    match = _RANGE.match(header.strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        return 0, size
+    first, last = match.groups()
+    if first == '':
+        count = min(int(last), size)
+        if count == 0:
+            return None
+        return size - count, count
+    first = int(first)
+    last = size - 1 if last == '' else min(int(last), size - 1)
+    if first >= size or last < first:
+        return None
+    return first, last - first + 1
+
+
+def send_file(sock, path, offset, count):
+    """Write ``count`` bytes of ``path`` from ``offset`` to ``sock``, with sendfile where the platform has it."""
+    if count <= 0:
+        return
+    f = open(path, 'rb')
+    try:
+        if hasattr(os, 'sendfile') and hasattr(sock, 'sendfile'):
+            sock.sendfile(f, offset, count)
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end = offset + count
+            while offset < end:
+                sock.sendall(mapped[offset:min(offset + MMAP_CHUNK, end)])
+                offset += MMAP_CHUNK
+        finally:
+            mapped.close()
+    finally:
+        f.close()
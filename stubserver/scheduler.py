@@ -0,0 +1,241 @@
+"""Release delayed and throttled responses without holding a thread per response."""
+import errno
+import heapq
+import itertools
+import random
+import select
+import socket
+import threading
+import time
+try:
+    import selectors
+except ImportError:
+    # Python 2 and 3.3 wait with select instead
+    selectors = None
+
+# How often a throttled response is topped up, in seconds
+TICK = 0.05
+
+# Piece size when the body of a delayed but unthrottled file response is read
+FILE_CHUNK = 64 * 1024
+
+
+class Pacing(object):
+    """When the bytes of a response may be written."""
+
+    def __init__(self, delay=0, jitter=0, bytes_per_second=None, duration=None):
+        """
+        :param delay: Seconds before the first byte is sent
+        :type delay: ``float``
+
+        :param jitter: Up to this many seconds are added at random to ``delay``
+        :type jitter: ``float``
+
+        :param bytes_per_second: Rate the response is sent at
+        :type bytes_per_second: ``None`` or ``int``
+
+        :param duration: Seconds between the first and the last byte, whatever
+                         the size of the response
+        :type duration: ``None`` or ``float``
+        """
+        if bytes_per_second is not None and duration is not None:
+            raise ValueError("Give either bytes_per_second or duration, not both")
+        self.delay = delay
+        self.jitter = jitter
+        self.bytes_per_second = bytes_per_second
+        self.duration = duration
+
+    def schedule(self, buffers, file_part=None, start=None):
+        """
+        Split a response into pieces with the time each may be sent.
+
+        :param buffers: Head and body as rendered by :class:`stubserver.response.PreparedResponse`
+        :type buffers: ``list`` of ``bytes``
+
+        :param file_part: ``(path, offset, count)`` to send after ``buffers``
+        :type file_part: ``None`` or ``tuple``
+
+        :return: Iterator of ``(due, bytes)``, due times on the
+                 :func:`time.time` clock
+        """
+        if start is None:
+            start = time.time()
+        first = start + self.delay + (random.uniform(0, self.jitter) if self.jitter else 0)
+        total = sum(len(b) for b in buffers) + (file_part[2] if file_part else 0)
+        rate = self.bytes_per_second
+        if self.duration is not None:
+            rate = total / float(self.duration) if self.duration > 0 else None
+        piece = max(1, int(rate * TICK)) if rate else None
+        sent = 0
+        for data in _pieces(buffers, file_part, piece or FILE_CHUNK):
+            yield (first + sent / float(rate) if rate else first), data
+            sent += len(data)
+
+
+def _pieces(buffers, file_part, size):
+    for buf in buffers:
+        for i in range(0, len(buf), size):
+            yield buf[i:i + size]
+    if file_part is None:
+        return
+    path, offset, count = file_part
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while count > 0:
+            data = f.read(min(size, count))
+            if not data:
+                return
+            yield data
+            count -= len(data)
+
+
+class _Transfer(object):
+    def __init__(self, sock, pieces):
+        self.sock = sock
+        self.pieces = pieces
+        self.pending = b''
+
+
+class ResponseScheduler(object):
+    """
+    One thread writing every delayed or throttled response.
+
+    A handler hands over its socket together with a :meth:`Pacing.schedule`
+    and goes back to serving other connections. The scheduler sleeps until
+    the next piece is due, writes it without blocking and closes the socket
+    once the response is complete, so thousands of slow responses can be in
+    flight at once.
+    """
+
+    def __init__(self):
+        self._timers = []
+        self._writers = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = socketpair()
+        self._wake_r.setblocking(False)
+        self._selector = selectors.DefaultSelector() if selectors else None
+        if self._selector:
+            self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, sock, pieces):
+        """Take over ``sock`` and write ``pieces``, ``(due, bytes)`` pairs, as they fall due."""
+        sock.setblocking(False)
+        self._push(_Transfer(sock, iter(pieces)), time.time())
+
+    def close(self):
+        """Stop the scheduler thread and drop every response still in flight."""
+        self._running = False
+        self._wake()
+        self._thread.join(5)
+        for transfer in [t for _, _, t in self._timers] + list(self._writers.values()):
+            _close(transfer.sock)
+        self._timers = []
+        self._writers = {}
+        if self._selector:
+            self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _push(self, transfer, due):
+        with self._lock:
+            heapq.heappush(self._timers, (due, next(self._seq), transfer))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'x')
+        except socket.error:
+            pass
+
+    def _wait(self, timeout):
+        """Return the sockets that became writable, draining the wake-up socket."""
+        if self._selector:
+            ready = [key.fileobj for key, _ in self._selector.select(timeout)]
+        else:
+            readable, writable, _ = select.select([self._wake_r], list(self._writers), [], timeout)
+            ready = readable + writable
+        if self._wake_r in ready:
+            ready.remove(self._wake_r)
+            try:
+                self._wake_r.recv(4096)
+            except socket.error:
+                pass
+        return ready
+
+    def _block_on(self, transfer):
+        self._writers[transfer.sock] = transfer
+        if self._selector:
+            self._selector.register(transfer.sock, selectors.EVENT_WRITE)
+
+    def _run(self):
+        while self._running:
+            with self._lock:
+                timeout = max(0, self._timers[0][0] - time.time()) if self._timers else None
+            for sock in self._wait(timeout):
+                if self._selector:
+                    self._selector.unregister(sock)
+                self._advance(self._writers.pop(sock))
+            now = time.time()
+            due = []
+            with self._lock:
+                while self._timers and self._timers[0][0] <= now:
+                    due.append(heapq.heappop(self._timers)[2])
+            for transfer in due:
+                self._advance(transfer)
+
+    def _advance(self, transfer):
+        """Write as much of ``transfer`` as is due and the socket accepts, then requeue it."""
+        while True:
+            if transfer.pending:
+                try:
+                    sent = transfer.sock.send(transfer.pending)
+                except (socket.error, ValueError) as e:
+                    if _would_block(e):
+                        self._block_on(transfer)
+                    else:
+                        _close(transfer.sock)
+                    return
+                transfer.pending = transfer.pending[sent:]
+                if transfer.pending:
+                    self._block_on(transfer)
+                    return
+            try:
+                due, transfer.pending = next(transfer.pieces)
+            except StopIteration:
+                _close(transfer.sock)
+                return
+            if due > time.time():
+                with self._lock:
+                    heapq.heappush(self._timers, (due, next(self._seq), transfer))
+                return
+
+
+def _would_block(error):
+    return getattr(error, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def _close(sock):
+    try:
+        sock.setblocking(True)
+        sock.shutdown(socket.SHUT_WR)
+    except (socket.error, ValueError):
+        pass
+    sock.close()
+
+
+def socketpair():
+    """Return a pair of connected sockets, used to wake a thread blocked in ``select``."""
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.create_connection(listener.getsockname())
+    reader, _ = listener.accept()
+    listener.close()
+    return reader, writer
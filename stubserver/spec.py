@@ -0,0 +1,119 @@
+"""
+Expectations described in files rather than code.
+
+A JSON spec is a list of objects, or an object with an ``expectations``
+list. Keys are the arguments of :meth:`stubserver.StubServer.expect` and
+:meth:`stubserver.webserver.Expectation.and_return`::
+
+    [
+      {"method": "GET", "url": "^/users/1$", "file_content": "users/1.json",
+       "mime_type": "application/json"},
+      {"method": "POST", "url": "^/users$", "data": "name=bob", "reply_code": 201, "times": null},
+      {"method": "PUT", "url": "^/users/1$", "data": {"name": "bob"}, "reply_code": 204}
+    ]
+
+A ``data`` object or array matches a JSON body with the same content,
+whatever its key order and spacing.
+
+The line format has one expectation per line, ``METHOD URL [CODE [BODY]]``,
+where a body starting with ``@`` names a file. Blank lines and lines
+starting with ``#`` are skipped::
+
+    GET ^/health$ 200 ok
+    GET ^/users/1$ 200 @users/1.json
+    DELETE ^/users/1$ 204
+
+Relative file names are resolved against the directory of the spec file.
+"""
+import io
+import json
+import mimetypes
+import os
+
+EXPECT_KEYS = frozenset(['method', 'url', 'data', 'capture_digest', 'times'])
+RETURN_KEYS = frozenset(['mime_type', 'reply_code', 'content', 'file_content', 'headers', 'serve_file',
+                         'delay', 'jitter', 'bytes_per_second', 'duration', 'template',
+                         'compress'])
+KEYS = EXPECT_KEYS | RETURN_KEYS
+
+
+def read_spec(source, format=None):
+    """
+    Parse a spec.
+
+    :param source: File name, or open text file
+    :type source: ``str`` or file
+
+    :param format: ``"json"`` or ``"lines"``; guessed from the file name or
+                   the first character when not given
+    :type format: ``None`` or ``str``
+
+    :return: One ``dict`` per expectation, with file names made absolute
+    :rtype: ``list``
+    :raises: ValueError: If the spec is malformed.
+    """
+    if hasattr(source, 'read'):
+        text = source.read()
+        base_dir = os.path.dirname(os.path.abspath(getattr(source, 'name', '.')))
+    else:
+        with io.open(source, encoding='utf-8') as f:
+            text = f.read()
+        base_dir = os.path.dirname(os.path.abspath(source))
+        if format is None and source.endswith('.json'):
+            format = 'json'
+    if format is None:
+        format = 'json' if text.lstrip()[:1] in ('[', '{') else 'lines'
+    if format == 'json':
+        entries = _json_entries(text)
+    elif format == 'lines':
+        entries = _line_entries(text)
+    else:
+        raise ValueError("Unknown spec format: %r" % (format,))
+    for entry in entries:
+        for key in ('file_content', 'serve_file'):
+            if entry.get(key):
+                entry[key] = os.path.join(base_dir, entry[key])
+    return entries
+
+
+def _json_entries(text):
+    spec = json.loads(text)
+    if isinstance(spec, dict):
+        spec = spec.get('expectations', [])
+    if not isinstance(spec, list):
+        raise ValueError("A JSON spec is a list of expectations")
+    for number, entry in enumerate(spec):
+        if not isinstance(entry, dict) or 'url' not in entry:
+            raise ValueError("Expectation %d has no url" % number)
+        if not KEYS.issuperset(entry):
+            unknown = set(entry) - KEYS
+            raise ValueError("Expectation %d has unknown keys: %s" % (number, ", ".join(sorted(unknown))))
+        if isinstance(entry.get('headers'), dict):
+            entry['headers'] = list(entry['headers'].items())
+    return spec
+
+
+def _line_entries(text):
+    entries = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(None, 3)
+        if len(fields) < 2:
+            raise ValueError("Line %d: expected METHOD URL [CODE [BODY]]" % number)
+        entry = {'method': fields[0], 'url': fields[1]}
+        if len(fields) > 2:
+            try:
+                entry['reply_code'] = int(fields[2])
+            except ValueError:
+                raise ValueError("Line %d: bad response code %r" % (number, fields[2]))
+        if len(fields) > 3:
+            body = fields[3]
+            if body.startswith('@'):
+                entry['file_content'] = body[1:]
+                entry['mime_type'] = mimetypes.guess_type(body[1:])[0] or 'text/html'
+            else:
+                entry['content'] = body
+        entries.append(entry)
+    return entries
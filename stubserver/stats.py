@@ -0,0 +1,112 @@
+"""Traffic counters kept by :class:`stubserver.StubServer` and served on ``/__stats``."""
+import threading
+
+STATS_PATH = "/__stats"
+
+# Histogram buckets are powers of two microseconds, the last one catching everything above ~67s
+_BUCKETS = 27
+
+
+class Histogram(object):
+    """Durations counted in power-of-two microsecond buckets."""
+
+    def __init__(self):
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micros = int(seconds * 1000000)
+        self.counts[min(micros.bit_length(), _BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        """
+        :return: ``count``, ``total``, ``mean`` and ``max`` in seconds, plus
+                 ``buckets`` mapping the upper bound of each non-empty bucket,
+                 in microseconds, to its count.
+        :rtype: ``dict``
+        """
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": dict((str((1 << i) - 1), n) for i, n in enumerate(self.counts) if n),
+        }
+
+
+class ServerStats(object):
+    """
+    Request counters of one server. :meth:`record` is called once per
+    request, before its response is sent, and :meth:`record_write` once the
+    response has been written.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.unmatched = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.body_time = Histogram()
+        self.match_time = Histogram()
+        self.write_time = Histogram()
+
+    def record(self, status, matched, bytes_in, bytes_out, body_time, match_time):
+        """
+        :param status: Response code sent
+        :type status: ``int``
+
+        :param matched: Whether an expectation answered the request
+        :type matched: ``bool``
+
+        :param bytes_in: Size of the request body
+        :type bytes_in: ``int``
+
+        :param bytes_out: Bytes written for the response
+        :type bytes_out: ``int``
+
+        :param body_time: Seconds spent reading the request body
+        :param match_time: Seconds spent finding the expectation
+        """
+        with self._lock:
+            self.requests += 1
+            if not matched:
+                self.unmatched[status] = self.unmatched.get(status, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.body_time.add(body_time)
+            self.match_time.add(match_time)
+
+    def record_write(self, write_time):
+        """
+        :param write_time: Seconds spent writing the response
+        """
+        with self._lock:
+            self.write_time.add(write_time)
+
+    def as_dict(self, expectations=()):
+        """
+        Snapshot the counters.
+
+        :param expectations: Expectations whose hit counts are reported
+        :type expectations: ``iterable`` of :class:`stubserver.webserver.Expectation`
+        :rtype: ``dict``
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "unmatched": dict((str(status), n) for status, n in self.unmatched.items()),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "body_time": self.body_time.as_dict(),
+                "match_time": self.match_time.as_dict(),
+                "write_time": self.write_time.as_dict(),
+                "expectations": [{"method": x.method, "url": x.url, "hits": x.hits, "times": str(x.times)}
+                                 for x in expectations],
+            }
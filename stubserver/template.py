@@ -0,0 +1,200 @@
+"""
+Responses whose body and headers are filled in from the request.
+
+A template is plain text in which only these placeholders are replaced,
+so JSON and XML bodies need no escaping::
+
+    {url.1}          group 1 of the expectation's URL regex ({url.0} is the whole match)
+    {url.name}       named group of the URL regex
+    {query.name}     first value of a query string parameter
+    {header.Name}    request header
+    {body}           request body
+
+A placeholder with nothing to fill it in is left empty. Templates are split
+into literal and placeholder pieces when the expectation is registered, so
+a hit only looks up the values and joins the pieces.
+"""
+import re
+import sys
+import traceback
+from collections import namedtuple
+from stubserver.response import PreparedResponse, SERVER_HEADER, sends_length, to_bytes
+if sys.version_info[0] < 3:
+    from urlparse import parse_qs
+else:
+    from urllib.parse import parse_qs
+
+_PLACEHOLDER = re.compile(r'\{(?:(url|query|header)\.([^{}\s]+)|(body))\}')
+
+
+class TemplateRequest(namedtuple('TemplateRequest', 'method path query headers body match')):
+    """
+    What a response callable is given: the method, the path including any
+    query string, the query parameters as a ``dict`` of lists, the request
+    headers, the body as ``bytes`` and the match of the URL regex.
+    """
+    __slots__ = ()
+
+
+def compile_template(text):
+    """
+    Split a template into pieces.
+
+    :return: ``bytes`` for literal text and ``(source, key)`` tuples for
+             placeholders, or ``None`` when the text has no placeholder
+    :rtype: ``tuple``
+    """
+    text = text.decode('utf-8') if isinstance(text, bytes) else text
+    pieces = []
+    start = 0
+    for placeholder in _PLACEHOLDER.finditer(text):
+        if placeholder.start() > start:
+            pieces.append(text[start:placeholder.start()].encode('utf-8'))
+        source, key, body = placeholder.groups()
+        if body:
+            pieces.append(('body', None))
+        elif source == 'url':
+            pieces.append((source, int(key) if key.isdigit() else key))
+        else:
+            pieces.append((source, key))
+        start = placeholder.end()
+    if not pieces:
+        return None
+    if start < len(text):
+        pieces.append(text[start:].encode('utf-8'))
+    return tuple(pieces)
+
+
+class _Values(object):
+    """Placeholder values of one request, each worked out on first use."""
+
+    def __init__(self, url_re, path, headers, body):
+        self.url_re = url_re
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self._match = self._query = self._text = None
+
+    def get(self, source, key):
+        if source == 'url':
+            if self._match is None:
+                self._match = self.url_re.search(self.path) or False
+            if not self._match:
+                return b""
+            try:
+                value = self._match.group(key)
+            except IndexError:
+                return b""
+        elif source == 'query':
+            if self._query is None:
+                self._query = query_of(self.path)
+            value = self._query.get(key, [None])[0]
+        elif source == 'header':
+            value = self.headers.get(key)
+        else:
+            if self._text is None:
+                self._text = self.body.getvalue()
+            return self._text
+        return to_bytes(value) if value is not None else b""
+
+
+def query_of(path):
+    """Return the query parameters of ``path`` as a ``dict`` of lists."""
+    if '?' not in path:
+        return {}
+    return parse_qs(path.split('?', 1)[1], keep_blank_values=True)
+
+
+def _render(pieces, values):
+    return b"".join([piece if isinstance(piece, bytes) else values.get(*piece) for piece in pieces])
+
+
+class _RenderedResponse(PreparedResponse):
+    """A :class:`PreparedResponse` put together from a head already serialized."""
+
+    def __init__(self, code, head, body, closes):
+        self.code = code
+        self.head = head
+        self.body = body
+        self.closes = closes
+        self._heads = {}
+
+
+class TemplateResponse(object):
+    """
+    Response built for each request, from a template or by calling a function.
+
+    The status line and every header without a placeholder are serialized
+    once; a hit only adds the rendered headers, ``Content-Length`` and body.
+    """
+
+    def __init__(self, code, message, content_type, headers, content, url_re):
+        """
+        :param content: Body template, or a callable given a
+                        :class:`TemplateRequest` and returning the body, or a
+                        ``(reply_code, headers, body)`` tuple
+        :type content: ``str``, ``bytes`` or callable
+
+        :param url_re: Returns the compiled URL regex of the expectation
+        :type url_re: callable
+
+        Other parameters are as for :class:`stubserver.response.PreparedResponse`.
+        """
+        self.code = code
+        self.message = message
+        self.content_type = content_type
+        self.url_re = url_re
+        self.callback = content if callable(content) else None
+        self.headers = list(headers or ())
+        self.closes = any(name.lower() == 'connection' and str(value).lower() == 'close'
+                          for name, value in self.headers)
+        if self.callback is None:
+            content = to_bytes(content)
+            self.body = compile_template(content) or (content,)
+        self._templated = []
+        lines = [" %d %s" % (code, message), SERVER_HEADER.decode('iso-8859-1').rstrip(),
+                 "Content-Type: %s" % content_type]
+        for name, value in self.headers:
+            pieces = compile_template(str(value))
+            if pieces is None:
+                lines.append("%s: %s" % (name, value))
+            else:
+                self._templated.append((("%s: " % name).encode('iso-8859-1'), pieces))
+        self._start = ("\r\n".join(lines) + "\r\n").encode('iso-8859-1')
+
+    def respond(self, method, path, headers, body):
+        """
+        Build the response to one request.
+
+        :param body: Body of the request
+        :type body: :class:`stubserver.body.RequestBody`
+
+        :rtype: :class:`stubserver.response.PreparedResponse`
+        """
+        if self.callback is not None:
+            return self._call(method, path, headers, body)
+        values = _Values(self.url_re(), path, headers, body)
+        head = [self._start]
+        for name, pieces in self._templated:
+            head.append(name)
+            # A header value taken from the request must not start a new header
+            head.append(_render(pieces, values).replace(b"\r", b"").replace(b"\n", b""))
+            head.append(b"\r\n")
+        content = _render(self.body, values)
+        if sends_length(self.code):
+            head.append(("Content-Length: %d\r\n" % len(content)).encode('ascii'))
+        return _RenderedResponse(self.code, b"".join(head), content, self.closes)
+
+    def _call(self, method, path, headers, body):
+        url_re = self.url_re()
+        request = TemplateRequest(method, path, query_of(path), headers, body.getvalue(), url_re.search(path))
+        try:
+            answer = self.callback(request)
+        except Exception:
+            return PreparedResponse(500, "Response callable failed", "text/plain", None,
+                                    traceback.format_exc().encode('utf-8'))
+        code, extra = self.code, ()
+        if isinstance(answer, tuple):
+            code, extra, answer = answer
+        return PreparedResponse(code, self.message, self.content_type, self.headers + list(extra or ()),
+                                to_bytes(answer))
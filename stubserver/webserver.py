@@ -1,76 +1,200 @@
+import copy
+import gc
+import json
+import select
+import socket
 import sys
 import threading
 import re
 import time
+from stubserver.body import DEFAULT_CAPTURE_LIMIT, RequestBody, read_body
+from stubserver.cassette import CassetteRecorder, CassetteReplayer
+from stubserver.cluster import ProcessCluster
+from stubserver.journal import DEFAULT_JOURNAL_SIZE, Journal
+from stubserver.matcher import Body, ExpectationIndex, literal_prefix
+from stubserver.response import DeferredResponse, FileResponse, PreparedResponse, send_file, to_bytes
+from stubserver.spec import RETURN_KEYS, read_spec
+from stubserver.scheduler import Pacing, ResponseScheduler, socketpair
+from stubserver.stats import STATS_PATH, ServerStats
+from stubserver.template import TemplateResponse
 if sys.version_info[0] < 3:
     import BaseHTTPServer
+    import SocketServer
 else:
     import http.server as BaseHTTPServer
+    import socketserver as SocketServer
 if sys.version_info[0] < 3:
-    from urllib import urlopen
+    import Queue as queue
 else:
-    from urllib.request import urlopen
+    import queue
+try:
+    import selectors
+except ImportError:
+    # Python 2 and 3.3 wait with select instead
+    selectors = None
 
 
-class StoppableHTTPServer(BaseHTTPServer.HTTPServer):
+class StubHTTPServer(BaseHTTPServer.HTTPServer):
     """
-    Python 2.5 HTTPServer does not close down properly when calling server_close.
-    The implementation below was based on the comments in the below article:
-    http://stackoverflow.com/questions/268629/how-to-stop-basehttpserver-serveforever-in-a-basehttprequesthandler-subclass
+    HTTP server whose handlers can hand a connection over to a
+    :class:`ResponseScheduler` for delayed or throttled responses.
+    The server of a port opened for a :class:`Scope` has it as ``scope``.
+
+    :meth:`serve_forever` sets :attr:`serving` once it is waiting for
+    connections and :meth:`shutdown` wakes it through a socket pair instead
+    of waiting for the next poll, so stopping takes milliseconds.
+    :meth:`server_close` also shuts down the connections still open, so a
+    kept-alive connection is not answered by a stopped server.
     """
-    stopped = False
-    allow_reuse_address = True
+    scheduler = None
+    scope = None
 
     def __init__(self, *args, **kw):
         BaseHTTPServer.HTTPServer.__init__(self, *args, **kw)
+        self._detached = set()
+        self._open = set()
+        self._scheduler_lock = threading.Lock()
+        self.serving = threading.Event()
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._stopping = False
+        self._wake_r, self._wake_w = socketpair()
+        self._wake_r.setblocking(False)
+
+    def serve_forever(self, poll_interval=None):
+        self._stopping = False
+        self._stopped.clear()
+        if selectors:
+            selector = selectors.DefaultSelector()
+            selector.register(self, selectors.EVENT_READ)
+            selector.register(self._wake_r, selectors.EVENT_READ)
+        self.serving.set()
+        try:
+            while not self._stopping:
+                if selectors:
+                    ready = [key.fileobj for key, _ in selector.select()]
+                else:
+                    ready = select.select([self, self._wake_r], [], [])[0]
+                if self._stopping:
+                    break
+                if self._wake_r in ready:
+                    self._drain_wake()
+                if self in ready:
+                    self._handle_request_noblock()
+        finally:
+            if selectors:
+                selector.close()
+            self.serving.clear()
+            self._stopped.set()
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except socket.error:
+            pass
 
-    def serve_forever(self):
-        while not self.stopped:
-            self.handle_request()
+    def shutdown(self):
+        """Stop :meth:`serve_forever` and wait until it has returned."""
+        self._stopping = True
+        try:
+            self._wake_w.send(b'x')
+        except socket.error:
+            pass
+        self._stopped.wait()
+
+    def schedule(self, request, pieces):
+        """Let the scheduler write ``pieces`` to ``request`` and close it afterwards."""
+        with self._scheduler_lock:
+            if self.scheduler is None:
+                self.scheduler = ResponseScheduler()
+            self._detached.add(request)
+        self.scheduler.submit(request, pieces)
+
+    def get_request(self):
+        request, client_address = BaseHTTPServer.HTTPServer.get_request(self)
+        with self._scheduler_lock:
+            self._open.add(request)
+        return request, client_address
+
+    def shutdown_request(self, request):
+        with self._scheduler_lock:
+            self._open.discard(request)
+            if request in self._detached:
+                self._detached.discard(request)
+                return
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
 
     def server_close(self):
         BaseHTTPServer.HTTPServer.server_close(self)
-        self.stopped = True
-        self._create_dummy_request()
-        time.sleep(0.5)
+        self._wake_r.close()
+        self._wake_w.close()
+        with self._scheduler_lock:
+            still_open, self._open = self._open, set()
+        # Their handlers read end of file and finish, ending any keep-alive loop
+        for request in still_open:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self.scheduler is not None:
+            self.scheduler.close()
 
-    def shutdown(self):
-        pass
 
-    def _create_dummy_request(self):
-        f = urllib.urlopen("http://localhost:" + str(self.server_port) + "/__shutdown")
-        f.read()
-        f.close()
+# Not derived from object: on Python 2 the servers it is mixed into are old-style classes, and object
+# ahead of them in the MRO would take their __init__
+class ThreadPoolMixIn:
+    """
+    Serve each connection on one of a fixed number of worker threads instead
+    of the thread calling :meth:`serve_forever`.
+    """
+    pool_size = 8
 
+    def process_request(self, request, client_address):
+        if not hasattr(self, '_requests'):
+            self._requests = queue.Queue()
+            self._workers = []
+            for i in range(self.pool_size):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        self._requests.put((request, client_address))
 
-if sys.version_info < (2, 6):
-    HTTPServer = StoppableHTTPServer
-else:
-    HTTPServer = BaseHTTPServer.HTTPServer
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
 
+    def stop_workers(self):
+        for worker in getattr(self, '_workers', []):
+            self._requests.put(None)
 
-class StubServer(object):
-    def __init__(self, port=8080, address='localhost'):
-        self._expectations = []
-        self.port = port
-        self.address = address
 
-    def run(self):
-        server_address = (self.address, self.port)
-        self.httpd = HTTPServer(server_address, StubResponse(self._expectations))
-        thread = threading.Thread(target=self._run)
-        thread.start()
+class ThreadPoolHTTPServer(ThreadPoolMixIn, StubHTTPServer):
+    def server_close(self):
+        StubHTTPServer.server_close(self)
+        self.stop_workers()
 
-    def stop(self):
-        self.httpd.shutdown()
-        self.httpd.server_close()
-        self.verify()
 
-    def _run(self):
-        try:
-            self.httpd.serve_forever()
-        except:
-            pass
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, StubHTTPServer):
+    daemon_threads = True
+
+
+class ExpectationScope(object):
+    """Expectations registered and verified together."""
+
+    def __init__(self):
+        self._expectations = []
+        self._index = ExpectationIndex()
 
     def verify(self):
         """
@@ -83,13 +207,14 @@ class StubServer(object):
             if not expectation.satisfied:
                 failures.append(str(expectation))
         del self._expectations[:]
+        self._index.clear()
         if failures:
             raise Exception("Unsatisfied expectations: " + "\n".join(failures))
 
     def expect(self, method="GET", url="^UrlRegExpMather$", data=None, data_capture=None,
-               file_content=None):
+               file_content=None, capture_digest=False, times=1):
         """
-        Prepare :class:`StubServer` to handle an HTTP request.
+        Prepare the server to handle an HTTP request.
 
         :param method: HTTP method
         :type method: ``str``
@@ -97,25 +222,498 @@ class StubServer(object):
         :param url: Regex matching with path part of an URL
         :type url: Raw ``str``
 
-        :param data: Excepted data
-        :type data: ``None`` or other
+        :param data: Excepted data: the exact body, or a :class:`Body`
+                     matcher comparing it as JSON, a form or with a regex
+        :type data: ``None``, ``str``, ``bytes``, :class:`Body` or other
 
         :param data_capture: Dictionary given by user for gather data returned
-                             by server.
+                             by server. Filled with ``body`` (decoded text),
+                             ``raw`` (bytes) and ``size``, or ``file`` when
+                             the body was larger than ``capture_limit``.
         :type data_capture: ``dict``
 
         :param file_content: Unsed
 
+        :param capture_digest: Only record ``size`` and ``sha256`` of the body
+                               in ``data_capture``
+        :type capture_digest: ``bool``
+
+        :param times: How many requests the expectation answers: an exact
+                      count, a :class:`Times` range, or ``None`` for any
+                      number of requests (at least one).
+                      ``data_capture`` holds the latest request.
+        :type times: ``int``, :class:`Times` or ``None``
+
         :return: Expectation object initilized
         :rtype: :class:`Expectation`
         """
-        expected = Expectation(method, url, data, data_capture)
+        expected = Expectation(method, url, data, data_capture, capture_digest, times)
+        # Report a bad pattern now rather than on the first request
+        expected.url_re
         self._expectations.append(expected)
+        self._index.add(expected)
         return expected
 
+    def load(self, source, format=None):
+        """
+        Register every expectation described in a spec file, see
+        :mod:`stubserver.spec` for the formats.
+
+        URL patterns are compiled and bodies read on first use, so specs with
+        tens of thousands of expectations load quickly.
+
+        :param source: File name, or open text file
+        :type source: ``str`` or file
+
+        :param format: ``"json"`` or ``"lines"``, guessed when not given
+        :type format: ``None`` or ``str``
+
+        :return: The expectations, in the order of the spec
+        :rtype: ``list`` of :class:`Expectation`
+        :raises: ValueError: If the spec is malformed.
+        """
+        entries = read_spec(source, format)
+        # Collections triggered by the many new objects would otherwise take a third of the time
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            loaded = []
+            for entry in entries:
+                data = entry.get('data')
+                if isinstance(data, (dict, list)):
+                    data = Body.json(data)
+                times = entry.get('times', 1)
+                if isinstance(times, dict):
+                    times = Times(times.get('minimum', 0), times.get('maximum'))
+                expected = Expectation(entry.get('method', "GET"), entry['url'], data, None,
+                                       entry.get('capture_digest', False), times)
+                expected.and_return(lazy=True, **dict((key, entry[key]) for key in RETURN_KEYS.intersection(entry)))
+                loaded.append(expected)
+            self._expectations.extend(loaded)
+            self._index.add_all(loaded)
+        finally:
+            if collecting:
+                gc.enable()
+        return loaded
+
+
+class StubServer(ExpectationScope):
+    # Values :meth:`scope` accepts for ``route``
+    scope_routes = ("prefix", "header", "port")
+
+    def __init__(self, port=8080, address='localhost', threads=None, protocol_version="HTTP/1.0",
+                 keep_alive_timeout=5, max_keep_alive_requests=None, capture_limit=DEFAULT_CAPTURE_LIMIT,
+                 journal_size=DEFAULT_JOURNAL_SIZE, journal_file=None, processes=None):
+        """
+        :param port: Port to listen on, 0 picks a free one. :attr:`port`
+                     holds the port actually bound once :meth:`run` returns.
+        :type port: ``int``
+
+        :param address: Address to listen on
+        :type address: ``str``
+
+        :param threads: Number of worker threads serving requests
+                        concurrently. ``None`` serves one connection at a
+                        time on the server thread, or one thread per
+                        connection when keep-alive is enabled.
+        :type threads: ``None`` or ``int``
+
+        :param protocol_version: ``"HTTP/1.1"`` keeps connections open
+                                 between requests and answers pipelined
+                                 requests in order.
+        :type protocol_version: ``str``
+
+        :param keep_alive_timeout: Seconds an HTTP/1.1 connection may stay
+                                   idle before it is closed
+        :type keep_alive_timeout: ``float``
+
+        :param max_keep_alive_requests: Number of requests served on one
+                                        HTTP/1.1 connection before it is
+                                        closed. ``None`` for no limit.
+        :type max_keep_alive_requests: ``None`` or ``int``
+
+        :param capture_limit: Bytes of a request body held in memory. Larger
+                              bodies are spooled to a temporary file.
+        :type capture_limit: ``int``
+
+        :param journal_size: Requests kept in :attr:`journal`
+        :type journal_size: ``int``
+
+        :param journal_file: File every request is also appended to, as a
+                             line of JSON
+        :type journal_file: ``None`` or ``str``
+
+        :param processes: Number of worker processes sharing the port, each
+                          serving as configured by ``threads`` and
+                          ``protocol_version``. ``None`` serves from this
+                          process. Expectations must be registered before
+                          :meth:`run`.
+        :type processes: ``None`` or ``int``
+        """
+        ExpectationScope.__init__(self)
+        self._stats = ServerStats()
+        self.journal = Journal(journal_size, journal_file)
+        self.port = port
+        self.address = address
+        self.threads = threads
+        self.protocol_version = protocol_version
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_keep_alive_requests = max_keep_alive_requests
+        self.capture_limit = capture_limit
+        self.processes = processes
+        self._cluster = None
+        self._scopes = ScopeRouter(self._index)
+        self._fallback = None
+
+    def _create_server(self, server_address, handler, listener=None):
+        """Create the server, binding a new socket unless a ``listener`` that already listens is given."""
+        if self.threads:
+            server = ThreadPoolHTTPServer(server_address, handler, bind_and_activate=False)
+            server.pool_size = self.threads
+            server.request_queue_size = max(server.request_queue_size, self.threads * 4)
+        elif self.protocol_version != "HTTP/1.0":
+            # An idle keep-alive connection would otherwise block every other client
+            server = ThreadingHTTPServer(server_address, handler, bind_and_activate=False)
+        else:
+            server = StubHTTPServer(server_address, handler, bind_and_activate=False)
+        if listener is None:
+            server.server_bind()
+            server.server_activate()
+        else:
+            server.socket.close()
+            server.socket = listener
+            server.server_address = listener.getsockname()
+            server.server_name, server.server_port = server.server_address[:2]
+        return server
+
+    def _create_handler(self):
+        handler = StubResponse(self._index, self._stats, self.journal, self._scopes)
+        handler.fallback = self._fallback
+        handler.protocol_version = self.protocol_version
+        handler.capture_limit = self.capture_limit
+        if self.protocol_version != "HTTP/1.0":
+            handler.timeout = self.keep_alive_timeout
+            handler.max_requests = self.max_keep_alive_requests
+        return handler
+
+    def run(self):
+        """Start serving. Returns once the server accepts requests."""
+        if self.processes:
+            self._cluster = ProcessCluster(self, self.processes)
+            self._cluster.start()
+            return
+        server_address = (self.address, self.port)
+        self.httpd = self._create_server(server_address, self._create_handler())
+        self.port = self.httpd.server_address[1]
+        self._start(self.httpd)
+
+    def stop(self):
+        if self._cluster is not None:
+            self._cluster.stop()
+            self._cluster = None
+        else:
+            for scope in self._scopes.scopes():
+                self._close_scope(scope)
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        if self._fallback is not None:
+            self._fallback.close()
+            self._fallback = None
+        self.journal.close()
+        self.verify()
+
+    def _start(self, httpd):
+        thread = threading.Thread(target=self._run, args=(httpd,))
+        thread.daemon = True
+        thread.start()
+        httpd.serving.wait()
+
+    def _run(self, httpd):
+        try:
+            httpd.serve_forever()
+        except:
+            pass
+
+    def record(self, upstream, cassette):
+        """
+        Forward every request no expectation matches to ``upstream`` and
+        append the exchange to ``cassette``, for :meth:`replay` later.
+
+        :param upstream: Base URL of the real server, e.g. ``"http://localhost:9000"``
+        :type upstream: ``str``
+
+        :param cassette: File the exchanges are appended to
+        :type cassette: ``str``
+        """
+        if self.processes:
+            raise Exception("Recording is not available when serving from several processes")
+        self._fallback = CassetteRecorder(upstream, cassette)
+
+    def replay(self, cassette):
+        """
+        Answer requests no expectation matches with the responses recorded
+        in ``cassette`` by :meth:`record`, matched on method, path and body.
+        Anything not recorded gets the usual error.
+
+        :param cassette: File written by :meth:`record`
+        :type cassette: ``str``
+        """
+        self._fallback = CassetteReplayer(cassette)
+
+    def scope(self, name=None, route="prefix"):
+        """
+        Open a :class:`Scope`, a separate set of expectations on this server.
+
+        :param name: Name of the scope, also its path prefix or header value.
+                     A unique one is made up when not given.
+        :type name: ``str``
+
+        :param route: How requests reach the scope: ``"prefix"``, the first
+                      segment of the path is ``/name``, ``"header"``, they
+                      carry ``X-Stub-Scope: name``, or ``"port"``, they
+                      arrive on a port opened for the scope.
+        :type route: ``str``
+
+        :rtype: :class:`Scope`
+        """
+        if self._cluster is not None:
+            raise Exception("Scopes are not available when serving from several processes")
+        if route not in self.scope_routes:
+            raise ValueError("Scopes of %s cannot be routed by %r" % (type(self).__name__, route))
+        scope = Scope(self, name or self._scopes.unique_name(), route)
+        self._scopes.add(scope)
+        if route == "port":
+            try:
+                self._open_port(scope)
+            except Exception:
+                self._scopes.remove(scope)
+                raise
+        return scope
+
+    def _open_port(self, scope):
+        httpd = self._create_server((self.address, 0), self._create_handler())
+        httpd.scope = scope
+        scope.httpd = httpd
+        self._start(httpd)
+
+    def _close_scope(self, scope):
+        self._scopes.remove(scope)
+        httpd, scope.httpd = scope.httpd, None
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def stats(self):
+        """
+        Traffic counters, also served as JSON on ``/__stats``.
+
+        :return: ``requests``, ``bytes_in`` and ``bytes_out`` totals,
+                 ``unmatched`` request counts keyed by response code,
+                 ``body_time``, ``match_time`` and ``write_time`` histograms
+                 and the hit count of every registered expectation.
+        :rtype: ``dict``
+        """
+        return self._stats.as_dict(self._index.expectations())
+
+    def expect(self, *args, **kw):
+        """As :meth:`ExpectationScope.expect`, for requests outside any :meth:`scope`."""
+        if self._cluster is not None:
+            raise Exception("Expectations must be registered before run() when serving from several processes")
+        return ExpectationScope.expect(self, *args, **kw)
+
+    def load(self, *args, **kw):
+        """As :meth:`ExpectationScope.load`, for requests outside any :meth:`scope`."""
+        if self._cluster is not None:
+            raise Exception("Expectations must be registered before run() when serving from several processes")
+        return ExpectationScope.load(self, *args, **kw)
+
+
+SCOPE_HEADER = "X-Stub-Scope"
+
+_SCOPE_PREFIX = re.compile(r'^/([^/?]+)(.*)$')
+_SCOPE_NAME = re.compile(r'^[^/?]+$')
+
+
+class Scope(ExpectationScope):
+    """
+    Expectations of one test sharing a long-lived :class:`StubServer` with
+    others, possibly running at the same time.
+
+    Requests routed to the scope are matched only against its expectations,
+    with the path prefix of a ``"prefix"`` scope taken off, and other scopes
+    never see them. Leaving the ``with`` block stops the routing and
+    verifies the scope's expectations alone::
+
+        with server.scope() as scope:
+            scope.expect(method="GET", url="^/users$").and_return(content="[]")
+            requests.get(scope.url + "/users", headers=scope.headers)
+    """
+
+    def __init__(self, server, name, route):
+        ExpectationScope.__init__(self)
+        if route == "prefix" and not _SCOPE_NAME.match(name):
+            raise ValueError("Scope name %r cannot be used as a path segment" % (name,))
+        self.server = server
+        self.name = name
+        self.route = route
+        self.httpd = None
+
+    @property
+    def prefix(self):
+        """Path prefix requests need, empty unless routed by prefix."""
+        return "/" + self.name if self.route == "prefix" else ""
+
+    @property
+    def headers(self):
+        """Headers requests need, empty unless routed by header."""
+        return {SCOPE_HEADER: self.name} if self.route == "header" else {}
+
+    @property
+    def port(self):
+        if self.httpd is not None:
+            return self.httpd.server_address[1]
+        return self.server.port
+
+    @property
+    def url(self):
+        """Base URL of the scope, expectation URLs are matched against what follows it."""
+        return "http://%s:%d%s" % (self.server.address, self.port, self.prefix)
+
+    def close(self):
+        """Stop routing requests to the scope, without verifying it."""
+        self.server._close_scope(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is None:
+            self.verify()
+        else:
+            del self._expectations[:]
+            self._index.clear()
+
+
+class ScopeRouter(object):
+    """Work out which scope's expectations a request is matched against."""
+
+    def __init__(self, default):
+        """
+        :param default: Index used for requests outside every scope
+        :type default: :class:`stubserver.matcher.ExpectationIndex`
+        """
+        self.default = default
+        self._lock = threading.Lock()
+        self._prefixes = {}
+        self._headers = {}
+        self._ports = []
+        self._count = 0
+
+    def unique_name(self):
+        with self._lock:
+            self._count += 1
+            return "scope-%d" % self._count
+
+    def scopes(self):
+        with self._lock:
+            return list(self._prefixes.values()) + list(self._headers.values()) + list(self._ports)
+
+    def add(self, scope):
+        with self._lock:
+            if scope.route == "port":
+                self._ports.append(scope)
+                return
+            names = self._prefixes if scope.route == "prefix" else self._headers
+            if scope.name in names:
+                raise ValueError("Scope %r is already open" % (scope.name,))
+            names[scope.name] = scope
+
+    def remove(self, scope):
+        with self._lock:
+            if scope.route == "port":
+                if scope in self._ports:
+                    self._ports.remove(scope)
+                return
+            names = self._prefixes if scope.route == "prefix" else self._headers
+            if names.get(scope.name) is scope:
+                del names[scope.name]
+
+    def route(self, server, path, headers):
+        """
+        :param server: Server the request arrived on, whose ``scope`` is set
+                       for the port of a ``"port"`` scope
+        :return: ``(index, path)``, the expectations to match and the path to
+                 match them against
+        :rtype: ``tuple``
+        """
+        scope = getattr(server, 'scope', None)
+        if scope is None and self._headers:
+            scope = self._headers.get(headers.get(SCOPE_HEADER))
+        if scope is None and self._prefixes:
+            match = _SCOPE_PREFIX.match(path)
+            if match:
+                scope = self._prefixes.get(match.group(1))
+                if scope is not None:
+                    path = match.group(2)
+                    if not path.startswith('/'):
+                        path = '/' + path
+        if scope is None:
+            return self.default, path
+        return scope._index, path
+
+
+class Times(object):
+    """How many requests an :class:`Expectation` answers and must receive."""
+
+    def __init__(self, minimum, maximum):
+        """
+        :param minimum: Requests needed for :meth:`StubServer.verify` to pass
+        :type minimum: ``int``
+
+        :param maximum: Requests answered before the expectation is
+                        exhausted, ``None`` for no limit
+        :type maximum: ``None`` or ``int``
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @classmethod
+    def exactly(cls, count):
+        return cls(count, count)
+
+    @classmethod
+    def at_least(cls, count):
+        return cls(count, None)
+
+    @classmethod
+    def at_most(cls, count):
+        return cls(0, count)
+
+    @classmethod
+    def unlimited(cls):
+        return cls(1, None)
+
+    @classmethod
+    def coerce(cls, times):
+        if times is None:
+            return cls.unlimited()
+        if isinstance(times, cls):
+            return times
+        return cls.exactly(times)
+
+    def __str__(self):
+        if self.maximum is None:
+            return "at least %d" % self.minimum
+        if self.minimum == self.maximum:
+            return "exactly %d" % self.minimum
+        if self.minimum == 0:
+            return "at most %d" % self.maximum
+        return "between %d and %d" % (self.minimum, self.maximum)
+
 
 class Expectation(object):
-    def __init__(self, method, url, data, data_capture):
+    def __init__(self, method, url, data, data_capture, capture_digest=False, times=1):
         """
         :param method: HTTP method
         :type method: ``str``
@@ -129,16 +727,56 @@ class Expectation(object):
         :param data_capture: Dictionary given by user for gather data returned
                              by server.
         :type data_capture: ``dict``
+
+        :param capture_digest: Only record size and hash of the body
+        :type capture_digest: ``bool``
+
+        :param times: Requests the expectation answers
+        :type times: ``int``, :class:`Times` or ``None``
         """
         if data_capture is None:
             data_capture = {}
         self.method = method
         self.url = url
+        self._url_re = None
+        self.url_prefix, self.url_exact = literal_prefix(url)
         self.data = data
+        self.data_match = Body.coerce(data)
         self.data_capture = data_capture
-        self.satisfied = False
+        self.capture_digest = capture_digest
+        self.times = Times.coerce(times)
+        self._hits = [0]
+        self._slot = 0
 
-    def and_return(self, mime_type="text/html", reply_code=200, content="", file_content=None, headers=None):
+    @property
+    def url_re(self):
+        """The URL regex, compiled when first needed."""
+        if self._url_re is None:
+            self._url_re = re.compile(self.url)
+        return self._url_re
+
+    @property
+    def hits(self):
+        """Requests answered so far, counted in shared memory when several processes serve them."""
+        return self._hits[self._slot]
+
+    @hits.setter
+    def hits(self, value):
+        self._hits[self._slot] = value
+
+    @property
+    def satisfied(self):
+        """True once enough requests have been received."""
+        return self.hits >= self.times.minimum
+
+    @property
+    def exhausted(self):
+        """True once no further request will be answered."""
+        return self.times.maximum is not None and self.hits >= self.times.maximum
+
+    def and_return(self, mime_type="text/html", reply_code=200, content="", file_content=None, headers=None,
+                   serve_file=None, delay=0, jitter=0, bytes_per_second=None, duration=None, lazy=False,
+                   template=False, compress=False):
         """
         Define the response created by the expectation.
 
@@ -148,50 +786,209 @@ class Expectation(object):
         :param reply_code: Define response code of HTTP response
         :type reply_code: ``int``
 
-        :param content: Define response's content
-        :type content: ``str``
+        :param content: Define response's content. ``str`` is sent UTF-8
+                        encoded, ``bytes`` as is. A callable is called for
+                        every request with a
+                        :class:`stubserver.template.TemplateRequest` and
+                        returns the content, or a ``(reply_code, headers,
+                        content)`` tuple.
+        :type content: ``str``, ``bytes`` or callable
 
-        :param file_content: Define response's content from a file
+        :param file_content: Define response's content from a file, read in
+                             binary mode
         :type file_content: ``str``
 
         :param headers: Additional HTTP header fields to be sent
         :type headers: ``iterable of tuples (header field name, value)``
+
+        :param serve_file: Send this file from disk on every hit instead of
+                           reading it into memory. ``Range`` requests are
+                           answered with ``206 Partial Content``.
+        :type serve_file: ``str``
+
+        :param delay: Seconds to wait before the first byte of the response
+        :type delay: ``float``
+
+        :param jitter: Up to this many seconds are added at random to ``delay``
+        :type jitter: ``float``
+
+        :param bytes_per_second: Send the response no faster than this
+        :type bytes_per_second: ``int``
+
+        :param duration: Spread the response so its last byte goes out this
+                         many seconds after the first
+        :type duration: ``float``
+
+        :param lazy: Build the response, reading ``file_content``, on the
+                     first hit rather than now
+        :type lazy: ``bool``
+
+        :param template: Fill placeholders in the content and header values
+                         from the request, see :mod:`stubserver.template`
+        :type template: ``bool``
+
+        :param compress: Send the content gzip, deflate or (with the
+                         ``brotli`` package installed) br encoded to clients
+                         accepting it. Each encoding is compressed once, on
+                         its first request.
+        :type compress: ``bool``
+
+        Delayed or throttled responses are written by a scheduler rather than
+        by the thread serving the connection, and close the connection once
+        sent.
         """
+        self.pacing = None
+        if delay or jitter or bytes_per_second is not None or duration is not None:
+            self.pacing = Pacing(delay, jitter, bytes_per_second, duration)
+        self.template = None
+        if serve_file:
+            self.response = (reply_code, mime_type, None, headers)
+            self.prepared = FileResponse(reply_code, "Python", mime_type, headers, serve_file)
+            return
+        if template or callable(content):
+            if file_content:
+                with open(file_content, "rb") as f:
+                    content = f.read()
+            self.response = (reply_code, mime_type, content, headers)
+            self.prepared = self.template = TemplateResponse(reply_code, "Python", mime_type, headers, content,
+                                                             lambda: self.url_re)
+            return
+        if lazy:
+            self.response = (reply_code, mime_type, None if file_content else content, headers)
+            self.prepared = DeferredResponse(reply_code, "Python", mime_type, headers, to_bytes(content),
+                                             file_content or None, compress)
+            return
         if file_content:
-            f = open(file_content, "r")
+            f = open(file_content, "rb")
             content = f.read()
             f.close()
         self.response = (reply_code, mime_type, content, headers)
+        self.prepared = PreparedResponse(reply_code, "Python", mime_type, headers, to_bytes(content),
+                                         compress=compress)
 
     def __str__(self):
-        return "%s %s \n data_capture: %s\n" % (self.method, self.url, self.data_capture)
+        return "%s %s (expected %s requests, received %d)\n data_capture: %s\n" % (
+            self.method, self.url, self.times, self.hits, self.data_capture)
+
+
+def stats_response(stats, index):
+    """Build the JSON answer to a request for ``/__stats``."""
+    content = json.dumps(stats.as_dict(index.expectations()), sort_keys=True)
+    return PreparedResponse(200, "Python", "application/json", None, content.encode('utf-8'))
+
+
+def fallback_response(fallback, method, path, headers, body):
+    """
+    Ask a recorder or replayer for the answer to an unmatched request.
+
+    :return: The response, or ``None`` when it has none
+    """
+    try:
+        return fallback.respond(method, path, headers, body)
+    except Exception as e:
+        return PreparedResponse(502, "Bad Gateway", "text/plain", None,
+                                ("Recording failed: %s" % e).encode('utf-8'))
+
+
+class Exchange(object):
+    """
+    One request on its way through either serving engine. The engine reads
+    the body and writes the response; matching, building the response and
+    keeping the journal and stats happen here, so both engines answer alike.
+    """
+
+    def __init__(self, journal, stats, method, path, headers):
+        self.journal = journal
+        self.stats = stats
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.started = time.time()
+        self.read = self.matched = None
+        self.body_size = 0
+        self.routed = path
+        self.exp = self.error = None
+        # Response built for this request by a template or a fallback rather than prepared in advance
+        self.recorded = None
+
+    def bad_body(self, error, body):
+        """Return the 400 response to a request whose body could not be read."""
+        self.read = self.matched = time.time()
+        self.body_size = body.size
+        return PreparedResponse(400, "Bad request body", "text/plain", None, str(error).encode('utf-8'))
+
+    def claim(self, scopes, server, body, fallback):
+        """
+        Find and count the expectation answering the request.
+
+        :return: Whether ``fallback`` has to be asked for the response, which
+                 is left to the engine so it can do so without blocking
+        :rtype: ``bool``
+        """
+        self.read = time.time()
+        self.body_size = body.size
+        index, self.routed = scopes.route(server, self.path, self.headers)
+        self.exp, self.error = index.claim(self.method, self.routed, body)
+        if self.exp is not None and self.exp.template is not None:
+            self.recorded = self.exp.template.respond(self.method, self.routed, self.headers, body)
+        return self.exp is None and fallback is not None
+
+    def response(self):
+        """
+        :return: The response, the ``(path, offset, count)`` of a file to send
+                 after it or ``None``, and the pacing of the expectation
+        :rtype: ``tuple``
+        """
+        self.matched = time.time()
+        exp = self.exp
+        if self.recorded is not None:
+            return self.recorded, None, exp.pacing if exp is not None else None
+        if exp is not None:
+            response, file_part = exp.prepared.resolve(self.headers)
+            return response, file_part, exp.pacing
+        err_code, err_message, err_body = self.error
+        return PreparedResponse(err_code, err_message, "text/plain", None, err_body.encode('utf-8')), None, None
+
+    def record(self, code, sent):
+        """
+        Journal and count the request once its response is ready. Called
+        before sending, so a client that has its answer also finds the
+        request in the journal and stats.
+        """
+        self.journal.record(self.method, self.path, code, self.body_size, sent, self.exp)
+        self.stats.record(code, self.exp is not None or self.recorded is not None, self.body_size, sent,
+                          self.read - self.started, self.matched - self.read)
+
+    def written(self):
+        """Count the time taken to write the response."""
+        self.stats.record_write(time.time() - self.matched)
 
 
 class StubResponse(BaseHTTPServer.BaseHTTPRequestHandler):
+    disable_nagle_algorithm = True
+    fallback = None
+    capture_limit = DEFAULT_CAPTURE_LIMIT
+    max_requests = None
+    requests_served = 0
+
     def __call__(self, request, client_address, server):
-        self.request = request
-        self.client_address = client_address
-        self.server = server
+        # Each connection gets its own copy so concurrent requests never
+        # share the request, headers or file objects.
+        handler = copy.copy(self)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = server
         try:
-            self.setup()
-            self.handle()
+            handler.setup()
+            handler.handle()
         finally:
-            self.finish()
+            handler.finish()
 
-    def __init__(self, expectations):
+    def __init__(self, expectations, stats=None, journal=None, scopes=None):
         self.expected = expectations
-
-    def _get_data(self):
-        max_chunk_size = 10 * 1024 * 1024
-        if "content-length" not in self.headers:
-            return b''
-        size_remaining = int(self.headers["content-length"])
-        data = []
-        while size_remaining:
-            chunk_size = min(size_remaining, max_chunk_size)
-            data.append(self.rfile.read(chunk_size))
-            size_remaining -= len(data[-1])
-        return b''.join(data)
+        self.stats = stats if stats is not None else ServerStats()
+        self.journal = journal if journal is not None else Journal()
+        self.scopes = scopes if scopes is not None else ScopeRouter(expectations)
 
     def handle_one_request(self):
         """Handle a single HTTP request.
@@ -200,75 +997,71 @@ class StubResponse(BaseHTTPServer.BaseHTTPRequestHandler):
         __doc__ string for information on how to handle specific HTTP
         commands such as GET and POST.
         """
-
-        def send_headers(exp):
-            self.send_header("Content-Type", exp.response[1])
-            headers = exp.response[3]
-            if headers:
-                for header in headers:
-                    self.send_header(header[0], header[1])
-            self.end_headers()
-
-        self.raw_requestline = self.rfile.readline()
+        try:
+            self.raw_requestline = self.rfile.readline()
+        except socket.timeout:
+            # Keep-alive connection left idle for too long
+            self.close_connection = 1
+            return
         if not self.raw_requestline:
             self.close_connection = 1
             return
         if not self.parse_request():  # An error code has been sent, just exit
             return
-        method = self.command
-        if self.path == "/__shutdown":
-            self.send_response(200, "Python")
-
-        data = self._get_data().decode('utf-8')
-
-        expectations_matching_url = [x for x in self.expected if re.search(x.url, self.path)]
-        expectations_matching_method = [x for x in expectations_matching_url if x.method == method]
-        matching_expectations = [x for x in expectations_matching_method if not x.satisfied]
-        matching_expectations_with_data = [x for x in matching_expectations if x.data and x.data == data]
-
-        err_code = err_message = err_body = None
-        if len(matching_expectations_with_data) > 0:
-            exp = matching_expectations_with_data[0]
-            self.send_response(exp.response[0], "Python")
-            send_headers(exp)
-            self.wfile.write(exp.response[2].encode('utf-8'))
-            exp.satisfied = True
-            exp.data_capture["body"] = data
-        elif len(matching_expectations) > 0:
-            exp = matching_expectations[0]
-            if exp.data:
-                err_code = 403
-                err_message = "Payload missing or incorrect"
-                err_body = "This URL expects data: {0}. Query provided: {1}".format(exp.data, data)
-            else:
-                self.send_response(exp.response[0], "Python")
-                send_headers(exp)
-                self.wfile.write(exp.response[2].encode('utf-8'))
-                exp.satisfied = True
-                exp.data_capture["body"] = data
-        elif len(expectations_matching_method) > 0:
-            # All expectations have been fulfilled
-            err_code = 400
-            err_message = "Expectations exhausted"
-            err_body = "Expectations at this URL have already been satisfied.\n" + str(expectations_matching_method)
-        elif len(expectations_matching_url) > 0:
-            # Method not allowed
-            err_code = 405
-            err_message = "Method not allowed"
-            err_body = "Method " + method + " not allowed.\n" + str(expectations_matching_url)
-        else:
-            # not found
-            err_code = 404
-            err_message = "Not found"
-            err_body = "No URL pattern matched."
+        self.requests_served += 1
+        if self.max_requests and self.requests_served >= self.max_requests:
+            self.close_connection = 1
+        exchange = Exchange(self.journal, self.stats, self.command, self.path, self.headers)
+        body = RequestBody(self.capture_limit)
+        try:
+            try:
+                read_body(self.rfile, self.headers, body)
+            except ValueError as e:
+                self.close_connection = 1
+                self._answer(exchange, exchange.bad_body(e, body))
+                return
+            if self.path == STATS_PATH:
+                self._write_response(stats_response(self.stats, self.expected))
+                return
+            if exchange.claim(self.scopes, self.server, body, self.fallback):
+                exchange.recorded = fallback_response(self.fallback, self.command, exchange.routed, self.headers,
+                                                      body)
+        finally:
+            body.close()
+        self._answer(exchange, *exchange.response())
+
+    def _answer(self, exchange, response, file_part=None, pacing=None):
+        buffers, file_part, sent = self._render_response(response, file_part, pacing)
+        exchange.record(response.code, sent)
+        self._send_response(buffers, file_part, pacing)
+        exchange.written()
 
-        if err_code is not None:
-            self.send_response(err_code, err_message)
-            self.send_header("Content-Type", "text/plain")
-            self.end_headers()
-            self.wfile.write(err_body.encode('utf-8'))
+    def _write_response(self, response, file_part=None, pacing=None):
+        """Send ``response`` and return the number of bytes it takes on the wire."""
+        buffers, file_part, sent = self._render_response(response, file_part, pacing)
+        self._send_response(buffers, file_part, pacing)
+        return sent
 
+    def _render_response(self, response, file_part=None, pacing=None):
+        """Return the buffers and file part to send for ``response``, and their size on the wire."""
+        if response.closes or pacing is not None:
+            self.close_connection = 1
+        head_only = self.command == "HEAD"
+        announce_close = self.close_connection and self.request_version == "HTTP/1.1"
+        buffers = response.render(self.protocol_version, announce_close, head_only)
+        if head_only:
+            file_part = None
+        return buffers, file_part, sum(len(buf) for buf in buffers) + (file_part[2] if file_part else 0)
+
+    def _send_response(self, buffers, file_part=None, pacing=None):
+        if pacing is not None:
+            self.server.schedule(self.request, pacing.schedule(buffers, file_part))
+            return
+        for buf in buffers:
+            self.wfile.write(buf)
         self.wfile.flush()
+        if file_part is not None:
+            send_file(self.connection, *file_part)
 
     def log_request(code=None, size=None):
         pass
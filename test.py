@@ -1,16 +1,40 @@
+import hashlib
+import json
 import os
+import shutil
+import socket
+import time
 import unittest
+import zlib
 import requests
 import sys
 import tempfile
-from io import BytesIO
-from ftplib import FTP
-from stubserver import StubServer, FTPStubServer
+import threading
+from io import BytesIO, StringIO
+from ftplib import FTP, error_perm, error_temp
+from stubserver import Body, StubServer, FTPStubServer, Times
+from stubserver import ftpserver
+from stubserver.ftpstorage import DirectoryStorage
+from stubserver.journal import Journal
+from stubserver.matcher import literal_prefix
+if sys.version_info >= (3, 7):
+    import asyncio
+    from stubserver import AsyncStubServer
 from unittest import TestCase
 if sys.version_info[0] < 3:
     from urllib2 import OpenerDirector, HTTPHandler, Request
+    from httplib import HTTPConnection
 else:
     from urllib.request import OpenerDirector, HTTPHandler, Request
+    from http.client import HTTPConnection
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
 
 
 class WebTest(TestCase):
@@ -49,6 +73,49 @@ class WebTest(TestCase):
             response.close()
             os.unlink(data_file)
 
+    def test_get_with_binary_file_call(self):
+        payload = bytes(bytearray(range(256))) * 4
+        with tempfile.NamedTemporaryFile(mode='wb', delete=False) as f:
+            f.write(payload)
+            data_file = f.name
+        try:
+            self.server.expect(method="GET", url="^/blob$").and_return(mime_type="application/octet-stream",
+                                                                        file_content=data_file)
+            r = requests.get("http://localhost:8998/blob")
+            self.assertEqual(payload, r.content)
+            self.assertEqual(str(len(payload)), r.headers["Content-Length"])
+        finally:
+            os.unlink(data_file)
+
+    def test_serve_file_streams_binary_file_with_ranges(self):
+        payload = os.urandom(3 * 1024 * 1024 + 17)
+        with tempfile.NamedTemporaryFile(mode='wb', delete=False) as f:
+            f.write(payload)
+            data_file = f.name
+        try:
+            for i in range(4):
+                self.server.expect(method="GET", url="^/download$").and_return(
+                    mime_type="application/octet-stream", serve_file=data_file)
+            r = requests.get("http://localhost:8998/download")
+            self.assertEqual(payload, r.content)
+            self.assertEqual("bytes", r.headers["Accept-Ranges"])
+            r = requests.get("http://localhost:8998/download", headers={"Range": "bytes=1000-"})
+            self.assertEqual(206, r.status_code)
+            self.assertEqual(payload[1000:], r.content)
+            self.assertEqual("bytes 1000-%d/%d" % (len(payload) - 1, len(payload)), r.headers["Content-Range"])
+            r = requests.get("http://localhost:8998/download", headers={"Range": "bytes=-10"})
+            self.assertEqual(payload[-10:], r.content)
+            r = requests.get("http://localhost:8998/download", headers={"Range": "bytes=%d-" % len(payload)})
+            self.assertEqual(416, r.status_code)
+        finally:
+            os.unlink(data_file)
+
+    def test_bytes_content_is_sent_as_is_with_date_header(self):
+        self.server.expect(method="GET", url="^/bytes$").and_return(content=b"\xff\x00raw")
+        r = requests.get("http://localhost:8998/bytes")
+        self.assertEqual(b"\xff\x00raw", r.content)
+        self.assertTrue(r.headers["Date"].endswith("GMT"))
+
     def test_put_with_capture(self):
         capture = {}
         self.server.expect(method="PUT", url="/address/\d+$", data_capture=capture).and_return(reply_code=201)
@@ -93,6 +160,14 @@ class WebTest(TestCase):
         f, reply_code = self._make_request("http://localhost:8998/address/45/inhabitant", method="POST", payload='<inhabitant name="Chris"/>')
         self.assertEqual(204, reply_code)
 
+    def test_no_content_response_has_no_content_length(self):
+        self.server.expect(method="DELETE", url="^/thing$").and_return(reply_code=204)
+        self.server.expect(method="GET", url="^/thing$").and_return(reply_code=200)
+        r = requests.delete("http://localhost:8998/thing")
+        self.assertEqual(204, r.status_code)
+        self.assertFalse("Content-Length" in r.headers)
+        self.assertEqual("0", requests.get("http://localhost:8998/thing").headers["Content-Length"])
+
     def test_multiple_expectations_identifies_correct_unmatched_request(self):
         self.server.expect(method="POST", url="address/\d+/inhabitant", data='Twas brillig and the slithy toves').and_return(reply_code=204)
         f, reply_code = self._make_request("http://localhost:8998/address/45/inhabitant", method="POST", payload='Twas brillig and the slithy toves')
@@ -167,6 +242,204 @@ class WebTest(TestCase):
         self.assertEqual("Expectations exhausted",f.msg)
         self.assertTrue(f.read().startswith(b"Expectations at this URL have already been satisfied.\n"))
 
+    def test_expectation_with_times_answers_that_many_requests(self):
+        capture = {}
+        self.server.expect(method="POST", url="^/hit$", data_capture=capture, times=3).and_return(content="hit")
+        for i in range(3):
+            f, reply_code = self._make_request("http://localhost:8998/hit", method="POST", payload=str(i))
+            self.assertEqual(b"hit", f.read())
+        self.assertEqual("2", capture["body"])
+        f, reply_code = self._make_request("http://localhost:8998/hit", method="POST", payload="3")
+        self.assertEqual(400, reply_code)
+
+    def test_unlimited_expectation_answers_every_request(self):
+        self.server.expect(method="GET", url="^/always$", times=None).and_return(content="again")
+        with requests.Session() as session:
+            for i in range(50):
+                self.assertEqual("again", session.get("http://localhost:8998/always").text)
+        self.assertEqual(50, self.server._expectations[0].hits)
+
+    def test_verify_reports_expected_and_received_counts(self):
+        self.server.expect(method="GET", url="^/twice$", times=Times.at_least(2)).and_return()
+        self.server.expect(method="GET", url="^/optional$", times=Times.at_most(2)).and_return()
+        self._make_request("http://localhost:8998/twice", method="GET")
+        try:
+            self.server.stop()
+            self.fail("verify should have failed")
+        except Exception as e:
+            self.assertTrue("expected at least 2 requests, received 1" in str(e), str(e))
+            self.assertFalse("optional" in str(e), str(e))
+
+    def test_stats_count_hits_misses_and_bytes(self):
+        self.server.expect(method="POST", url="^/counted$", times=2).and_return(content="12345")
+        requests.post("http://localhost:8998/counted", data="abc")
+        requests.post("http://localhost:8998/counted", data="defg")
+        requests.get("http://localhost:8998/missing")
+        requests.get("http://localhost:8998/counted")
+        stats = self.server.stats()
+        self.assertEqual(4, stats["requests"])
+        self.assertEqual({"404": 1, "405": 1}, stats["unmatched"])
+        self.assertEqual(7, stats["bytes_in"])
+        self.assertEqual(4, stats["match_time"]["count"])
+        self.assertEqual([{"method": "POST", "url": "^/counted$", "hits": 2, "times": "exactly 2"}],
+                         stats["expectations"])
+        served = requests.get("http://localhost:8998/__stats").json()
+        self.assertEqual(stats["requests"], served["requests"])
+        self.assertEqual(stats["expectations"], served["expectations"])
+
+    def test_journal_records_matched_and_unmatched_requests(self):
+        exp = self.server.expect(method="POST", url="^/journal/\\d+$", times=2)
+        exp.and_return(content="ok")
+        requests.post("http://localhost:8998/journal/1", data="abc")
+        mark = self.server.journal.checkpoint()
+        requests.post("http://localhost:8998/journal/2", data="de")
+        requests.get("http://localhost:8998/elsewhere")
+        records = self.server.journal.records()
+        self.assertEqual(["/journal/1", "/journal/2", "/elsewhere"], [r.path for r in records])
+        self.assertEqual([200, 200, 404], [r.status for r in records])
+        self.assertEqual([3, 2, 0], [r.bytes_in for r in records])
+        self.assertEqual(["^/journal/\\d+$", "^/journal/\\d+$", None], [r.expectation for r in records])
+        self.assertEqual(["/journal/2", "/elsewhere"], [r.path for r in self.server.journal.records(since=mark)])
+        self.assertEqual(2, len(self.server.journal.records(url="^/journal/")))
+        self.assertEqual(2, len(self.server.journal.records(expectation=exp)))
+        self.assertEqual(["/elsewhere"], [r.path for r in self.server.journal.records(status=404)])
+
+    def test_load_json_spec_reads_body_files_on_first_hit(self):
+        directory = tempfile.mkdtemp()
+        spec = os.path.join(directory, "spec.json")
+        body = os.path.join(directory, "user.json")
+        with open(spec, "w") as f:
+            json.dump({"expectations": [
+                {"method": "GET", "url": "^/users/1$", "file_content": "user.json", "mime_type": "application/json",
+                 "headers": {"X-Loaded": "yes"}},
+                {"method": "POST", "url": "^/users$", "data": "name=bob", "reply_code": 201, "times": None},
+            ]}, f)
+        loaded = self.server.load(spec)
+        # The body file only has to exist by the time it is requested
+        with open(body, "w") as f:
+            f.write('{"id": 1}')
+        r = requests.get("http://localhost:8998/users/1")
+        self.assertEqual({"id": 1}, r.json())
+        self.assertEqual("yes", r.headers["X-Loaded"])
+        self.assertEqual(201, requests.post("http://localhost:8998/users", data="name=bob").status_code)
+        self.assertEqual(2, len(loaded))
+        for name in (spec, body):
+            os.remove(name)
+        os.rmdir(directory)
+
+    def test_load_line_spec(self):
+        spec = StringIO(u"# health checks\nGET ^/health$ 200 all good\n\nDELETE ^/users/\\d+$ 204\n")
+        self.server.load(spec)
+        self.assertEqual("all good", requests.get("http://localhost:8998/health").text)
+        self.assertEqual(204, requests.delete("http://localhost:8998/users/7").status_code)
+
+    def test_load_rejects_unknown_keys(self):
+        self.assertRaises(ValueError, self.server.load, StringIO(u'[{"url": "^/$", "reply": 200}]'))
+
+    def test_template_fills_in_url_groups_query_headers_and_body(self):
+        self.server.expect(method="POST", url=r"^/address/(\d+)/(?P<part>\w+)", times=None).and_return(
+            mime_type="application/json", template=True,
+            content='{"id": {url.1}, "part": "{url.part}", "q": "{query.q}", "by": "{header.X-User}", "body": "{body}"}',
+            headers=(("Location", "/address/{url.1}"), ("X-Static", "yes")))
+        r = requests.post("http://localhost:8998/address/12/street?q=main", data="abc", headers={"X-User": "bob"})
+        self.assertEqual({"id": 12, "part": "street", "q": "main", "by": "bob", "body": "abc"}, r.json())
+        self.assertEqual("/address/12", r.headers["Location"])
+        self.assertEqual("yes", r.headers["X-Static"])
+        r = requests.post("http://localhost:8998/address/7/town")
+        self.assertEqual({"id": 7, "part": "town", "q": "", "by": "", "body": ""}, r.json())
+
+    def test_callable_response(self):
+        def answer(request):
+            if request.query.get("fail"):
+                return 409, [("X-Reason", "asked")], "conflict"
+            return "%s %s %s" % (request.method, request.match.group(1), request.body.decode('utf-8'))
+        self.server.expect(method="PUT", url=r"^/items/(\d+)", times=None).and_return(content=answer)
+        self.assertEqual("PUT 3 new", requests.put("http://localhost:8998/items/3", data="new").text)
+        r = requests.put("http://localhost:8998/items/3?fail=1")
+        self.assertEqual(409, r.status_code)
+        self.assertEqual("asked", r.headers["X-Reason"])
+        self.assertEqual("conflict", r.text)
+
+    def test_failing_callable_answers_500(self):
+        self.server.expect(method="GET", url="^/broken$").and_return(content=lambda request: 1 / 0)
+        r = requests.get("http://localhost:8998/broken")
+        self.assertEqual(500, r.status_code)
+        self.assertTrue("ZeroDivisionError" in r.text)
+
+    def test_compressed_response_variants(self):
+        payload = json.dumps([{"id": i, "name": "item %d" % i} for i in range(200)])
+        self.server.expect(method="GET", url="^/items$", times=None).and_return(
+            mime_type="application/json", content=payload, compress=True)
+        self.server.expect(method="GET", url="^/small$").and_return(content="tiny", compress=True)
+        for coding, decompress in (("gzip", lambda data: zlib.decompress(data, 31)), ("deflate", zlib.decompress)):
+            for i in range(2):
+                conn = HTTPConnection("localhost", 8998)
+                conn.request("GET", "/items", headers={"Accept-Encoding": "br;q=0, %s" % coding})
+                response = conn.getresponse()
+                self.assertEqual(coding, response.getheader("Content-Encoding"))
+                self.assertEqual("Accept-Encoding", response.getheader("Vary"))
+                self.assertEqual(payload.encode('utf-8'), decompress(response.read()))
+                conn.close()
+        conn = HTTPConnection("localhost", 8998)
+        conn.request("GET", "/items")
+        response = conn.getresponse()
+        self.assertEqual(None, response.getheader("Content-Encoding"))
+        self.assertEqual(payload.encode('utf-8'), response.read())
+        conn.close()
+        r = requests.get("http://localhost:8998/small")
+        self.assertEqual(None, r.headers.get("Content-Encoding"))
+
+    def test_compressed_request_body_is_matched_after_decompressing(self):
+        capture = {}
+        self.server.expect(method="POST", url="^/gzip$", data="hello world", data_capture=capture).and_return()
+        self.server.expect(method="PUT", url="^/deflate$", data="raw deflate").and_return()
+        gzipper = zlib.compressobj(6, zlib.DEFLATED, 31)
+        body = gzipper.compress(b"hello world") + gzipper.flush()
+        r = requests.post("http://localhost:8998/gzip", data=body, headers={"Content-Encoding": "gzip"})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual("hello world", capture["body"])
+        deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+        body = deflater.compress(b"raw deflate") + deflater.flush()
+        r = requests.put("http://localhost:8998/deflate", data=iter([body[:3], body[3:]]),
+                         headers={"Content-Encoding": "deflate"})
+        self.assertEqual(200, r.status_code)
+
+    def test_corrupt_compressed_request_body_is_rejected(self):
+        r = requests.post("http://localhost:8998/gzip", data=b"not gzip", headers={"Content-Encoding": "gzip"})
+        self.assertEqual(400, r.status_code)
+
+    def test_json_body_matches_whatever_the_key_order(self):
+        self.server.expect(method="PUT", url="^/address/1$", data=Body.json({"hello": "world", "n": [1, 2]})).and_return(
+            reply_code=201)
+        self.server.expect(method="PUT", url="^/address/2$", data=Body.json('{"a": {"b": 1}}', partial=True)).and_return(
+            reply_code=202)
+        r = requests.put("http://localhost:8998/address/1", data='{ "n" : [1,2], "hello":"world" }')
+        self.assertEqual(201, r.status_code)
+        r = requests.put("http://localhost:8998/address/2", data='{"a": {"b": 1, "c": 2}, "d": 3}')
+        self.assertEqual(202, r.status_code)
+
+    def test_form_and_regex_body_matchers(self):
+        self.server.expect(method="POST", url="^/login$", data=Body.form({"user": "bob", "roles": ["a", "b"]})).and_return(
+            content="full")
+        self.server.expect(method="POST", url="^/login$", data=Body.form("user=eve", partial=True)).and_return(
+            content="partial")
+        self.server.expect(method="POST", url="^/log", data=Body.matching(r"level=(warn|error)")).and_return(
+            content="regex")
+        self.assertEqual("full", requests.post("http://localhost:8998/login", data="roles=a&user=bob&roles=b").text)
+        self.assertEqual("partial", requests.post("http://localhost:8998/login", data="token=1&user=eve").text)
+        self.assertEqual("regex", requests.post("http://localhost:8998/log/app", data="time=1&level=warn").text)
+
+    def test_many_expectations_on_one_url_differing_by_body(self):
+        self.server.expect(method="POST", url="^/items$").and_return(content="any")
+        for i in range(2000):
+            self.server.expect(method="POST", url="^/items$", data=Body.json({"id": i}), times=Times.at_most(1)).and_return(
+                content=str(i))
+        for i in (1999, 0, 1000):
+            self.assertEqual(str(i), requests.post("http://localhost:8998/items", data='{"id": %d}' % i).text)
+        self.assertEqual("any", requests.post("http://localhost:8998/items", data='{"id": -1}').text)
+        r = requests.post("http://localhost:8998/items", data='{"id": 0}')
+        self.assertEqual(403, r.status_code)
+
     def test_returns_additional_headers_for_expectation_without_data(self):
         self.server.expect(method="GET", url="/api/endpoint").and_return(
             headers=(("some_header", "foo"), ("some_other_header", "bar"),))
@@ -186,6 +459,381 @@ class WebTest(TestCase):
         self.assertEqual(r.headers["some_other_header"], "bar")
 
 
+    def test_indexed_and_scanned_patterns_are_matched_in_registration_order(self):
+        self.server.expect(method="GET", url="counter$").and_return(content="1")
+        self.server.expect(method="GET", url="^/counter$").and_return(content="2")
+        self.server.expect(method="GET", url="^/count").and_return(content="3")
+        for i in range(1, 4):
+            f, reply_code = self._make_request("http://localhost:8998/counter", method="GET")
+            self.assertEqual(str(i).encode('utf-8'), f.read())
+        self.server.expect(method="GET", url="^/users/42").and_return(content="nested first")
+        self.server.expect(method="GET", url="^/users").and_return(content="shorter second")
+        for content in (b"nested first", b"shorter second"):
+            f, reply_code = self._make_request("http://localhost:8998/users/42", method="GET")
+            self.assertEqual(content, f.read())
+
+    def test_many_expectations_only_match_their_own_url(self):
+        for i in range(500):
+            self.server.expect(method="GET", url="^/item/%d$" % i).and_return(content=str(i))
+        for i in range(500):
+            self.server.expect(method="GET", url="^/item/%d$" % i).and_return(content=str(i))
+        f, reply_code = self._make_request("http://localhost:8998/item/123", method="GET")
+        self.assertEqual(b"123", f.read())
+        f, reply_code = self._make_request("http://localhost:8998/item/123", method="GET")
+        self.assertEqual(b"123", f.read())
+        f, reply_code = self._make_request("http://localhost:8998/item/123", method="GET")
+        self.assertEqual(400, reply_code)
+        del self.server._expectations[:]
+
+
+class SlowResponseWebTest(TestCase):
+    def setUp(self):
+        self.server = StubServer(8998)
+        self.server.run()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _timed(self, func):
+        started = time.time()
+        result = func()
+        return result, time.time() - started
+
+    def test_delayed_response_does_not_hold_up_other_requests(self):
+        self.server.expect(method="GET", url="^/slow$").and_return(content="slow", delay=0.5)
+        self.server.expect(method="GET", url="^/fast$").and_return(content="fast")
+        slow = []
+        thread = threading.Thread(target=lambda: slow.append(self._timed(
+            lambda: requests.get("http://localhost:8998/slow").text)))
+        thread.start()
+        time.sleep(0.1)
+        fast, elapsed = self._timed(lambda: requests.get("http://localhost:8998/fast").text)
+        self.assertEqual("fast", fast)
+        self.assertTrue(elapsed < 0.3, elapsed)
+        thread.join()
+        self.assertEqual("slow", slow[0][0])
+        self.assertTrue(slow[0][1] >= 0.5, slow[0][1])
+
+    def test_bandwidth_limited_response(self):
+        payload = b"z" * 20000
+        self.server.expect(method="GET", url="^/trickle$").and_return(content=payload, bytes_per_second=40000)
+        content, elapsed = self._timed(lambda: requests.get("http://localhost:8998/trickle").content)
+        self.assertEqual(payload, content)
+        self.assertTrue(elapsed >= 0.4, elapsed)
+
+    def test_many_delayed_responses_in_flight(self):
+        self.server.expect(method="GET", url="^/wait$", times=50).and_return(content="done", delay=0.5)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(requests.get("http://localhost:8998/wait").text))
+                   for i in range(50)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(["done"] * 50, results)
+        self.assertTrue(time.time() - started < 3, time.time() - started)
+
+
+class CaptureWebTest(TestCase):
+    def setUp(self):
+        self.server = StubServer(8998, capture_limit=1024)
+        self.server.run()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_chunked_upload_is_decoded_before_matching(self):
+        capture = {}
+        self.server.expect(method="POST", url="^/upload$", data="hello world", data_capture=capture).and_return()
+        r = requests.post("http://localhost:8998/upload", data=iter([b"hello", b" ", b"world"]))
+        self.assertEqual(200, r.status_code)
+        self.assertEqual("hello world", capture["body"])
+
+    def test_non_utf8_body_is_captured_as_raw_bytes(self):
+        capture = {}
+        self.server.expect(method="PUT", url="^/latin$", data_capture=capture).and_return(reply_code=204)
+        r = requests.put("http://localhost:8998/latin", data=b"caf\xe9")
+        self.assertEqual(204, r.status_code)
+        self.assertEqual(b"caf\xe9", capture["raw"])
+        self.assertEqual(4, capture["size"])
+
+    def test_body_over_capture_limit_is_spilled_to_a_file(self):
+        capture = {}
+        payload = os.urandom(100 * 1024)
+        self.server.expect(method="PUT", url="^/big$", data_capture=capture).and_return(reply_code=201)
+        r = requests.put("http://localhost:8998/big", data=payload)
+        self.assertEqual(201, r.status_code)
+        self.assertFalse("raw" in capture)
+        try:
+            self.assertEqual(payload, capture["file"].read())
+        finally:
+            capture["file"].close()
+
+    def test_digest_only_capture(self):
+        capture = {}
+        payload = b"x" * 5000
+        self.server.expect(method="PUT", url="^/digest$", data_capture=capture, capture_digest=True).and_return()
+        requests.put("http://localhost:8998/digest", data=payload)
+        self.assertEqual({"size": 5000, "sha256": hashlib.sha256(payload).hexdigest()}, capture)
+
+
+class ConcurrentWebTest(TestCase):
+    def setUp(self):
+        self.server = StubServer(8998, threads=8)
+        self.server.run()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _concurrently(self, count, func):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func())) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_one_shot_expectation_is_claimed_exactly_once(self):
+        capture = {}
+        self.server.expect(method="POST", url="^/claim$", data_capture=capture).and_return(content="mine")
+        codes = self._concurrently(20, lambda: requests.post("http://localhost:8998/claim", data="x").status_code)
+        self.assertEqual(1, codes.count(200))
+        self.assertEqual(19, codes.count(400))
+        self.assertEqual("x", capture["body"])
+
+    def test_concurrent_requests_each_get_their_own_response(self):
+        for i in range(20):
+            self.server.expect(method="GET", url="^/slot$").and_return(content="ok")
+        bodies = self._concurrently(20, lambda: requests.get("http://localhost:8998/slot").text)
+        self.assertEqual(["ok"] * 20, bodies)
+
+
+@unittest.skipIf(not hasattr(os, 'fork'), "worker processes are forked")
+class MultiProcessWebTest(TestCase):
+    def setUp(self):
+        self.server = StubServer(0, threads=4, processes=2)
+
+    def _get(self, path):
+        return requests.get("http://localhost:%d%s" % (self.server.port, path))
+
+    def test_one_shot_expectations_are_claimed_once_across_processes(self):
+        for i in range(20):
+            self.server.expect(method="GET", url="^/once$").and_return(content=str(i))
+        self.server.run()
+        try:
+            self.results = []
+            pool = [threading.Thread(target=lambda: self.results.append(self._get("/once").text)) for i in range(25)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+        finally:
+            self.server.stop()
+        self.assertEqual(sorted(str(i) for i in range(20)), sorted(r for r in self.results if r.isdigit()))
+        self.assertEqual(5, len([r for r in self.results if not r.isdigit()]))
+
+    def test_captures_hits_and_journal_reach_the_parent(self):
+        captured = {}
+        self.server.expect(method="PUT", url="^/upload$", data_capture=captured).and_return(reply_code=201)
+        exp = self.server.expect(method="GET", url="^/twice$", times=2)
+        exp.and_return(content="ok")
+        self.server.run()
+        requests.put("http://localhost:%d/upload" % self.server.port, data="from a worker")
+        self._get("/twice")
+        try:
+            self.server.stop()
+            self.fail("verify should have failed")
+        except Exception as e:
+            self.assertTrue("expected exactly 2 requests, received 1" in str(e), str(e))
+        self.assertEqual("from a worker", captured["body"])
+        self.assertEqual(["/upload", "/twice"], [r.path for r in self.server.journal.records()])
+        self.assertEqual(2, self.server.stats()["requests"])
+
+
+class KeepAliveWebTest(TestCase):
+    def setUp(self):
+        self.server = StubServer(8998, protocol_version="HTTP/1.1", keep_alive_timeout=0.5,
+                                 max_keep_alive_requests=3)
+        self.server.run()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_connection_is_reused_across_requests(self):
+        self.server.expect(method="GET", url="^/a$").and_return(content="first")
+        self.server.expect(method="POST", url="^/b$", data="payload").and_return(reply_code=201)
+        conn = HTTPConnection("localhost", 8998)
+        try:
+            conn.request("GET", "/a")
+            response = conn.getresponse()
+            self.assertEqual(b"first", response.read())
+            sock = conn.sock
+            conn.request("POST", "/b", body="payload")
+            response = conn.getresponse()
+            self.assertEqual(201, response.status)
+            self.assertEqual(b"", response.read())
+            self.assertTrue(conn.sock is sock)
+        finally:
+            conn.close()
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        for i in range(3):
+            self.server.expect(method="GET", url="^/p/%d$" % i).and_return(content="reply %d" % i)
+        sock = socket.create_connection(("localhost", 8998))
+        try:
+            sock.sendall(b"".join(b"GET /p/" + str(i).encode('utf-8') + b" HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                                  for i in range(3)))
+            received = b""
+            while received.count(b"reply") < 3:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                received += chunk
+        finally:
+            sock.close()
+        self.assertTrue(received.index(b"reply 0") < received.index(b"reply 1") < received.index(b"reply 2"))
+        self.assertTrue(b"Connection: close" in received)
+
+    def test_idle_connection_is_closed_after_timeout(self):
+        sock = socket.create_connection(("localhost", 8998))
+        try:
+            sock.settimeout(5)
+            self.assertEqual(b"", sock.recv(1024))
+        finally:
+            sock.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "asyncio engine needs Python 3.7+")
+class AsyncWebTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = AsyncStubServer(0)
+        self.loop.run_until_complete(self.server.start())
+        self.url = "http://localhost:%d" % self.server.port
+
+    def tearDown(self):
+        try:
+            self.loop.run_until_complete(self.server.stop())
+        finally:
+            self.loop.close()
+
+    def _in_thread(self, func):
+        return self.loop.run_until_complete(self.loop.run_in_executor(None, func))
+
+    def test_get_and_post_on_one_connection(self):
+        capture = {}
+        self.server.expect(method="GET", url="/monitor/server_status$").and_return(content="Server is up")
+        self.server.expect(method="POST", url="^/data/$", data="John", data_capture=capture).and_return(
+            reply_code=201, headers=(("some_header", "foo"),))
+        with requests.Session() as session:
+            r = self._in_thread(lambda: session.get(self.url + "/monitor/server_status"))
+            self.assertEqual("Server is up", r.text)
+            r = self._in_thread(lambda: session.post(self.url + "/data/", data="John"))
+            self.assertEqual(201, r.status_code)
+            self.assertEqual("foo", r.headers["some_header"])
+        self.assertEqual("John", capture["body"])
+
+    def test_chunked_upload(self):
+        capture = {}
+        self.server.expect(method="POST", url="^/upload$", data="hello world", data_capture=capture).and_return()
+        r = self._in_thread(lambda: requests.post(self.url + "/upload", data=iter([b"hello", b" ", b"world"])))
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(b"hello world", capture["raw"])
+
+    def test_stats_endpoint(self):
+        self.server.expect(method="GET", url="^/x$").and_return(content="x")
+        self._in_thread(lambda: requests.get(self.url + "/x"))
+        stats = self._in_thread(lambda: requests.get(self.url + "/__stats")).json()
+        self.assertEqual(1, stats["requests"])
+        self.assertEqual(1, stats["expectations"][0]["hits"])
+
+    def test_scopes_routed_by_prefix_and_header(self):
+        with self.server.scope("async") as by_prefix, self.server.scope(route="header") as by_header:
+            by_prefix.expect(method="GET", url="^/x$").and_return(content="prefix")
+            by_header.expect(method="GET", url="^/x$").and_return(content="header")
+            r = self._in_thread(lambda: requests.get(by_header.url + "/x", headers=by_header.headers))
+            self.assertEqual("header", r.text)
+            self.assertEqual("prefix", self._in_thread(lambda: requests.get(by_prefix.url + "/x")).text)
+        self.assertRaises(ValueError, self.server.scope, route="port")
+
+    def test_undecodable_body_is_answered_and_counted(self):
+        r = self._in_thread(lambda: requests.post(self.url + "/gz", data=b"not gzip",
+                                                  headers={"Content-Encoding": "gzip"}))
+        self.assertEqual(400, r.status_code)
+        self.assertEqual([("POST", "/gz", 400)], [(x.method, x.path, x.status) for x in self.server.journal.records()])
+        self.assertEqual({"400": 1}, self.server.stats()["unmatched"])
+
+    def test_template(self):
+        self.server.expect(method="GET", url=r"^/users/(\d+)$").and_return(content="user {url.1}", template=True)
+        self.assertEqual("user 5", self._in_thread(lambda: requests.get(self.url + "/users/5")).text)
+
+    def test_delayed_response(self):
+        self.server.expect(method="GET", url="^/slow$").and_return(content="slow", duration=0.3, delay=0.2)
+        started = time.time()
+        r = self._in_thread(lambda: requests.get(self.url + "/slow"))
+        self.assertEqual("slow", r.text)
+        self.assertTrue(time.time() - started >= 0.5)
+
+    def test_serve_file_with_range(self):
+        with tempfile.NamedTemporaryFile(mode='wb', delete=False) as f:
+            f.write(b"0123456789")
+            data_file = f.name
+        try:
+            self.server.expect(method="GET", url="^/download$").and_return(serve_file=data_file)
+            r = self._in_thread(lambda: requests.get(self.url + "/download", headers={"Range": "bytes=2-4"}))
+            self.assertEqual(206, r.status_code)
+            self.assertEqual(b"234", r.content)
+        finally:
+            os.unlink(data_file)
+
+    def test_unmatched_requests_get_the_same_errors(self):
+        self.server.expect(method="POST", url="^/data/$", data="Bob").and_return()
+        self.assertEqual(404, self._in_thread(lambda: requests.get(self.url + "/nothing")).status_code)
+        self.assertEqual(405, self._in_thread(lambda: requests.put(self.url + "/data/")).status_code)
+        self.assertEqual(403, self._in_thread(lambda: requests.post(self.url + "/data/", data="Chris")).status_code)
+        self.assertRaises(Exception, self.loop.run_until_complete, self.server.stop())
+
+
+class MatcherTest(TestCase):
+    def test_literal_prefix_of_fully_literal_pattern_is_exact(self):
+        self.assertEqual(("/api/endpoint", True), literal_prefix("^/api/endpoint$"))
+        self.assertEqual(("/a.b", True), literal_prefix(r"^/a\.b$"))
+
+    def test_literal_prefix_stops_at_regex_syntax(self):
+        self.assertEqual(("/address/", False), literal_prefix(r"^/address/\d+$"))
+        self.assertEqual(("/item", False), literal_prefix("^/items?$"))
+        self.assertEqual(("", False), literal_prefix("/address/45"))
+        self.assertEqual(("", False), literal_prefix("^/a|^/b"))
+
+
+class JournalTest(TestCase):
+    def test_oldest_records_are_overwritten_when_full(self):
+        journal = Journal(3)
+        for i in range(5):
+            journal.record("GET", "/item/%d" % (i % 2), 200)
+        self.assertEqual(3, len(journal))
+        self.assertEqual(2, journal.dropped)
+        self.assertEqual([2, 3, 4], [r.seq for r in journal.records()])
+        self.assertEqual([2, 4], [r.seq for r in journal.records(url="/item/0")])
+        self.assertEqual([3, 4], [r.seq for r in journal.records(url="^/item/", since=3)])
+
+    def test_records_are_streamed_to_a_file(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "journal.jsonl")
+        journal = Journal(1, path)
+        journal.record("GET", "/first", 200, 0, 10)
+        journal.record("PUT", "/second", 201, 5, 0)
+        journal.close()
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        os.remove(path)
+        os.rmdir(directory)
+        self.assertEqual(["/first", "/second"], [line["path"] for line in lines])
+        self.assertEqual(["/second"], [r.path for r in journal.records()])
+
+
 class FTPTest(TestCase):
     def setUp(self):
         self.server = FTPStubServer(0)
@@ -202,8 +850,37 @@ class FTPTest(TestCase):
         self.server.stop()
 
     def test_change_directory(self):
+        self.ftp.mkd('newdir')
         self.ftp.cwd('newdir')
-        self.assertEqual(self.ftp.pwd(), 'newdir')
+        self.assertEqual(self.ftp.pwd(), '/newdir')
+
+    def test_change_to_missing_directory(self):
+        self.assertRaises(error_perm, self.ftp.cwd, 'nowhere')
+        self.assertEqual(self.ftp.pwd(), '/')
+
+    def test_directory_hierarchy(self):
+        self.ftp.mkd('a/b')
+        self.ftp.cwd('a')
+        self.ftp.storbinary('STOR b/deep.txt', BytesIO(b'deep'))
+        self.ftp.storbinary('STOR top.txt', BytesIO(b'top'))
+        self.assertEqual(['b', 'top.txt'], self.ftp.nlst())
+        self.ftp.cwd('b')
+        self.assertEqual(['deep.txt'], self.ftp.nlst())
+        self.ftp.sendcmd('CDUP')
+        self.assertEqual(self.ftp.pwd(), '/a')
+        self.assertEqual('deep', self.server.files('a/b/deep.txt'))
+        self.assertRaises(error_perm, self.ftp.storbinary, 'STOR missing/x.txt', BytesIO(b'x'))
+
+    def test_binary_transfers_are_exact(self):
+        content = bytes(bytearray(range(256))) * 4
+        self.ftp.storbinary('STOR blob.bin', BytesIO(content))
+        self.assertEqual(content, self.server.storage.read('/blob.bin'))
+        chunks = []
+        self.ftp.retrbinary('RETR blob.bin', chunks.append)
+        self.assertEqual(content, b''.join(chunks))
+
+    def test_retrieve_missing_file(self):
+        self.assertRaises(error_perm, self.ftp.retrbinary, 'RETR nothing.txt', lambda data: None)
 
     def test_make_directory(self):
         prev_dir = self.ftp.pwd()
@@ -243,6 +920,46 @@ class FTPTest(TestCase):
         self.ftp.retrlines('NLST', accumulate)
         self.assertEqual(sorted(self.lines), sorted(['vanadiyam.pdf', 'palladium.csv']))
 
+    def test_commands_are_journaled(self):
+        self.ftp.storbinary('STOR journal.txt', BytesIO(b'twelve bytes'))
+        self.ftp.retrbinary('RETR journal.txt', lambda data: None)
+        records = self.server.journal.records()
+        self.assertEqual(["USER", "PASS"], [r.method for r in records[:2]])
+        stor, = self.server.journal.records(method="STOR")
+        self.assertEqual(("journal.txt", 226, 12), (stor.path, stor.status, stor.bytes_in))
+        retr, = self.server.journal.records(method="RETR")
+        self.assertEqual(12, retr.bytes_out)
+
+    def test_passive_listeners_are_reused(self):
+        self.server.add_file('small.txt', 'x')
+        ports = set()
+        for i in range(200):
+            reply = self.ftp.sendcmd('PASV')
+            numbers = reply[reply.index('(') + 1:reply.index(')')].split(',')
+            self.assertEqual(['127', '0', '0', '1'], numbers[:4])
+            ports.add(int(numbers[4]) * 256 + int(numbers[5]))
+            self.ftp.voidcmd('TYPE I')
+            conn = socket.create_connection(('localhost', int(numbers[4]) * 256 + int(numbers[5])))
+            self.ftp.sendcmd('RETR small.txt')
+            self.assertEqual(b'x', conn.recv(10))
+            conn.close()
+            self.ftp.voidresp()
+        self.assertEqual(1, len(ports))
+
+    def test_extended_passive_mode(self):
+        self.ftp.af = socket.AF_INET6  # makes ftplib use EPSV
+        self.server.add_file('e.txt', 'epsv')
+        try:
+            self.assertEqual(["epsv"], self._retrlines('RETR e.txt'))
+        finally:
+            self.ftp.af = socket.AF_INET
+        self.assertEqual(1, len(self.server.journal.records(method="EPSV")))
+
+    def _retrlines(self, command):
+        lines = []
+        self.ftp.retrlines(command, lines.append)
+        return lines
+
     def test_retrieve_expected_file_returns_file(self):
         expected_content = 'content of my file\nis a complete mystery to me.'
         self.server.add_file('foo.txt', expected_content)
@@ -254,6 +971,487 @@ class FTPTest(TestCase):
         self.assertEqual(expected_content, '\n'.join(file_content))
 
 
+class FTPControlTest(TestCase):
+    def setUp(self):
+        self.server = FTPStubServer(0)
+        self.server.run()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_failing_command_keeps_the_session(self):
+        def broken(path):
+            raise RuntimeError("storage failure")
+        self.server.add_file('a.txt', 'a')
+        self.server.storage.size = broken
+        ftp = FTP()
+        ftp.connect('localhost', self.server.port)
+        ftp.login('user', 'passwd')
+        try:
+            self.assertRaises(error_temp, ftp.size, 'a.txt')
+            self.assertEqual('/', ftp.pwd())
+        finally:
+            ftp.quit()
+
+    def test_pipelined_and_split_commands(self):
+        sock = socket.create_connection(('localhost', self.server.port))
+        rfile = sock.makefile('rb')
+        try:
+            self.assertTrue(rfile.readline().startswith(b'220'))
+            sock.sendall(b'USER a\r\nPASS b\r\nPWD\r\nFROB x\r\nSITE y\r\nCWD\r\n')
+            self.assertEqual([b'331', b'230', b'257', b'500', b'502', b'501'], [rfile.readline()[:3] for i in range(6)])
+            sock.sendall(b'TYPE  \r\nTYPE X\r\n')
+            self.assertEqual([b'501', b'504'], [rfile.readline()[:3] for i in range(2)])
+            sock.sendall(b'MKD /tmp\r\n')
+            self.assertTrue(rfile.readline().startswith(b'257'))
+            for part in (b'CW', b'D /tm', b'p\r', b'\nQUIT\r\n'):
+                sock.sendall(part)
+                time.sleep(0.01)
+            self.assertEqual(b'250 OK. Current directory is "/tmp"\r\n', rfile.readline())
+            self.assertTrue(rfile.readline().startswith(b'221-'))
+            self.assertTrue(rfile.readline().startswith(b'221 '))
+        finally:
+            rfile.close()
+            sock.close()
+
+
+class FTPConcurrentSessionTest(TestCase):
+    def test_sessions_keep_their_own_state(self):
+        server = FTPStubServer(0)
+        server.run()
+        errors = []
+
+        def session(number):
+            try:
+                ftp = FTP()
+                ftp.connect('localhost', server.port)
+                ftp.login('user%d' % number, 'passwd')
+                ftp.mkd('dir%d' % number)
+                ftp.cwd('dir%d' % number)
+                for i in range(20):
+                    name = 'file-%d-%d.txt' % (number, i)
+                    ftp.storbinary('STOR ' + name, BytesIO(name.encode('utf-8')))
+                    content = []
+                    ftp.retrbinary('RETR ' + name, content.append)
+                    if b''.join(content) != name.encode('utf-8'):
+                        errors.append((name, content))
+                    if ftp.pwd() != '/dir%d' % number:
+                        errors.append((number, ftp.pwd()))
+                ftp.quit()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=session, args=(n,)) for n in range(8)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([], errors)
+            self.assertEqual('file-7-19.txt', server.files('dir7/file-7-19.txt'))
+        finally:
+            server.stop()
+
+
+class FTPPassivePortRangeTest(TestCase):
+    def test_transfers_use_ports_of_the_range(self):
+        first = free_port()
+        server = FTPStubServer(0, passive_ports=[first])
+        server.run()
+        try:
+            server.add_file('a.txt', 'alpha')
+            ftp = FTP()
+            ftp.connect('localhost', server.port)
+            ftp.login('user', 'passwd')
+            for i in range(5):
+                self.assertEqual(first, ftp.makepasv()[1])
+            lines = []
+            ftp.retrlines('RETR a.txt', lines.append)
+            self.assertEqual(['alpha'], lines)
+            ftp.quit()
+        finally:
+            server.stop()
+
+    def test_listener_of_a_dropped_session_is_released(self):
+        first = free_port()
+        server = FTPStubServer(0, passive_ports=[first])
+        server.run()
+        try:
+            for i in range(3):
+                ftp = FTP()
+                ftp.connect('localhost', server.port)
+                ftp.login('user', 'passwd')
+                deadline = time.time() + 2
+                while True:
+                    try:
+                        self.assertEqual(first, ftp.makepasv()[1])
+                        break
+                    except error_temp:
+                        # The server may not have noticed the previous client is gone yet
+                        if time.time() > deadline:
+                            raise
+                        time.sleep(0.05)
+                # Gone without QUIT
+                ftp.close()
+        finally:
+            server.stop()
+
+    def test_transfer_without_passive_mode_is_refused(self):
+        server = FTPStubServer(0)
+        server.run()
+        try:
+            ftp = FTP()
+            ftp.connect('localhost', server.port)
+            ftp.login('user', 'passwd')
+            try:
+                ftp.sendcmd('LIST')
+                self.fail("LIST without PASV was accepted")
+            except Exception as e:
+                self.assertTrue(str(e).startswith('425'), e)
+            ftp.quit()
+        finally:
+            server.stop()
+
+
+class FTPDirectoryStorageTest(TestCase):
+    def setUp(self):
+        self.storage = DirectoryStorage()
+        self.server = FTPStubServer(0, storage=self.storage)
+        self.server.run()
+        self.ftp = FTP()
+        self.ftp.connect('localhost', self.server.port)
+        self.ftp.login('user', 'passwd')
+
+    def tearDown(self):
+        self.ftp.quit()
+        self.server.stop()
+        self.storage.close()
+
+    def test_large_files_are_streamed_through_disk(self):
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        self.ftp.mkd('big')
+        self.ftp.storbinary('STOR big/file.bin', BytesIO(content), blocksize=65536)
+        with open(os.path.join(self.storage.root, 'big', 'file.bin'), 'rb') as f:
+            self.assertEqual(content, f.read())
+        chunks = []
+        self.ftp.retrbinary('RETR big/file.bin', chunks.append)
+        self.assertEqual(content, b''.join(chunks))
+        self.assertEqual(['file.bin'], self.ftp.nlst('big'))
+
+    def test_upload_without_data_connection_leaves_no_partial_file(self):
+        timeout, ftpserver.DATA_TIMEOUT = ftpserver.DATA_TIMEOUT, 0.2
+        try:
+            self.ftp.sendcmd('PASV')
+        finally:
+            ftpserver.DATA_TIMEOUT = timeout
+        self.assertTrue(self.ftp.sendcmd('STOR never.bin').startswith('150'))
+        self.assertRaises(error_temp, self.ftp.getresp)
+        self.assertEqual([], os.listdir(self.storage.root))
+
+    def test_added_files_are_written_to_the_directory(self):
+        self.server.add_file('docs/readme.txt', 'hello')
+        self.assertEqual('hello', self.server.files('/docs/readme.txt'))
+        self.assertEqual(['docs'], self.ftp.nlst())
+
+
+class FTPDirectoryStorageCleanupTest(TestCase):
+    def test_given_root_is_left_alone(self):
+        root = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(root, 'precious.txt'), 'w') as f:
+                f.write('keep me')
+            server = FTPStubServer(0, storage=DirectoryStorage(root))
+            server.run()
+            self.assertEqual('keep me', server.files('precious.txt'))
+            server.stop()
+            self.assertEqual(['precious.txt'], os.listdir(root))
+        finally:
+            shutil.rmtree(root)
+
+    def test_temporary_root_is_removed_on_stop(self):
+        storage = DirectoryStorage()
+        server = FTPStubServer(0, storage=storage)
+        server.run()
+        server.add_file('a.txt', 'a')
+        server.stop()
+        self.assertFalse(os.path.exists(storage.root))
+
+
+class FTPResumeTest(TestCase):
+    content = bytes(bytearray(range(256))) * 1024
+
+    def setUp(self):
+        self.server = self.make_server()
+        self.server.run()
+        self.ftp = FTP()
+        self.ftp.connect('localhost', self.server.port)
+        self.ftp.login('user', 'passwd')
+        self.ftp.voidcmd('TYPE I')
+
+    def make_server(self):
+        return FTPStubServer(0)
+
+    def tearDown(self):
+        self.ftp.quit()
+        self.server.stop()
+
+    def _interrupted(self, transfer, *args):
+        try:
+            transfer(*args)
+            self.fail("The transfer was not interrupted")
+        except error_temp as e:
+            self.assertTrue(str(e).startswith('426'), e)
+        except socket.error:
+            # The upload was still being sent when the connection dropped; its reply is still to be read
+            self.assertRaises(error_temp, self.ftp.getresp)
+
+    def test_interrupted_download_is_resumed(self):
+        self.server.add_file('big.bin', self.content)
+        self.server.interrupt_transfers(100000)
+        first = []
+        self._interrupted(self.ftp.retrbinary, 'RETR big.bin', first.append)
+        first = b''.join(first)
+        self.assertEqual(100000, len(first))
+        rest = []
+        self.ftp.retrbinary('RETR big.bin', rest.append, rest=len(first))
+        self.assertEqual(self.content, first + b''.join(rest))
+        retr = self.server.journal.records(method="RETR")
+        self.assertEqual([426, 226], [r.status for r in retr])
+
+    def test_interrupted_upload_is_resumed(self):
+        self.server.interrupt_transfers(70000, verbs=['STOR'])
+        self._interrupted(self.ftp.storbinary, 'STOR up.bin', BytesIO(self.content))
+        received = self.ftp.size('up.bin')
+        self.assertEqual(70000, received)
+        self.ftp.storbinary('STOR up.bin', BytesIO(self.content[received:]), rest=received)
+        self.assertEqual(self.content, self.server.storage.read('/up.bin'))
+
+    def test_resumed_upload_without_data_connection_keeps_the_file(self):
+        self.server.add_file('keep.bin', b'0123456789')
+        timeout, ftpserver.DATA_TIMEOUT = ftpserver.DATA_TIMEOUT, 0.2
+        try:
+            self.ftp.sendcmd('PASV')
+        finally:
+            ftpserver.DATA_TIMEOUT = timeout
+        self.ftp.sendcmd('REST 3')
+        self.assertTrue(self.ftp.sendcmd('STOR keep.bin').startswith('150'))
+        self.assertRaises(error_temp, self.ftp.getresp)
+        self.assertEqual(b'0123456789', self.server.storage.read('/keep.bin'))
+
+    def _retrieve(self, name):
+        chunks = []
+        self.ftp.retrbinary('RETR ' + name, chunks.append)
+        return b''.join(chunks)
+
+    def test_refused_transfers_do_not_hold_up_the_next(self):
+        self.server.add_file('good.txt', 'good')
+        # Without the fix the next transfer would hang rather than fail
+        self.ftp.timeout = 5
+        self.assertRaises(error_perm, self.ftp.retrbinary, 'RETR missing.txt', lambda data: None)
+        self.assertEqual(b'good', self._retrieve('good.txt'))
+        self.assertRaises(error_perm, self.ftp.retrbinary, 'RETR good.txt', lambda data: None, rest=100)
+        self.assertEqual(b'good', self._retrieve('good.txt'))
+        self.assertRaises(error_perm, self.ftp.storbinary, 'STOR nowhere/x.txt', BytesIO(b'x'))
+        self.assertEqual(['good.txt'], self.ftp.nlst())
+
+    def test_append(self):
+        self.ftp.storbinary('APPE log.txt', BytesIO(b'one\n'))
+        self.ftp.storbinary('APPE log.txt', BytesIO(b'two\n'))
+        self.assertEqual('one\ntwo\n', self.server.files('log.txt'))
+
+    def test_restart_past_the_end_is_refused(self):
+        self.server.add_file('small.txt', 'small')
+        self.ftp.sendcmd('REST 100')
+        self.assertRaises(error_perm, self.ftp.retrbinary, 'RETR small.txt', lambda data: None)
+        self.assertRaises(error_perm, self.ftp.sendcmd, 'REST ten')
+
+    def test_size_and_modification_time(self):
+        self.server.add_file('docs/a.txt', 'twelve bytes')
+        self.assertEqual(12, self.ftp.size('docs/a.txt'))
+        reply = self.ftp.sendcmd('MDTM docs/a.txt')
+        self.assertEqual(time.strftime('213 %Y', time.gmtime()), reply[:8])
+        self.assertEqual(18, len(reply))
+        self.assertRaises(error_perm, self.ftp.size, 'docs/missing.txt')
+        self.assertRaises(error_perm, self.ftp.sendcmd, 'MDTM docs')
+
+    def test_machine_listing(self):
+        self.server.add_file('docs/a.txt', 'twelve bytes')
+        self.server.add_file('top.txt', '')
+        entries = dict(self.ftp.mlsd())
+        self.assertEqual(['docs', 'top.txt'], sorted(entries))
+        self.assertEqual('dir', entries['docs']['type'])
+        self.assertEqual(('file', '0'), (entries['top.txt']['type'], entries['top.txt']['size']))
+        a, = self.ftp.mlsd('docs')
+        self.assertEqual(('a.txt', '12'), (a[0], a[1]['size']))
+        self.assertEqual(14, len(a[1]['modify']))
+        self.assertTrue(' REST STREAM' in self.ftp.sendcmd('FEAT'))
+
+
+class FTPDirectoryResumeTest(FTPResumeTest):
+    def make_server(self):
+        self.storage = DirectoryStorage()
+        return FTPStubServer(0, storage=self.storage)
+
+    def tearDown(self):
+        FTPResumeTest.tearDown(self)
+        self.storage.close()
+
+
+class ScopeTest(TestCase):
+    def setUp(self):
+        self.server = StubServer(0, protocol_version="HTTP/1.1")
+        self.server.run()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_prefix_scopes_only_see_their_own_expectations(self):
+        with self.server.scope() as first:
+            with self.server.scope("second") as second:
+                first.expect(method="GET", url="^/users$").and_return(content="first")
+                second.expect(method="GET", url="^/users$").and_return(content="second")
+                self.assertEqual("second", requests.get(second.url + "/users").text)
+                self.assertEqual("first", requests.get(first.url + "/users").text)
+                self.assertEqual(404, requests.get("http://localhost:%d/users" % self.server.port).status_code)
+
+    def test_header_and_port_scopes(self):
+        with self.server.scope(route="header") as by_header:
+            with self.server.scope(route="port") as by_port:
+                by_header.expect(method="GET", url="^/$").and_return(content="header")
+                by_port.expect(method="GET", url="^/$").and_return(content="port")
+                self.assertNotEqual(self.server.port, by_port.port)
+                self.assertEqual("port", requests.get(by_port.url + "/").text)
+                self.assertEqual("header", requests.get(by_header.url + "/", headers=by_header.headers).text)
+
+    def test_leaving_a_scope_verifies_only_its_expectations(self):
+        self.server.expect(method="GET", url="^/outside$").and_return(content="outside")
+        try:
+            with self.server.scope() as scope:
+                scope.expect(method="GET", url="^/never$").and_return()
+            self.fail("verify should have failed")
+        except Exception as e:
+            self.assertTrue("/never" in str(e), str(e))
+            self.assertFalse("/outside" in str(e), str(e))
+        requests.get("http://localhost:%d/outside" % self.server.port)
+
+    def test_parallel_scopes_do_not_interfere(self):
+        errors = []
+
+        def run_test(i):
+            try:
+                with self.server.scope() as scope:
+                    scope.expect(method="POST", url="^/items$", times=5).and_return(content=str(i))
+                    for attempt in range(5):
+                        self.assertEqual(str(i), requests.post(scope.url + "/items", data="x").text)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run_test, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+
+class RecordReplayTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cassette = os.path.join(self.directory, "session.cassette")
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def _record(self):
+        upstream = StubServer(0)
+        upstream.expect(method="GET", url="^/users/1$").and_return(
+            mime_type="application/json", content='{"id": 1}', headers=(("X-Upstream", "yes"),))
+        upstream.expect(method="POST", url="^/users$", data="name=bob").and_return(reply_code=201, content="1")
+        upstream.expect(method="POST", url="^/users$", data="name=bob").and_return(reply_code=201, content="2")
+        upstream.run()
+        recorder = StubServer(0)
+        recorder.record("http://localhost:%d" % upstream.port, self.cassette)
+        recorder.run()
+        url = "http://localhost:%d" % recorder.port
+        try:
+            self.assertEqual("yes", requests.get(url + "/users/1").headers["X-Upstream"])
+            self.assertEqual("1", requests.post(url + "/users", data="name=bob").text)
+            self.assertEqual("2", requests.post(url + "/users", data="name=bob").text)
+        finally:
+            recorder.stop()
+            upstream.stop()
+        self.assertTrue(os.path.getsize(self.cassette + ".idx") > 0)
+
+    def _replay(self):
+        player = StubServer(0)
+        player.replay(self.cassette)
+        player.run()
+        url = "http://localhost:%d" % player.port
+        try:
+            r = requests.get(url + "/users/1")
+            self.assertEqual({"id": 1}, r.json())
+            self.assertEqual("application/json", r.headers["Content-Type"])
+            self.assertEqual("yes", r.headers["X-Upstream"])
+            self.assertEqual(["1", "2", "2"], [requests.post(url + "/users", data="name=bob").text for i in range(3)])
+            self.assertEqual(404, requests.post(url + "/users", data="name=eve").status_code)
+        finally:
+            player.stop()
+
+    def test_recorded_exchanges_are_replayed_without_the_upstream(self):
+        self._record()
+        self._replay()
+
+    def test_replay_scans_exchanges_missing_from_the_index(self):
+        self._record()
+        os.remove(self.cassette + ".idx")
+        self._replay()
+
+    def test_unreachable_upstream_is_a_bad_gateway(self):
+        recorder = StubServer(0)
+        recorder.record("http://localhost:%d" % free_port(), self.cassette)
+        recorder.run()
+        try:
+            self.assertEqual(502, requests.get("http://localhost:%d/x" % recorder.port).status_code)
+        finally:
+            recorder.stop()
+
+
+class StartStopTest(TestCase):
+    def test_port_zero_binds_a_free_port(self):
+        server = StubServer(0)
+        server.expect(method="GET", url="^/$").and_return(content="up")
+        server.run()
+        try:
+            self.assertNotEqual(0, server.port)
+            self.assertEqual("up", requests.get("http://localhost:%d/" % server.port).text)
+        finally:
+            server.stop()
+
+    def test_stop_does_not_wait_for_a_poll_interval(self):
+        for protocol_version in ("HTTP/1.0", "HTTP/1.1"):
+            server = StubServer(0, protocol_version=protocol_version)
+            server.run()
+            started = time.time()
+            server.stop()
+            self.assertTrue(time.time() - started < 0.25, protocol_version)
+
+    def test_kept_alive_connection_is_not_served_by_a_stopped_server(self):
+        for threads in (None, 2):
+            session = requests.Session()
+            try:
+                for content in ("first", "second"):
+                    server = StubServer(8998, protocol_version="HTTP/1.1", threads=threads)
+                    server.expect(method="GET", url="^/which$").and_return(content=content)
+                    server.run()
+                    try:
+                        self.assertEqual(content, session.get("http://localhost:8998/which").text)
+                    finally:
+                        server.stop()
+            finally:
+                session.close()
+
+
 class VerifyTest(TestCase):
     def setUp(self):
         self.server = StubServer(8998)